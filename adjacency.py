@@ -0,0 +1,147 @@
+#%%
+"""
+    Graphe d'adjacence des communes : deux communes sont voisines si elles ont une
+    frontière commune (un simple coin commun ne suffit pas).
+
+    Le graphe est stocké au format CSR (tableaux numpy, sauvegardés dans DATA/adjacency.npz) :
+        - indptr : début de la liste des voisins de chaque commune dans indices
+        - indices : positions des communes voisines, triées
+    Les voisins de la commune i sont indices[indptr[i]:indptr[i + 1]].
+"""
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+from shapely.prepared import prep
+
+# Graphe sauvegardé (reconstruit si le jeu de données change)
+adjacency_file = "DATA/adjacency.npz"
+
+
+class Adjacency:
+    """
+        Graphe d'adjacence des communes au format CSR (cf description du module)
+    """
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes
+
+    def neighbours(self, position):
+        """
+            Positions des communes voisines de la commune en position
+        """
+        return self.indices[self.indptr[position]:self.indptr[position + 1]]
+
+    def k_hop(self, position, hops):
+        """
+            Communes à au plus hops frontières de la commune en position (parcours en largeur)
+            Entrées :
+                - position : position de la commune de référence dans le jeu de données
+                - hops : nombre de rangs de voisinage (0 : la commune seule)
+            Sortie :
+                - positions triées des communes retenues (commune de référence comprise)
+        """
+        visited = np.zeros(len(self), dtype=bool)
+        visited[position] = True
+        frontier = np.array([position], dtype=np.int64)
+        for _ in range(hops):
+            # Voisins de toutes les communes du front, lus d'un coup dans indices
+            starts = self.indptr[frontier]
+            lengths = self.indptr[frontier + 1] - starts
+            offsets = np.cumsum(lengths) - lengths
+            index = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+            reached = np.unique(self.indices[index])
+            frontier = reached[~visited[reached]]
+            if len(frontier) == 0:
+                break
+            visited[frontier] = True
+        return np.flatnonzero(visited)
+
+    def save(self, path, version):
+        # Écriture atomique (cf Topology.save)
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        with os.fdopen(handle, "wb") as file:
+            np.savez(file, version=version, indptr=self.indptr, indices=self.indices)
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path, version):
+        """
+            Charge le graphe sauvegardé, ou None s'il correspond à un autre jeu de données
+        """
+        with np.load(path) as saved:
+            if str(saved["version"]) != version:
+                return None
+            return cls(saved["indptr"], saved["indices"])
+
+
+def corner_only(geometry, other):
+    """
+        Vrai si les deux communes ne se touchent qu'en un ou plusieurs points (coin commun),
+        sans frontière commune : elles ne sont pas considérées comme voisines
+    """
+    matrix = geometry.relate(other)
+    # DE-9IM : intérieurs disjoints (F) et frontières qui ne se croisent qu'en des points (0)
+    return matrix[0] == "F" and matrix[4] == "0"
+
+
+def build_adjacency(dataCities):
+    """
+        Construit le graphe d'adjacence de toutes les communes
+        Les paires candidates sont données par l'index spatial (emprises qui se recouvrent),
+        puis confirmées par un test exact d'intersection des contours.
+        Entrées :
+            - dataCities : geoDataFrame de toutes les communes
+        Sorties :
+            - Adjacency
+    """
+    sindex = dataCities.sindex
+    first, second = [], []
+    for pos, geometry in enumerate(dataCities.geometry):
+        if geometry is None or geometry.is_empty:
+            continue
+        # Chaque paire n'est testée qu'une fois (voisin de position supérieure)
+        candidates = [other for other in sindex.intersection(geometry.bounds) if other > pos]
+        if not candidates:
+            continue
+        prepared = prep(geometry)
+        for other in candidates:
+            otherGeometry = dataCities.geometry.iat[other]
+            if prepared.intersects(otherGeometry) and not corner_only(geometry, otherGeometry):
+                first.append(pos)
+                second.append(other)
+
+    # Graphe symétrique, trié par commune puis par voisin
+    rows = np.array(first + second, dtype=np.int64)
+    cols = np.array(second + first, dtype=np.int64)
+    order = np.lexsort((cols, rows))
+    counts = np.bincount(rows, minlength=len(dataCities))
+    indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return Adjacency(indptr, cols[order].astype(np.int32))
+
+
+def load_adjacency(dataCities, version, path=adjacency_file, build=True):
+    """
+        Charge le graphe sauvegardé pour cette version du jeu de données,
+        ou le construit (puis le sauvegarde) ; None s'il manque et que build est faux
+    """
+    try:
+        adjacency = Adjacency.load(path, version)
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        adjacency = None
+
+    if adjacency is None and build:
+        print("graphe d'adjacence des communes non trouvé, génération en cours")
+        adjacency = build_adjacency(dataCities)
+        adjacency.save(path, version)
+
+    return adjacency
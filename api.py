@@ -0,0 +1,350 @@
+#%%
+"""
+    API JSON des statistiques de voisinage des communes.
+
+        GET /api/commune/<insee>/stats?radius=10&tax=TH&year=2018
+        GET /api/commune/<insee>/neighbours?radius=10
+
+    hops=k remplace radius par une sélection des communes à au plus k frontières
+    de la commune (ex : /api/commune/69123/neighbours?hops=2).
+
+    Communes les plus proches au taux plus bas (distance entre centroïdes) :
+
+        GET /api/commune/<insee>/cheaper?k=5&tax=TH&year=2018
+
+    Export des communes (fichier transmis par morceaux, cf export.py) :
+
+        GET /api/commune/<insee>/export?radius=10&format=csv&geometry=1
+        GET /api/export?format=geojson          toutes les communes
+
+    format : csv (par défaut), geojson ou parquet ; geometry=1 ajoute le tracé.
+
+    Les réponses sont calculées à partir du jeu de données partagé en mémoire
+    (index insee et index spatial) et portent un ETag dérivé de la version du
+    jeu de données : un client qui renvoie If-None-Match reçoit un 304 sans
+    que la sélection soit recalculée.
+
+    Administration (jeton dans l'en-tête X-Admin-Token, cf VIZIMPOTS_ADMIN_TOKEN) :
+
+        POST /api/admin/reload    rechargement du jeu de données en arrière-plan
+"""
+import os
+import hmac
+import hashlib
+from collections import OrderedDict
+from threading import Lock, Thread
+
+import numpy as np
+from flask import Blueprint, Response, jsonify, request
+
+from dataset import get_store, reload_store, on_reload, data_yr, dict_tax, DisplaySet, DatasetError
+from engine import Engine
+from export import iter_export, exportFormats, parquet_available
+
+api = Blueprint("api", __name__, url_prefix="/api")
+
+# Durée de mise en cache côté client / proxy (en secondes)
+cacheMaxAge = 3600
+# Rayon maximal accepté (km), identique au slider de l'application
+maxRadius = 100
+# Nombre maximal de rangs de voisinage, identique au slider de l'application
+maxHops = 10
+# Nombre maximal de communes au taux plus bas renvoyées
+maxCheaper = 50
+# Taille totale des réponses conservées en mémoire (octets de JSON, les plus récemment utilisées)
+cacheBytes = 64 << 20
+# Taille maximale d'une réponse conservée (les plus grosses sont recalculées, cf ETag)
+cacheEntryBytes = 4 << 20
+# Jeton des requêtes d'administration (administration désactivée s'il n'est pas défini)
+adminToken = os.environ.get("VIZIMPOTS_ADMIN_TOKEN")
+
+
+# Réponses déjà calculées : ETag -> JSON sérialisé (bytes), et leur taille totale
+_responses = OrderedDict()
+_responsesBytes = 0
+_responsesLock = Lock()
+
+
+def clear_responses():
+    # Les réponses de l'ancienne version du jeu de données ne seront plus demandées
+    global _responsesBytes
+    with _responsesLock:
+        _responses.clear()
+        _responsesBytes = 0
+
+
+def remember_response(etag, body):
+    # Conserve une réponse sérialisée, en évinçant les moins récentes au-delà de cacheBytes
+    global _responsesBytes
+    if len(body) > cacheEntryBytes:
+        return
+    with _responsesLock:
+        if etag in _responses:
+            return
+        _responses[etag] = body
+        _responsesBytes += len(body)
+        while _responsesBytes > cacheBytes:
+            _, evicted = _responses.popitem(last=False)
+            _responsesBytes -= len(evicted)
+
+on_reload(clear_responses)
+
+
+class ApiError(Exception):
+    """
+        Erreur renvoyée au client sous forme JSON avec le code HTTP status
+    """
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api.errorhandler(ApiError)
+def handle_api_error(error):
+    return jsonify(error=error.message), error.status
+
+
+@api.errorhandler(DatasetError)
+def handle_dataset_error(error):
+    # Jeu de données pas encore généré (ou en cours de génération) : pas de reconstruction ici
+    response = jsonify(error=str(error))
+    response.headers["Retry-After"] = str(cacheMaxAge // 60)
+    return response, 503
+
+
+def cached_json(compute):
+    """
+        Renvoie la réponse JSON de compute() avec ETag et Cache-Control.
+        L'ETag dépend de la version du jeu de données et de la requête complète,
+        le calcul n'est pas effectué si le client possède déjà la réponse,
+        ni si la même requête a déjà été servie par ce processus (réponses conservées
+        sérialisées, dans la limite de cacheBytes octets).
+    """
+    store = get_store()
+    key = f"{store.version}:{request.path}?{sorted(request.args.items(multi=True))}"
+    etag = hashlib.sha1(key.encode()).hexdigest()[:20]
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        with _responsesLock:
+            body = _responses.get(etag)
+            if body is not None:
+                _responses.move_to_end(etag)
+        if body is None:
+            body = jsonify(compute(store)).get_data()
+            remember_response(etag, body)
+        response = Response(body, mimetype="application/json")
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = cacheMaxAge
+    response.headers["X-Dataset-Version"] = store.version
+    return response
+
+
+def parse_commune(store, insee):
+    ogCity = store.city(insee)
+    if ogCity is None:
+        raise ApiError(f"commune {insee} inconnue", 404)
+    return ogCity
+
+
+def parse_radius():
+    radius = request.args.get("radius", default=10, type=float)
+    if not 0 <= radius <= maxRadius:
+        raise ApiError(f"radius doit être compris entre 0 et {maxRadius} km")
+    return radius
+
+
+def parse_hops():
+    hops = request.args.get("hops", type=int)
+    if hops is not None and not 0 <= hops <= maxHops:
+        raise ApiError(f"hops doit être compris entre 0 et {maxHops}")
+    return hops
+
+
+def select_communes(store, ogCity, radius, hops):
+    # Sélection par rangs de voisinage si demandée, par distance sinon (cf Engine.select)
+    return Engine(store).select(ogCity["insee"], radius, hops)
+
+
+def describe_selection(radius, hops):
+    if hops is None:
+        return {"radius": radius}
+    return {"hops": hops}
+
+
+def parse_tax():
+    tax = request.args.get("tax", default="TH").upper()
+    if tax not in dict_tax:
+        raise ApiError("tax doit valoir " + " ou ".join(dict_tax))
+    return tax
+
+
+def parse_years():
+    year = request.args.get("year", type=int)
+    if year is None:
+        return data_yr
+    if year not in data_yr:
+        raise ApiError("year doit valoir " + ", ".join(str(elt) for elt in data_yr))
+    return [year]
+
+
+def to_json_value(value):
+    # NaN n'est pas du JSON valide
+    if isinstance(value, (float, np.floating)) and np.isnan(value):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def describe_city(ogCity):
+    # Code_DEP vient de la fusion des taux : NaN pour une commune sans taux
+    return {key: to_json_value(ogCity[key]) for key in ("insee", "nom", "Code_DEP")}
+
+
+@api.route("/commune/<insee>/stats", methods=["GET"])
+def commune_stats(insee):
+    """
+        Statistiques du panneau d'information pour une commune et un rayon
+    """
+    radius = parse_radius()
+    hops = parse_hops()
+    tax = parse_tax()
+    years = parse_years()
+
+    def compute(store):
+        ogCity = parse_commune(store, insee)
+        displaySet = select_communes(store, ogCity, radius, hops)
+        stats = Engine(store).describe(displaySet, tax, years)
+
+        return {"commune": describe_city(ogCity),
+                **describe_selection(radius, hops),
+                "tax": tax,
+                "communes": len(displaySet),
+                "stats": {str(year): {name: to_json_value(value) for name, value in column.items()}
+                          for year, (label, column) in zip(years, stats.items())},
+                "version": store.version}
+
+    return cached_json(compute)
+
+
+@api.route("/commune/<insee>/neighbours", methods=["GET"])
+def commune_neighbours(insee):
+    """
+        Liste des communes affichées autour d'une commune, avec leurs taux
+    """
+    radius = parse_radius()
+    hops = parse_hops()
+
+    def compute(store):
+        ogCity = parse_commune(store, insee)
+        displaySet = select_communes(store, ogCity, radius, hops)
+        columns = ["insee", "nom", "Code_DEP"] + [prefix + str(elt) for prefix in dict_tax.values()
+                                                  for elt in data_yr]
+        records = displaySet[columns].to_dict(orient="records")
+
+        return {"commune": describe_city(ogCity),
+                **describe_selection(radius, hops),
+                "communes": [{name: to_json_value(value) for name, value in record.items()}
+                             for record in records],
+                "version": store.version}
+
+    return cached_json(compute)
+
+
+def parse_count():
+    k = request.args.get("k", default=5, type=int)
+    if not 1 <= k <= maxCheaper:
+        raise ApiError(f"k doit être compris entre 1 et {maxCheaper}")
+    return k
+
+
+@api.route("/commune/<insee>/cheaper", methods=["GET"])
+def commune_cheaper(insee):
+    """
+        Communes les plus proches d'une commune dont le taux est plus bas
+        (année la plus récente si year n'est pas précisé)
+    """
+    k = parse_count()
+    tax = parse_tax()
+    year = parse_years()[-1]
+
+    def compute(store):
+        ogCity = parse_commune(store, insee)
+        param = dict_tax[tax] + str(year)
+        cheaper = Engine(store).cheaper(insee, k, tax, year)
+
+        return {"commune": describe_city(ogCity),
+                "tax": tax,
+                "year": year,
+                "taux": to_json_value(ogCity[param]),
+                "communes": [{name: to_json_value(value) for name, value in record.items()}
+                             for record in cheaper.to_dict(orient="records")],
+                "version": store.version}
+
+    return cached_json(compute)
+
+
+def parse_export():
+    fmt = request.args.get("format", default="csv").lower()
+    if fmt not in exportFormats:
+        raise ApiError("format doit valoir " + " ou ".join(exportFormats))
+    if fmt == "parquet" and not parquet_available():
+        raise ApiError("export parquet indisponible (pyarrow n'est pas installé)", 501)
+    geometry = request.args.get("geometry", default="0") not in ("0", "false", "")
+    return fmt, geometry
+
+
+def export_response(store, displaySet, fmt, geometry, name):
+    """
+        Réponse transmise par morceaux au fil de leur production (cf export.py)
+    """
+    mimetype, extension = exportFormats[fmt]
+    response = Response(iter_export(displaySet, fmt, geometry), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f'attachment; filename="{name}.{extension}"'
+    response.headers["X-Dataset-Version"] = store.version
+    return response
+
+
+@api.route("/commune/<insee>/export", methods=["GET"])
+def commune_export(insee):
+    """
+        Export des communes affichées autour d'une commune
+    """
+    radius = parse_radius()
+    hops = parse_hops()
+    fmt, geometry = parse_export()
+
+    store = get_store()
+    ogCity = parse_commune(store, insee)
+    displaySet = select_communes(store, ogCity, radius, hops)
+    name = f"vizimpots_{insee}_" + (f"{radius:g}km" if hops is None else f"{hops}rangs")
+    return export_response(store, displaySet, fmt, geometry, name)
+
+
+@api.route("/export", methods=["GET"])
+def national_export():
+    """
+        Export de toutes les communes
+    """
+    fmt, geometry = parse_export()
+
+    store = get_store()
+    displaySet = DisplaySet(store.dataCities, np.arange(len(store.dataCities)))
+    return export_response(store, displaySet, fmt, geometry, "vizimpots_france")
+
+
+@api.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    """
+        Recharge le jeu de données en arrière-plan (régénéré depuis les fichiers sources)
+        Les requêtes continuent d'être servies par la version courante jusqu'à la substitution.
+    """
+    token = request.headers.get("X-Admin-Token", "")
+    if not adminToken or not hmac.compare_digest(token, adminToken):
+        raise ApiError("accès refusé", 403)
+
+    Thread(target=reload_store, kwargs=dict(force=True), daemon=True).start()
+    return jsonify(status="rechargement lancé", version=get_store().version), 202
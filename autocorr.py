@@ -0,0 +1,201 @@
+#%%
+"""
+    Autocorrélation spatiale des taux : repère les groupes de communes aux taux élevés
+    (ou faibles), et pas seulement les communes prises une à une.
+        - I de Moran global : tendance des communes voisines à avoir des taux proches
+        - LISA (I de Moran local) : clusters Haut-Haut, Bas-Bas et communes atypiques
+        - Gi* de Getis-Ord : points chauds et points froids (z-score)
+
+    Les poids sont ceux de la contiguïté (communes ayant une frontière commune, cf
+    adjacency.py), normalisés par ligne pour les indices de Moran. Les communes sans
+    valeur sont retirées du graphe. Tous les calculs sont des opérations vectorisées
+    sur les tableaux du graphe (pas de boucle sur les communes).
+"""
+import numpy as np
+
+# z-score au-delà duquel un indice local est significatif (bilatéral, 5 %)
+zCritical = 1.96
+# clusters LISA (code -> libellé)
+clusterLabels = ["Non significatif", "Haut-Haut", "Bas-Bas", "Bas-Haut", "Haut-Bas"]
+
+
+def hotspot_params(param):
+    """
+        Noms des colonnes d'autocorrélation d'un paramètre (ex : TauxTH_2018_giZ)
+    """
+    return {"giZ": f"{param}_giZ", "lisaZ": f"{param}_lisaZ", "lisaCl": f"{param}_lisaCl"}
+
+
+def base_param(param):
+    """
+        Paramètre dont dérive une colonne d'autocorrélation (TauxTH_2018_giZ -> TauxTH_2018)
+    """
+    for suffix in ("_giZ", "_lisaZ", "_lisaCl"):
+        if param.endswith(suffix):
+            return param[:-len(suffix)]
+    return param
+
+
+class Weights:
+    """
+        Graphe de contiguïté restreint à un ensemble de communes, sous forme de liste d'arêtes
+        (rows[k], cols[k]) triée par ligne, en numérotation locale
+    """
+
+    def __init__(self, n, rows, cols):
+        self.n = n
+        self.rows = rows
+        self.cols = cols
+        self.degree = np.bincount(rows, minlength=n)
+
+    @classmethod
+    def from_adjacency(cls, adjacency, positions):
+        """
+            Sous-graphe des communes en positions (les voisins hors de l'ensemble sont ignorés)
+        """
+        local = np.full(len(adjacency), -1, dtype=np.int64)
+        local[positions] = np.arange(len(positions))
+
+        # Listes de voisins de toutes les communes retenues, lues d'un coup
+        starts = adjacency.indptr[positions]
+        lengths = adjacency.indptr[positions + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        index = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        rows = np.repeat(np.arange(len(positions)), lengths)
+        cols = local[adjacency.indices[index]]
+        inSet = cols >= 0
+        return cls(len(positions), rows[inSet], cols[inSet])
+
+    def lag_sum(self, values):
+        """
+            Somme des valeurs des voisins de chaque commune
+        """
+        return np.bincount(self.rows, weights=values[self.cols], minlength=self.n)
+
+
+def moran(values, weights):
+    """
+        I de Moran global (poids normalisés par ligne) et son z-score (hypothèse de normalité)
+    """
+    n = weights.n
+    z = values - values.mean()
+    connected = weights.degree > 0
+    if n < 3 or not connected.any() or not (z ** 2).sum() > 0:
+        return np.nan, np.nan
+
+    invDegree = np.where(connected, 1 / np.maximum(weights.degree, 1), 0)
+    lag = weights.lag_sum(z) * invDegree
+    s0 = connected.sum()
+    moranI = n / s0 * (z * lag).sum() / (z ** 2).sum()
+
+    # Moments sous l'hypothèse de normalité (w_ij = 1 / degré de i, graphe symétrique)
+    s1 = 0.5 * ((invDegree[weights.rows] + invDegree[weights.cols]) ** 2).sum()
+    colSums = np.bincount(weights.cols, weights=invDegree[weights.rows], minlength=n)
+    s2 = ((connected + colSums) ** 2).sum()
+    expected = -1 / (n - 1)
+    variance = (n ** 2 * s1 - n * s2 + 3 * s0 ** 2) / ((n ** 2 - 1) * s0 ** 2) - expected ** 2
+    return moranI, (moranI - expected) / np.sqrt(variance) if variance > 0 else np.nan
+
+
+def local_stats(values, weights):
+    """
+        Indices locaux de chaque commune
+        Sorties :
+            - lisaZ : z-score du I de Moran local (hypothèse de randomisation)
+            - lisaCl : code du cluster LISA (cf clusterLabels), 0 si non significatif
+            - giZ : Gi* de Getis-Ord (z-score ; la commune fait partie de son voisinage)
+    """
+    n = weights.n
+    degree = weights.degree
+    connected = degree > 0
+    invDegree = np.where(connected, 1 / np.maximum(degree, 1), 0)
+
+    mean = values.mean()
+    z = values - mean
+    m2 = (z ** 2).mean()
+    lag = weights.lag_sum(z) * invDegree
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # I de Moran local et ses moments (Anselin, 1995), poids normalisés par ligne
+        b2 = (z ** 4).mean() / m2 ** 2
+        localI = z / m2 * lag
+        wi = connected.astype(np.float64)
+        wi2 = invDegree
+        expected = -wi / (n - 1)
+        variance = (wi2 * (n - b2) / (n - 1) + (wi ** 2 - wi2) * (2 * b2 - n) / ((n - 1) * (n - 2))
+                    - wi ** 2 / (n - 1) ** 2)
+        lisaZ = np.where(connected & (variance > 0), (localI - expected) / np.sqrt(variance), np.nan)
+
+        # Gi* : somme des valeurs du voisinage (commune comprise), poids binaires
+        neighbourhood = degree + 1
+        std = np.sqrt((values ** 2).mean() - mean ** 2)
+        giZ = ((weights.lag_sum(values) + values - mean * neighbourhood)
+               / (std * np.sqrt((n * neighbourhood - neighbourhood ** 2) / (n - 1))))
+    giZ[~connected] = np.nan
+
+    # Quadrant du diagramme de Moran, pour les communes significatives
+    lisaCl = np.select([(z > 0) & (lag > 0), (z < 0) & (lag < 0), (z < 0) & (lag > 0), (z > 0) & (lag < 0)],
+                       [1, 2, 3, 4], default=0)
+    lisaCl[~(np.abs(lisaZ) > zCritical)] = 0
+
+    return lisaZ, lisaCl, giZ
+
+
+def autocorrelation(values, adjacency, positions=None):
+    """
+        Autocorrélation spatiale d'un paramètre sur un ensemble de communes
+        Entrées :
+            - values : valeurs du paramètre pour les communes de positions (NaN : sans valeur)
+            - adjacency : graphe d'adjacence de toutes les communes
+            - positions : positions des communes dans le jeu de données (None : toutes)
+        Sorties :
+            - dictionnaire (moranI, moranZ, n, lisaZ, lisaCl, giZ), les indices locaux étant
+              alignés sur values (NaN, ou cluster 0, pour les communes sans valeur)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if positions is None:
+        positions = np.arange(len(adjacency))
+    valid = ~np.isnan(values)
+    weights = Weights.from_adjacency(adjacency, positions[valid])
+
+    result = dict(lisaZ=np.full(len(values), np.nan),
+                  lisaCl=np.zeros(len(values), dtype=np.int64),
+                  giZ=np.full(len(values), np.nan),
+                  n=int(valid.sum()))
+    result["moranI"], result["moranZ"] = moran(values[valid], weights)
+    if weights.n >= 3:
+        result["lisaZ"][valid], result["lisaCl"][valid], result["giZ"][valid] = local_stats(values[valid], weights)
+    return result
+
+
+def add_hotspots(dataCities, adjacency, params):
+    """
+        Ajoute au jeu de données les indices locaux nationaux de chaque paramètre
+        (colonnes de hotspot_params), calculés une fois au chargement
+        Entrées :
+            - dataCities : geoDataFrame de toutes les communes (modifié en place)
+            - adjacency : graphe d'adjacence des communes
+            - params : paramètres analysés
+        Sorties :
+            - dictionnaire paramètre -> (I de Moran national, z-score)
+    """
+    moranNat = {}
+    for param in params:
+        result = autocorrelation(dataCities[param].to_numpy(dtype=np.float64), adjacency)
+        for key, column in hotspot_params(param).items():
+            dataCities[column] = result[key]
+        moranNat[param] = (result["moranI"], result["moranZ"])
+    return moranNat
+
+
+def display_moran(displaySet, param, adjacency):
+    """
+        I de Moran de la zone affichée (calculé à la demande, une fois par jeu affiché)
+        Sorties :
+            - (I, z-score, nombre de communes)
+    """
+    key = ("moran", param)
+    if key not in displaySet.cache:
+        result = autocorrelation(displaySet.values(param), adjacency, displaySet.positions)
+        displaySet.cache[key] = (result["moranI"], result["moranZ"], result["n"])
+    return displaySet.cache[key]
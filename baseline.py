@@ -0,0 +1,105 @@
+#%%
+"""
+    Répartitions de référence des paramètres affichés, nationale et départementales,
+    pour les comparer à celle des communes affichées dans l'histogramme.
+
+    Elles sont calculées une fois au chargement du jeu de données, sous forme d'effectifs
+    cumulés sur une grille fine de baselineBins intervalles égaux. L'effectif de
+    n'importe quel intervalle [a, b] s'en déduit par interpolation linéaire des effectifs
+    cumulés en a et en b : l'histogramme local est comparé à la France et au département
+    sur ses propres regroupements, sans relire le jeu de données.
+"""
+import numpy as np
+import pandas as pd
+
+# Nombre d'intervalles de la grille fine
+baselineBins = 1000
+# Quantiles conservés pour chaque répartition
+baselineQuantiles = [0.1, 0.25, 0.5, 0.75, 0.9]
+
+
+class Baseline:
+    """
+        Répartition nationale et départementales d'un paramètre
+            - edges : limites de la grille fine (baselineBins + 1)
+            - national : effectifs cumulés nationaux aux limites de la grille
+            - departments : effectifs cumulés de chaque département (ligne depIndex[code])
+            - quantiles : quantiles nationaux (baselineQuantiles)
+            - depQuantiles : quantiles de chaque département (même ordre de lignes)
+    """
+
+    def __init__(self, values, depCodes, depIndex, bins=baselineBins):
+        valid = ~np.isnan(values)
+        values, depRows = values[valid], depCodes[valid]
+        vmin, vmax = (values.min(), values.max()) if len(values) else (0, 1)
+        if vmin == vmax:
+            vmin, vmax = vmin - 0.5, vmax + 0.5
+        self.edges = np.linspace(vmin, vmax, bins + 1)
+
+        # Effectifs par (département, intervalle) en un seul comptage
+        binIndex = np.clip(np.searchsorted(self.edges, values, side="right") - 1, 0, bins - 1)
+        counts = np.bincount(depRows * bins + binIndex, minlength=len(depIndex) * bins)
+        counts = counts.reshape(len(depIndex), bins)
+        self.departments = np.zeros((len(depIndex), bins + 1), dtype=np.int32)
+        self.departments[:, 1:] = np.cumsum(counts, axis=1)
+        self.national = self.departments.sum(axis=0)
+
+        self.quantiles = np.full(len(baselineQuantiles), np.nan)
+        if len(values):
+            self.quantiles = np.quantile(values, baselineQuantiles)
+        depQuantiles = pd.Series(values).groupby(depRows).quantile(baselineQuantiles).unstack()
+        self.depQuantiles = depQuantiles.reindex(range(len(depIndex))).to_numpy()
+
+    def rebin(self, cumulative, edges):
+        """
+            Effectifs dans les intervalles de limites edges, par interpolation des
+            effectifs cumulés (les valeurs hors de [edges[0], edges[-1]] ne sont pas comptées)
+        """
+        return np.diff(np.interp(edges, self.edges, cumulative))
+
+
+class Baselines:
+    """
+        Répartitions de référence de plusieurs paramètres (cf Baseline)
+        Entrées :
+            - dataCities : geoDataFrame de toutes les communes
+            - params : paramètres à décrire
+    """
+
+    def __init__(self, dataCities, params):
+        codes, depCodes = np.unique(dataCities["Code_DEP"].astype(str).to_numpy(), return_inverse=True)
+        self.depIndex = {code: row for row, code in enumerate(codes)}
+        self.baselines = {param: Baseline(dataCities[param].to_numpy(dtype=np.float64), depCodes, self.depIndex)
+                          for param in params}
+
+    @property
+    def nbytes(self):
+        return sum(elt.departments.nbytes + elt.national.nbytes for elt in self.baselines.values())
+
+    def overlay(self, param, dep, edges):
+        """
+            Répartitions nationale et départementale du paramètre sur les regroupements
+            de l'histogramme local
+            Entrées :
+                - param : paramètre affiché
+                - dep : code du département de la commune sélectionnée
+                - edges : limites des regroupements de l'histogramme
+            Sorties :
+                - dictionnaire (national, department : % des communes de France et du
+                  département dans chaque regroupement ; natMedian, depMedian), ou None
+                  si le paramètre n'a pas de répartition de référence
+        """
+        baseline = self.baselines.get(param)
+        if baseline is None:
+            return None
+        row = self.depIndex.get(str(dep))
+        median = baselineQuantiles.index(0.5)
+
+        result = dict(national=100 * baseline.rebin(baseline.national, edges) / max(baseline.national[-1], 1),
+                      natMedian=baseline.quantiles[median],
+                      department=None, depMedian=np.nan)
+        if row is not None:
+            cumulative = baseline.departments[row]
+            result["department"] = 100 * baseline.rebin(cumulative, edges) / max(cumulative[-1], 1)
+            result["depMedian"] = baseline.depQuantiles[row, median]
+        return result
@@ -0,0 +1,194 @@
+#%%
+"""
+    Export en lot (sans serveur) des cartes, histogrammes et statistiques.
+
+    Exemple :
+        python batch.py --insee 75056 69123 13055 --radius 10 20 50 --formats html csv
+        python batch.py --insee-file prefectures.txt --radius 10 20 --workers 8
+
+    Chaque couple (commune, rayon) produit, dans le dossier de sortie :
+        - <insee>_<rayon>km_<param>.html : carte + histogramme
+        - <insee>_<rayon>km_<param>.png  : idem en image (nécessite selenium)
+        - <insee>_<rayon>km_<impot>.csv  : statistiques des années disponibles
+    Les travaux terminés sont consignés dans batch_done.txt, avec l'impôt, l'année et les
+    formats demandés : relancer la même commande reprend là où l'export s'est arrêté,
+    une commande portant sur un autre impôt, une autre année ou d'autres formats
+    exporte tout.
+"""
+import argparse
+import os
+import sys
+import time
+import multiprocessing as mp
+
+from bokeh.layouts import column, row
+from bokeh.io import save
+from bokeh.palettes import brewer, Colorblind
+from bokeh.resources import CDN
+
+from dataset import get_store, create_displayParam, compute_stats, data_yr, dict_imp, dict_tax
+from figures import create_choropleth, createHisto, create_info
+
+# Fichier de suivi des travaux terminés (reprise)
+doneFile = "batch_done.txt"
+
+# Jeu de données (et index) partagé par les workers du pool.
+# Chargé une seule fois dans le processus parent : avec la méthode "fork"
+# les workers en héritent sans le recharger (copie à l'écriture).
+store = None
+
+
+def init_worker():
+    """
+        Initialisation d'un worker : ne recharge le jeu de données que s'il
+        n'a pas été hérité du processus parent (méthode "spawn").
+    """
+    global store
+    if store is None:
+        store = get_store()
+
+
+def job_key(insee, radius, impot, year, formats):
+    # Clé du travail dans le suivi des travaux terminés
+    return f"{insee}_{radius}km_{impot}{year}_{'+'.join(sorted(formats))}"
+
+
+def export_job(job):
+    """
+        Exporte les sorties demandées pour une commune et un rayon
+        Entrées :
+            - job : tuple (insee, rayon, impot, année, palette, formats, dossier de sortie)
+        Sorties :
+            - tuple (clé du travail, message d'erreur ou None)
+    """
+    insee, radius, impot, year, palette, formats, outDir = job
+    key = job_key(insee, radius, impot, year, formats)
+    try:
+        ogCity = store.city(insee)
+        if ogCity is None:
+            return key, "commune inconnue"
+
+        displaySet = store.select(ogCity, radius)
+        displayParam = create_displayParam(impot, year)
+        infoParam = [impot + str(elt) for elt in data_yr]
+        impotLabel = [label for label, prefix in dict_imp.items() if prefix == impot][0]
+        prefix = os.path.join(outDir, f"{insee}_{radius}km")
+
+        if "html" in formats or "png" in formats:
+            choroPlot = create_choropleth(displaySet, displayParam, palette, ogCity,
+                                          'Taux ' + impotLabel + " " + str(year),
+                                          topology=store.topology)
+            histoPlot = createHisto(displaySet, displayParam, palette, ogCity,
+                                    'Répartition du taux de ' + impotLabel + " " + str(year),
+                                    baseline=store.baselines)
+            infoTitle, infoDisplaySet = create_info(displaySet, infoParam, ogCity, impotLabel,
+                                                    displayParam=displayParam, adjacency=store.adjacency,
+                                                    cheaper=store.cheaper(ogCity, displayParam))
+            exportLayout = row(choroPlot, column(histoPlot, infoTitle, infoDisplaySet))
+
+            if "html" in formats:
+                save(exportLayout, filename=f"{prefix}_{displayParam}.html",
+                     resources=CDN, title=f"VizImpôts - {ogCity['nom']}")
+            if "png" in formats:
+                from bokeh.io import export_png
+                export_png(exportLayout, filename=f"{prefix}_{displayParam}.png")
+
+        if "csv" in formats:
+            stats = compute_stats(displaySet, infoParam)
+            stats.loc["communes"] = len(displaySet)
+            stats.to_csv(f"{prefix}_{impot.rstrip('_')}.csv")
+
+    except Exception as e:
+        return key, repr(e)
+
+    return key, None
+
+
+def read_done(outDir):
+    """
+        Retourne l'ensemble des travaux déjà terminés dans le dossier de sortie
+    """
+    try:
+        with open(os.path.join(outDir, doneFile)) as f:
+            return set(line.strip() for line in f if line.strip())
+    except FileNotFoundError:
+        return set()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Export en lot des cartes et statistiques VizImpôts")
+    parser.add_argument("--insee", nargs="*", default=[], help="codes insee des communes")
+    parser.add_argument("--insee-file", help="fichier texte contenant un code insee par ligne")
+    parser.add_argument("--radius", nargs="+", type=int, default=[10], help="rayons d'affichage (km)")
+    parser.add_argument("--impot", choices=list(dict_tax), default="TH", help="impôt à afficher")
+    parser.add_argument("--year", type=int, choices=data_yr, default=data_yr[-1], help="année affichée")
+    parser.add_argument("--formats", nargs="+", choices=["html", "png", "csv"], default=["html", "csv"])
+    parser.add_argument("--out", default="export", help="dossier de sortie")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="nombre de processus")
+    parser.add_argument("--dalto", action="store_true", help="palette pour daltoniens")
+    parser.add_argument("--restart", action="store_true", help="ignore les travaux déjà terminés")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    global store
+
+    args = parse_args(argv)
+
+    inseeList = list(args.insee)
+    if args.insee_file:
+        with open(args.insee_file) as f:
+            inseeList += [line.strip() for line in f if line.strip()]
+    if not inseeList:
+        sys.exit("Aucune commune à exporter (--insee ou --insee-file)")
+
+    if "png" in args.formats:
+        try:
+            import selenium
+        except ImportError:
+            sys.exit("L'export png nécessite selenium et un webdriver (geckodriver ou chromedriver)")
+
+    os.makedirs(args.out, exist_ok=True)
+    if args.restart and os.path.exists(os.path.join(args.out, doneFile)):
+        os.remove(os.path.join(args.out, doneFile))
+    done = read_done(args.out)
+
+    impot = dict_tax[args.impot]
+    palette = Colorblind[7] if args.dalto else brewer['RdYlGn'][7]
+    jobs = [(insee, radius, impot, args.year, palette, args.formats, args.out)
+            for insee in dict.fromkeys(inseeList)
+            for radius in args.radius]
+    total = len(jobs)
+    jobs = [job for job in jobs if job_key(*job[:4], args.formats) not in done]
+    skipped = total - len(jobs)
+    print(f"{len(jobs)} exports à réaliser ({skipped} déjà terminés)")
+    if not jobs:
+        return
+
+    # Chargement unique du jeu de données, partagé par les workers
+    store = get_store()
+
+    start = time.time()
+    nDone, nFail = skipped, 0
+    with mp.Pool(processes=args.workers, initializer=init_worker) as pool, \
+            open(os.path.join(args.out, doneFile), "a") as ledger:
+        for key, error in pool.imap_unordered(export_job, jobs):
+            if error is None:
+                nDone += 1
+                ledger.write(key + "\n")
+                ledger.flush()
+            else:
+                nFail += 1
+                print(f"  échec {key} : {error}")
+            # Suivi de l'avancement
+            elapsed = time.time() - start
+            processed = nDone + nFail - skipped
+            eta = elapsed / processed * (len(jobs) - processed)
+            print(f"[{nDone + nFail}/{total}] {key} - {elapsed:.0f}s écoulées, reste ~{eta:.0f}s")
+
+    print(f"Terminé : {nDone}/{total} exports, {nFail} échecs")
+
+
+if __name__ == '__main__':
+    main()
+# %%
@@ -0,0 +1,61 @@
+#%%
+"""
+    Centroïdes des communes et leur arbre de recherche (KD-tree), pour les calculs
+    de proximité entre communes (lissage des taux, communes voisines les plus proches).
+
+    Les coordonnées sont celles du jeu de données (EPSG:3857, en m), comme les
+    distances de select_data.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Au-delà de cette part des communes à interroger, les candidates sont parcourues directement
+bruteFraction = 0.125
+
+
+class Centroids:
+    """
+        Centroïdes de toutes les communes (xy[i] : commune en position i) et KD-tree associé
+    """
+
+    def __init__(self, dataCities):
+        points = dataCities.geometry.centroid
+        self.xy = np.column_stack([points.x.to_numpy(), points.y.to_numpy()])
+        self.tree = cKDTree(self.xy)
+
+    def __len__(self):
+        return len(self.xy)
+
+    def nearest_where(self, position, mask, k):
+        """
+            Communes les plus proches d'une commune parmi celles retenues par un masque
+            Les voisines sont lues dans le KD-tree par paquets de taille croissante, jusqu'à
+            en trouver k dans le masque : le premier paquet est dimensionné d'après la part
+            des communes retenues. Quand elles sont trop rares pour que le KD-tree soit utile,
+            leurs distances sont calculées directement.
+            Entrées :
+                - position : position de la commune de départ
+                - mask : booléens (une valeur par commune), communes candidates
+                - k : nombre de communes recherchées
+            Sorties :
+                - positions des communes trouvées (au plus k), par distance croissante
+                - distances entre centroïdes (m)
+        """
+        candidates = int(np.count_nonzero(mask))
+        k = min(k, candidates)
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        # En moyenne k * n / candidates voisines pour en trouver k dans le masque
+        query = max(2 * k, int(np.ceil(2 * k * len(self) / candidates)))
+        while query <= bruteFraction * len(self):
+            dist, found = self.tree.query(self.xy[position], k=query)
+            keep = mask[found]
+            if np.count_nonzero(keep) >= k:
+                return found[keep][:k], dist[keep][:k]
+            query *= 4
+
+        found = np.flatnonzero(mask)
+        dist = np.hypot(*(self.xy[found] - self.xy[position]).T)
+        order = np.argsort(dist, kind="stable")[:k]
+        return found[order], dist[order]
@@ -0,0 +1,184 @@
+#%%
+"""
+    Classification des valeurs affichées en classes de couleur, partagée par la carte
+    et l'histogramme :
+        - intervalles égaux entre le min et le max
+        - quantiles : même nombre de communes par classe
+        - seuils naturels de Jenks : classes les plus homogènes possible
+"""
+import numpy as np
+from bokeh.palettes import brewer
+
+from autocorr import clusterLabels
+
+# modes de classification (libellé affiché -> mode)
+dict_classif = {"Intervalles égaux": "equal",
+                "Quantiles": "quantile",
+                "Seuils naturels (Jenks)": "jenks"
+            }
+# mode par défaut (équivalent à l'ancienne échelle linéaire)
+defaultScheme = "equal"
+# nombre maximal de valeurs traitées par Jenks (au-delà, sur des quantiles de l'échantillon)
+jenksSample = 1000
+# classe des valeurs manquantes dans les classes compactes (cf frame_classes)
+missingClass = 255
+# paramètres à classes fixes, quel que soit le mode de classification
+# (suffixe du paramètre -> limites intérieures, palette, libellés des classes)
+fixedClasses = {"_giZ": ([-2.58, -1.96, -1.65, 1.65, 1.96, 2.58],   # seuils de confiance 99/95/90 %
+                         brewer['RdBu'][7],   # bleu : points froids, rouge : points chauds
+                         None),
+                "_lisaCl": ([0.5, 1.5, 2.5, 3.5],
+                            ['#d9d9d9', '#d7191c', '#2c7bb6', '#abd9e9', '#fdae61'],
+                            clusterLabels)
+            }
+
+
+def fixed_classes(displayParam):
+    """
+        Classes fixes du paramètre (limites intérieures, palette, libellés), ou None
+    """
+    for suffix, classes in fixedClasses.items():
+        if displayParam.endswith(suffix):
+            return classes
+    return None
+
+
+def fixed_breaks(values, inner):
+    """
+        Limites de classes fixes : limites intérieures imposées, limites extérieures
+        à l'étendue des valeurs (ou aux première et dernière limites intérieures)
+    """
+    # Flottants : les classes LISA sont entières (3.5 tronqué à 3 sinon)
+    values = np.asarray(values, dtype=np.float64)
+    vmin, vmax = inner[0], inner[-1]
+    if not np.isnan(values).all():
+        vmin, vmax = min(np.nanmin(values), vmin), max(np.nanmax(values), vmax)
+    return np.array([vmin] + inner + [vmax], dtype=np.float64)
+
+
+def equal_breaks(values, nClasses):
+    vmin, vmax = values.min(), values.max()
+    if vmin == vmax:
+        # même convention que np.histogram
+        vmin, vmax = vmin - 0.5, vmax + 0.5
+    return np.linspace(vmin, vmax, nClasses + 1)
+
+
+def quantile_breaks(values, nClasses):
+    return np.quantile(values, np.linspace(0, 1, nClasses + 1))
+
+
+def jenks_breaks(values, nClasses, sample=jenksSample):
+    """
+        Seuils naturels de Jenks (Fisher) : découpage des valeurs triées qui minimise la
+        somme des carrés des écarts à la moyenne de chaque classe, par programmation dynamique.
+        Au-delà de sample valeurs, le calcul porte sur sample quantiles régulièrement espacés,
+        qui conservent la répartition des valeurs (coût en sample² par classe).
+    """
+    values = np.sort(values)
+    vmin, vmax = values[0], values[-1]
+    if len(values) > sample:
+        values = np.quantile(values, np.linspace(0, 1, sample))
+    m = len(values)
+
+    # ssd[j, i] : somme des carrés des écarts de values[j..i], par sommes cumulées
+    s1 = np.concatenate([[0], np.cumsum(values)])
+    s2 = np.concatenate([[0], np.cumsum(values ** 2)])
+    j = np.arange(m)[:, np.newaxis]
+    i = np.arange(m)[np.newaxis, :]
+    count = i - j + 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ssd = s2[i + 1] - s2[j] - (s1[i + 1] - s1[j]) ** 2 / count
+    ssd[count <= 0] = np.inf
+
+    # cost[i] : meilleur découpage de values[0..i] en c classes ;
+    # starts[c][i] : début de la dernière de ces classes
+    cost = ssd[0]
+    starts = []
+    for _ in range(1, min(nClasses, m)):
+        total = cost[:-1, np.newaxis] + ssd[1:, :]
+        best = np.argmin(total, axis=0)
+        cost = total[best, np.arange(m)]
+        starts.append(best + 1)
+
+    # Remontée du découpage optimal depuis la dernière valeur
+    bounds, end = [], m - 1
+    for start in reversed(starts):
+        bounds.append(start[end])
+        end = start[end] - 1
+    inner = [values[elt] for elt in reversed(bounds)]
+    inner += [vmax] * (nClasses - 1 - len(inner))
+    return np.array([vmin] + inner + [vmax])
+
+
+def compute_breaks(values, nClasses, scheme=defaultScheme):
+    """
+        Limites des classes de couleur
+        Entrées :
+            - values : valeurs à classer (les NaN sont ignorés)
+            - nClasses : nombre de classes (nombre de couleurs de la palette)
+            - scheme : mode de classification (valeur de dict_classif)
+        Sorties :
+            - tableau croissant de nClasses + 1 limites
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.linspace(0, 1, nClasses + 1)
+    if scheme == "quantile":
+        return quantile_breaks(values, nClasses)
+    if scheme == "jenks":
+        return jenks_breaks(values, nClasses)
+    return equal_breaks(values, nClasses)
+
+
+def class_index(values, breaks):
+    """
+        Classe de chaque valeur, centrée sur l'entier (0.5 pour la première classe) pour
+        un LinearColorMapper entre 0 et le nombre de classes ; NaN pour une valeur manquante
+    """
+    values = np.asarray(values, dtype=np.float64)
+    index = np.searchsorted(breaks[1:-1], values, side="right") + 0.5
+    index[np.isnan(values)] = np.nan
+    return index
+
+
+def display_breaks(displaySet, displayParam, nClasses, scheme=defaultScheme):
+    """
+        Limites des classes pour le paramètre affiché, calculées une fois par jeu affiché
+        (la carte et l'histogramme utilisent les mêmes)
+    """
+    key = ("breaks", displayParam, nClasses, scheme)
+    breaks = displaySet.cache.get(key)
+    if breaks is None:
+        fixed = fixed_classes(displayParam)
+        if fixed is None:
+            breaks = compute_breaks(displaySet.values(displayParam), nClasses, scheme)
+        else:
+            breaks = fixed_breaks(displaySet.values(displayParam), fixed[0])
+        displaySet.cache[key] = breaks
+    return breaks
+
+
+def frame_classes(displaySet, params, nClasses, scheme=defaultScheme):
+    """
+        Classes de couleur de plusieurs paramètres à la fois (ex : une année par image
+        d'une animation), sur des limites communes pour que les couleurs restent comparables
+        Entrées :
+            - displaySet : DisplaySet des communes affichées
+            - params : paramètres classés (mêmes classes fixes éventuelles)
+            - nClasses : nombre de classes
+            - scheme : mode de classification (valeur de dict_classif)
+        Sorties :
+            - limites communes des classes
+            - tableau uint8 (len(params), communes) des classes, missingClass si sans valeur
+    """
+    values = np.array([displaySet.values(param) for param in params], dtype=np.float64)
+    fixed = fixed_classes(params[0])
+    if fixed is None:
+        breaks = compute_breaks(values.ravel(), nClasses, scheme)
+    else:
+        breaks = fixed_breaks(values, fixed[0])
+    classes = np.searchsorted(breaks[1:-1], values, side="right").astype(np.uint8)
+    classes[np.isnan(values)] = missingClass
+    return breaks, classes
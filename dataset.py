@@ -0,0 +1,887 @@
+#%%
+import os
+import time
+from threading import Lock, Thread
+
+import geopandas as gpd
+import pandas as pd
+import numpy as np
+from shapely import vectorized
+from shapely.prepared import prep
+
+from search import SearchIndex
+from topology import load_topology, topology_file
+from adjacency import load_adjacency, adjacency_file
+from centroids import Centroids
+from baseline import Baselines
+from autocorr import add_hotspots, hotspot_params
+from manifest import (BuildLock, create_manifest, read_manifest, manifest_matches, manifest_path,
+                      manifest_version, sources_changed, write_json_atomic)
+
+# Fichier contenant le tracé des communes (format geojson)
+city_shapefile = "DATA/communes-20190101.json"
+# Fichiers de données
+taxe_hab = "DATA/taux_taxe_habitation.xlsx"
+taxe_fon = "DATA/taux_taxe_fonciere.xlsx"
+# Jeu de données assemblé (cache)
+dataset_file = "DATA/dataCities.json"
+# Fichiers à partir desquels le jeu de données est assemblé
+source_files = [city_shapefile, taxe_hab, taxe_fon]
+# Intervalle de surveillance des fichiers pour le rechargement à chaud (s)
+watchInterval = 30
+# Part maximale des communes sans taux après l'assemblage (codes insee non appariés)
+maxUnmatched = 0.05
+
+# années pour lesquelles on dispose des données
+data_yr = [2016, 2017, 2018]
+# impôts disponibles (libellé affiché -> préfixe des colonnes)
+dict_imp = {"Taxe d'habitation" : "TauxTH_",
+            "Taxe foncière" : "TauxTF_"
+        }
+# codes courts des impôts (API, scripts) -> préfixe des colonnes
+dict_tax = {"TH" : "TauxTH_",
+            "TF" : "TauxTF_"
+        }
+# mesures disponibles (libellé affiché -> type de paramètre)
+dict_mesure = {"Taux" : "taux",
+               "Évolution annuelle (points)" : "evol",
+               f"Évolution {data_yr[0]}-{data_yr[-1]} (points)" : "evolTotal",
+               f"Évolution {data_yr[0]}-{data_yr[-1]} (%)" : "evolPct",
+               "Points chauds (Gi*)" : "hotspot",
+               "Clusters (LISA)" : "lisa",
+               "Montant estimé (€)" : "montant"
+            }
+
+
+def createDataSet():
+    '''
+        Charge les données d'entrées dans un dataFrame geopandas
+        Données d'entrées :
+            - shapefile contenant le traçé des communes au format geojson
+            - fichier texte contenant les données aui nous interesse au format csv
+        Tâches réalisées :
+            - chargement des fichiers
+            - reprojection de wgs84 vers webmercator
+            - tri des données inutiles
+            - calcul de données à partir des données existantes
+            - assemblage des données dans un geodataframe
+            - tri des NaN/inf
+        Sortie :
+            - un geoDataFrame
+            - part des communes sans ligne dans chaque fichier de taux (code insee absent)
+    '''
+
+    ########## Gestion de la géométrie des communes ############
+
+    # import de la geometrie des communes
+    df_shape = gpd.read_file(city_shapefile)
+    # Suppression des colonnes  "wiki" et "surface", inutiles
+    df_shape.drop(columns=["wikipedia", "surf_ha"],inplace=True)
+
+    # reprojection en webmercator
+    df_shape["geometry"] = df_shape["geometry"].to_crs("EPSG:3857")
+    df_shape.crs = "EPSG:3857"
+
+
+    ########## Gestion des stats sur les communes ############
+
+    # Taxe habitation
+    # Import des taux d'imposition par commune dans la dataframe
+    dfTH = pd.read_excel(taxe_hab,sheet_name="COM",header=2,usecols="A:B,E:G", converters={'Code commune':str,'Code DEP':str})
+
+    # Mise en forme des libelles des colonnes
+    dfTH.columns = dfTH.columns.str.replace(' ','_')
+    dfTH.columns = dfTH.columns.str.replace('Taux_communal_TH*','TauxTH').str.replace('Taux_communal_voté_TH*','TauxTH')
+
+    # On crée le code INSEE en concatenant le code departement et commune
+    # Le code Insee sera la clé commune entre les dataframe de géométrie et de data.
+    # Création du code Insee dans une nouvelle colonne de la df
+    dfTH["insee"] = dfTH["Code_DEP"] + dfTH["Code_commune"]
+    # Suppression de la colonne code commune qui ne sert plus à rien
+    dfTH.drop(columns=["Code_commune"], inplace=True)
+
+    # On converti les valeurs non numériques de la colonnes TauxTH en NaN pour les filtrer
+    dfTH["TauxTH_2018"] = pd.to_numeric(dfTH["TauxTH_2018"], errors='coerce')
+    dfTH["TauxTH_2017"] = pd.to_numeric(dfTH["TauxTH_2017"], errors='coerce')
+
+    # Taxe foncière
+    dfTF = pd.read_excel(taxe_fon,sheet_name="COM",header=2,usecols="A:B,D:F", converters={'Code commune':str,'Code DEP':str})
+    dfTF.columns = dfTF.columns.str.replace(' ','_')
+    dfTF.columns = dfTF.columns.str.replace('Taux_communal_TFB*','TauxTF').str.replace('Taux_communal_voté_TFB*','TauxTF')
+    dfTF["insee"] = dfTF["Code_DEP"] + dfTF["Code_commune"]
+
+    dfTF.drop(columns=["Code_commune"], inplace=True)
+    dfTF.drop(columns=["Code_DEP"], inplace=True)
+
+    # On converti les valeurs non numériques de la colonnes TauxTH en NaN pour les filtrer
+    dfTF["TauxTF_2018"] = pd.to_numeric(dfTF["TauxTF_2018"], errors='coerce')
+    dfTF["TauxTF_2017"] = pd.to_numeric(dfTF["TauxTF_2017"], errors='coerce')
+
+    # Part des communes dont le code insee n'apparaît pas dans les fichiers de taux
+    unmatched = {"TH": float((~df_shape["insee"].isin(dfTH["insee"])).mean()),
+                 "TF": float((~df_shape["insee"].isin(dfTF["insee"])).mean())}
+
+    # Assemblage de la géométrie et des taux d'imposition.
+    dataCities = pd.merge(df_shape,dfTH, left_on="insee",right_on="insee", how = 'left')
+    dataCities = pd.merge(dataCities,dfTF, left_on="insee",right_on="insee", how = 'left')
+
+    # Calcul des évolutions des taux
+    add_trends(dataCities)
+    # Calcul des rangs nationaux et départementaux
+    add_ranks(dataCities)
+
+    return dataCities, unmatched
+
+
+def add_trends(dataCities):
+    """
+        Ajoute au jeu de données les colonnes d'évolution des taux, pour chaque impôt :
+            - <impot>evol_<année> : évolution par rapport à l'année précédente (points)
+            - <impot>evol_<début>_<fin> : évolution sur toute la période (points)
+            - <impot>evolpct_<début>_<fin> : évolution sur toute la période (%)
+        Le calcul est vectorisé sur l'ensemble des communes, une seule fois au chargement.
+        Entrées :
+            - dataCities : geoDataFrame contenant les taux (modifié en place)
+    """
+    first, last = data_yr[0], data_yr[-1]
+    for impot in dict_imp.values():
+        for prev, year in zip(data_yr[:-1], data_yr[1:]):
+            dataCities[f"{impot}evol_{year}"] = dataCities[impot + str(year)] - dataCities[impot + str(prev)]
+
+        dataCities[f"{impot}evol_{first}_{last}"] = dataCities[impot + str(last)] - dataCities[impot + str(first)]
+        # Evolution relative : un taux initial nul donne une évolution indéfinie
+        evolPct = 100 * dataCities[f"{impot}evol_{first}_{last}"] / dataCities[impot + str(first)]
+        dataCities[f"{impot}evolpct_{first}_{last}"] = evolPct.replace([np.inf, -np.inf], np.nan)
+
+
+def baseline_params():
+    """
+        Paramètres affichables dont la répartition sert de référence à l'histogramme
+        (taux et évolutions de chaque impôt)
+    """
+    params = [create_displayParam(impot, year, mesure) for impot in dict_imp.values()
+              for mesure in ("taux", "evol", "evolTotal", "evolPct") for year in data_yr]
+    return list(dict.fromkeys(params))
+
+
+def rank_params(displayParam):
+    """
+        Noms des colonnes de rang associées à un taux
+        Sortie :
+            - dictionnaire (rangNat, pctNat, rangDep, pctDep) -> nom de colonne
+    """
+    return {kind: f"{displayParam}_{kind}" for kind in ("rangNat", "pctNat", "rangDep", "pctDep")}
+
+
+def add_ranks(dataCities):
+    """
+        Ajoute au jeu de données, pour chaque impôt et chaque année, le rang de chaque commune
+        (1 = taux le plus bas) et son percentile, au niveau national et dans son département :
+            - <impot><année>_rangNat, <impot><année>_pctNat
+            - <impot><année>_rangDep, <impot><année>_pctDep
+        Les rangs sont calculés une seule fois au chargement : l'affichage n'a plus qu'à les lire.
+        Entrées :
+            - dataCities : geoDataFrame contenant les taux (modifié en place)
+    """
+    byDep = dataCities.groupby("Code_DEP")
+    for impot in dict_imp.values():
+        for year in data_yr:
+            param = impot + str(year)
+            cols = rank_params(param)
+            dataCities[cols["rangNat"]] = dataCities[param].rank(method="min")
+            dataCities[cols["pctNat"]] = 100 * dataCities[param].rank(pct=True)
+            dataCities[cols["rangDep"]] = byDep[param].rank(method="min")
+            dataCities[cols["pctDep"]] = 100 * byDep[param].rank(pct=True)
+
+
+class DatasetError(Exception):
+    """
+        Jeu de données assemblé absent, invalide ou en cours de construction
+    """
+
+
+def dataset_schema():
+    """
+        Colonnes attendues dans le jeu de données assemblé et leur type
+    """
+    schema = {"insee": "str", "nom": "str", "Code_DEP": "str"}
+    schema.update({impot + str(year): "float64" for impot in dict_imp.values() for year in data_yr})
+    return schema
+
+
+def apply_schema(dataCities):
+    """
+        Convertit les colonnes du schéma à leur type (un fichier relu peut les typer autrement)
+    """
+    for column, dtype in dataset_schema().items():
+        if column not in dataCities.columns:
+            continue
+        if dtype == "str":
+            values = dataCities[column]
+            dataCities[column] = values.where(values.isna(), values.astype(str))
+        else:
+            dataCities[column] = pd.to_numeric(dataCities[column], errors="coerce").astype(dtype)
+
+
+def validate_dataset(dataCities, unmatched):
+    """
+        Vérifie le jeu de données assemblé avant de l'enregistrer
+        Entrées :
+            - dataCities : geoDataFrame assemblé (cf createDataSet)
+            - unmatched : part des communes sans taux, par impôt
+        Sortie :
+            - rien (DatasetError décrivant toutes les anomalies)
+    """
+    errors = []
+    schema = dataset_schema()
+    missing = [column for column in schema if column not in dataCities.columns]
+    if missing:
+        errors.append("colonnes absentes : " + ", ".join(missing))
+    if not len(dataCities):
+        errors.append("aucune commune")
+    if "insee" in dataCities.columns and dataCities["insee"].duplicated().any():
+        errors.append(f"{dataCities['insee'].duplicated().sum()} codes insee en double")
+    noShape = (dataCities.geometry.isna() | dataCities.geometry.is_empty).sum()
+    if noShape:
+        errors.append(f"{noShape} communes sans tracé")
+    for column in [column for column, dtype in schema.items() if dtype == "float64" and column in dataCities]:
+        outside = ((dataCities[column] < 0) | (dataCities[column] > 100)).sum()
+        if outside:
+            errors.append(f"{outside} taux hors de [0, 100] dans {column}")
+    for tax, share in unmatched.items():
+        if share > maxUnmatched:
+            errors.append(f"{100 * share:.1f} % des communes sans taux {tax} (maximum {100 * maxUnmatched:.0f} %)")
+    if errors:
+        raise DatasetError("jeu de données invalide : " + " ; ".join(errors))
+
+
+def dataset_outdated(path=dataset_file):
+    """
+        Vrai si le jeu de données assemblé n'existe pas, ne correspond pas à son manifeste
+        ou si un fichier source a été modifié depuis sa génération (temps constant, sauf
+        source de date modifiée dont le contenu est comparé, cf manifest.sources_changed)
+    """
+    manifest = read_manifest(path)
+    return not manifest_matches(path, manifest) or sources_changed(manifest, source_files)
+
+
+def build_dataset(path=dataset_file):
+    """
+        Génère le jeu de données, le vérifie puis l'enregistre avec son manifeste.
+        Le fichier est écrit sous un nom temporaire puis substitué d'un coup, sous un
+        verrou partagé par les processus : un lecteur ne voit jamais de fichier partiel.
+        Un processus qui attendait le verrou reprend le fichier que l'autre vient d'écrire.
+        La topologie et le graphe d'adjacence sont construits dans la foulée : le
+        chargement (cf DataStore) ne fait que les relire.
+        Entrées :
+            - path : fichier assemblé
+        Sortie :
+            - un geoDataFrame, la version du jeu de données (cf manifest_version)
+    """
+    previous = read_manifest(path)
+    with BuildLock(path):
+        # Jeu construit par un autre processus pendant l'attente du verrou
+        manifest = read_manifest(path)
+        if manifest != previous and not dataset_outdated(path):
+            dataCities = read_dataset(path, manifest)
+            build_caches(dataCities, manifest_version(manifest))
+            return dataCities, manifest_version(manifest)
+
+        print("génération du jeu de données en cours")
+        dataCities, unmatched = createDataSet()
+        apply_schema(dataCities)
+        validate_dataset(dataCities, unmatched)
+
+        temp = f"{path}.{os.getpid()}.tmp"
+        dataCities.to_file(temp, driver='GeoJSON')
+        # Manifeste établi sur le fichier complet (os.replace conserve taille et date)
+        manifest = create_manifest(temp, dataCities, source_files, unmatched)
+        os.replace(temp, path)
+        write_json_atomic(manifest_path(path), manifest)
+        print(f"jeu de données enregistré : {manifest['rows']} communes, sans taux : "
+              + ", ".join(f"{tax} {100 * share:.2f} %" for tax, share in unmatched.items()))
+
+        # Caches dérivés construits sur le fichier relu, tel que les processus le chargeront
+        dataCities = read_dataset(path, manifest)
+        build_caches(dataCities, manifest_version(manifest))
+    return dataCities, manifest_version(manifest)
+
+
+def build_caches(dataCities, version):
+    """
+        Construit (si besoin) et sauvegarde la topologie et le graphe d'adjacence d'une
+        version du jeu de données
+    """
+    load_topology(dataCities, version)
+    load_adjacency(dataCities, version)
+
+
+def caches_missing(path=dataset_file):
+    """
+        Vrai si le jeu de données en place est valide mais que sa topologie ou son graphe
+        d'adjacence manque ou est illisible (caches supprimés, endommagés, ou d'une autre version)
+    """
+    manifest = read_manifest(path)
+    if not manifest_matches(path, manifest):
+        return False
+    version = manifest_version(manifest)
+    return (load_topology(None, version, build=False) is None
+            or load_adjacency(None, version, build=False) is None)
+
+
+def repair_caches(path=dataset_file):
+    """
+        Reconstruit les caches dérivés du jeu de données en place, sous le verrou de
+        construction (un seul processus les écrit, les autres les relisent ensuite)
+    """
+    with BuildLock(path):
+        if caches_missing(path):
+            manifest = read_manifest(path)
+            print("caches dérivés du jeu de données absents ou endommagés, reconstruction en cours")
+            build_caches(read_dataset(path, manifest), manifest_version(manifest))
+
+
+def read_dataset(path, manifest):
+    """
+        Lit le fichier assemblé et vérifie qu'il contient les communes et colonnes du manifeste
+    """
+    dataCities = gpd.read_file(path)
+    if len(dataCities) != manifest["rows"]:
+        raise DatasetError(f"{path} : {len(dataCities)} communes lues, {manifest['rows']} attendues")
+    missing = [column for column in dataset_schema() if column not in dataCities.columns]
+    if missing:
+        raise DatasetError(f"{path} : colonnes absentes : " + ", ".join(missing))
+    apply_schema(dataCities)
+    return dataCities
+
+
+def load_dataset(rebuild=False, path=dataset_file):
+    """
+        Charge le jeu de données assemblé depuis le cache DATA/dataCities.json, après
+        vérification de son manifeste (cf manifest.py).
+        Sans rebuild, le jeu n'est jamais généré ici (chargement appelé depuis les sessions
+        et requêtes) et les fichiers sources ne sont pas examinés : un jeu périmé est servi
+        en attendant sa reconstruction en arrière-plan (cf watch_sources) ; sinon DatasetError, sans attendre une construction en cours
+        (le chargement bloquerait la boucle d'événements de toutes les sessions).
+        Entrées :
+            - rebuild : génère le jeu de données (surveillance, administration, python dataset.py)
+            - path : fichier assemblé
+        Sortie :
+            - un geoDataFrame
+            - version du jeu de données (cf manifest_version)
+    """
+    if rebuild:
+        dataCities, version = build_dataset(path)
+    else:
+        manifest = read_manifest(path)
+        if not manifest_matches(path, manifest):
+            if BuildLock(path).held():
+                raise DatasetError(f"{path} en cours de génération, réessayer dans quelques minutes")
+            raise DatasetError(f"{path} absent, incomplet ou sans manifeste : "
+                               "générer le jeu de données avec python dataset.py")
+        dataCities = read_dataset(path, manifest)
+        version = manifest_version(manifest)
+
+    # Fichier généré avant l'ajout des évolutions
+    if f"TauxTH_evol_{data_yr[-1]}" not in dataCities.columns:
+        add_trends(dataCities)
+    if rank_params(f"TauxTH_{data_yr[-1]}")["rangNat"] not in dataCities.columns:
+        add_ranks(dataCities)
+
+    return dataCities, version
+
+
+### Fonctions de traitement ###
+
+class DisplaySet:
+    """
+        Communes affichées : positions des lignes retenues dans le jeu de données partagé.
+        Aucune ligne n'est copiée à la sélection ; seules les colonnes effectivement utilisées
+        (histogramme, statistiques, couleurs, tracé) sont extraites, pour les seules communes
+        retenues. S'utilise comme le dataFrame de la sélection :
+            - displaySet[colonne] : Series des valeurs de la colonne
+            - displaySet[[colonnes]] : dataFrame de ces colonnes
+            - len(displaySet), displaySet.columns, displaySet.geometry, displaySet.total_bounds
+        Des colonnes calculées pour la seule sélection (ex : montants simulés, cf simulator.py)
+        peuvent s'ajouter à celles du jeu de données (cf with_columns).
+    """
+
+    def __init__(self, dataCities, positions, extra=None):
+        self.dataCities = dataCities
+        self.positions = positions
+        # Colonnes calculées : nom -> valeurs alignées sur positions
+        self.extra = extra if extra is not None else {}
+        # Résultats dérivés de la sélection (ex : limites des classes de couleur)
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def columns(self):
+        if not self.extra:
+            return self.dataCities.columns
+        return self.dataCities.columns.append(pd.Index(list(self.extra)))
+
+    @property
+    def empty(self):
+        return len(self.positions) == 0
+
+    def values(self, column):
+        """
+            Valeurs de la colonne pour les communes retenues (tableau numpy)
+        """
+        if column in self.extra:
+            return self.extra[column]
+        return self.dataCities[column].to_numpy()[self.positions]
+
+    def with_columns(self, columns):
+        """
+            Même sélection, avec des colonnes calculées en plus
+            Entrées :
+                - columns : dictionnaire nom -> valeurs alignées sur positions
+        """
+        return DisplaySet(self.dataCities, self.positions, dict(self.extra, **columns))
+
+    def __getitem__(self, columns):
+        if isinstance(columns, str):
+            return pd.Series(self.values(columns), name=columns)
+        return pd.DataFrame({column: self.values(column) for column in columns}, columns=columns)
+
+    @property
+    def geometry(self):
+        return self.dataCities.geometry.iloc[self.positions]
+
+    @property
+    def total_bounds(self):
+        return self.geometry.total_bounds
+
+
+def city_distances(df, geometry, dist):
+    """
+        Communes situées à au plus dist km d'un contour (critère commun à select_data
+        et aux requêtes en lot du moteur, cf engine.py)
+        Entrées :
+            - df : dataframe qui contient toutes les données
+            - geometry : contour de la commune de référence
+            - dist : distance maximale (km)
+        Sorties :
+            - positions des communes retenues dans df (croissantes)
+            - distances de leur contour à geometry (m)
+    """
+    margin = dist * 1000
+    xmin, ymin, xmax, ymax = geometry.bounds
+    # Pré-sélection par l'index spatial (emprises) puis distance exacte au contour
+    candidates = np.sort(np.fromiter(df.sindex.intersection((xmin - margin, ymin - margin,
+                                                             xmax + margin, ymax + margin)),
+                                     dtype=np.int64))
+    distance = df.geometry.iloc[candidates].distance(geometry).to_numpy()
+    inRange = distance <= margin
+    return candidates[inRange], distance[inRange]
+
+
+def select_data(df, ogCity, dist):
+    """
+        Fonction qui permet de sélectionner les données à afficher
+        Sélectionnées en fonction de la distance autour de la ville :
+        On prend toutes les villes dont le contour est à au plus dist
+        du contour de la ville originale
+        Entrées :
+            - df : dataframe qui contient toutes les données
+            - ogCity : extract de la commune sélectionnée
+            - dist : distance à l'origine (km)
+        Sortie :
+            - DisplaySet des communes retenues
+    """
+    positions, _ = city_distances(df, ogCity.geometry, dist)
+    return DisplaySet(df, positions)
+
+
+def select_hops(df, adjacency, position, hops):
+    """
+        Fonction qui permet de sélectionner les données à afficher
+        Sélectionnées en fonction du voisinage de la ville :
+        On prend toutes les villes séparées de la ville originale par au plus hops frontières
+        Entrées :
+            - df : dataframe qui contient toutes les données
+            - adjacency : graphe d'adjacence des communes de df (cf adjacency.py)
+            - position : position de la commune sélectionnée dans df
+            - hops : nombre de rangs de voisinage
+        Sortie :
+            - DisplaySet des communes retenues
+    """
+    return DisplaySet(df, adjacency.k_hop(position, hops))
+
+
+def select_shape(df, centroids, shape):
+    """
+        Fonction qui permet de sélectionner les communes d'une zone quelconque
+        (ex : rectangle ou lasso tracé sur la carte) :
+        On prend toutes les villes dont le centroïde est dans la zone
+        Entrées :
+            - df : dataframe qui contient toutes les données
+            - centroids : centroïdes des communes de df (cf centroids.py)
+            - shape : polygone shapely de la zone (EPSG:3857)
+        Sortie :
+            - DisplaySet des communes retenues
+    """
+    # Pré-sélection par l'index spatial (emprises), puis test vectorisé des centroïdes
+    # (pas d'intersection exacte des contours, trop coûteuse pendant le tracé)
+    candidates = np.sort(np.fromiter(df.sindex.intersection(shape.bounds), dtype=np.int64))
+    xy = centroids.xy[candidates]
+    inZone = vectorized.contains(prep(shape), xy[:, 0], xy[:, 1])
+    return DisplaySet(df, candidates[inZone])
+
+
+def cheaper_nearby(df, centroids, position, param, k=5):
+    """
+        Communes les plus proches d'une commune parmi celles dont le taux est plus bas
+        Entrées :
+            - df : dataframe qui contient toutes les données
+            - centroids : centroïdes des communes de df (cf centroids.py)
+            - position : position de la commune sélectionnée dans df
+            - param : taux comparé (ex : TauxTH_2018)
+            - k : nombre de communes recherchées
+        Sortie :
+            - dataFrame (une ligne par commune, par distance croissante) : insee, nom,
+              Code_DEP, distance entre centroïdes (km), taux, ecart (points, négatif)
+    """
+    values = df[param].to_numpy(dtype=np.float64)
+    # Une commune sans taux n'est comparable à aucune autre (NaN < x est faux)
+    positions, dist = centroids.nearest_where(position, values < values[position], k)
+    result = df[["insee", "nom", "Code_DEP"]].iloc[positions].reset_index(drop=True)
+    result["distance"] = np.round(dist / 1000, 1)
+    result["taux"] = values[positions]
+    result["ecart"] = np.round(values[positions] - values[position], 2)
+    return result
+
+
+def create_displayParam(impot='TauxTH_', year=2018, mesure='taux'):
+    """
+        Fonction qui retourne le paramètre à afficher dans la dataframe, à partir de l'impôt
+        et de l'année désirée.
+        Entrées :
+            - impot : l'impot que l'ont souhaite afficher (str)
+            - année (int) : l'année que l'on souhait afficher (int)
+            - mesure : type de paramètre, valeur de dict_mesure (str)
+                la première année n'a pas d'évolution annuelle, l'année suivante est utilisée
+                les évolutions sur la période ne dépendent pas de l'année
+                points chauds et clusters : indices d'autocorrélation du taux de l'année (cf autocorr.py)
+                montant : montant estimé de l'impôt, calculé pour la session (cf simulator.py)
+        Sortie :
+            - displayParam : le paramètre d'affichge (str)
+        """
+    if mesure == 'evol':
+        return f"{impot}evol_{max(year, data_yr[1])}"
+    if mesure == 'evolTotal':
+        return f"{impot}evol_{data_yr[0]}_{data_yr[-1]}"
+    if mesure == 'evolPct':
+        return f"{impot}evolpct_{data_yr[0]}_{data_yr[-1]}"
+    if mesure == 'hotspot':
+        return hotspot_params(impot + str(year))["giZ"]
+    if mesure == 'lisa':
+        return hotspot_params(impot + str(year))["lisaCl"]
+    if mesure == 'montant':
+        return f"{impot}montant_{year}"
+
+    return impot + str(year)
+
+
+def create_infoParam(impot='TauxTH_', mesure='taux'):
+    """
+        Retourne les paramètres dont les statistiques sont affichées dans le panneau d'information
+        Entrées :
+            - impot : l'impot que l'ont souhaite afficher (str)
+            - mesure : type de paramètre, valeur de dict_mesure (str)
+        Sortie :
+            - liste des paramètres (str)
+    """
+    if mesure == 'evol':
+        return [create_displayParam(impot, year, mesure) for year in data_yr[1:]]
+    if mesure in ('evolTotal', 'evolPct'):
+        return [create_displayParam(impot, data_yr[-1], 'evolTotal'),
+                create_displayParam(impot, data_yr[-1], 'evolPct')]
+    if mesure == 'montant':
+        return [create_displayParam(impot, year, mesure) for year in data_yr]
+
+    return [create_displayParam(impot, year) for year in data_yr]
+
+
+def param_label(displayParam):
+    """
+        Libellé court d'un paramètre (ex : "Taux 2018", "Évol. 2018", "Évol. % 2016-2018")
+    """
+    parts = displayParam.split("_")
+    if parts[-1] == "giZ":
+        return "Gi* " + parts[1]
+    if parts[-1] == "lisaCl":
+        return "LISA " + parts[1]
+    if parts[1] == "evol":
+        return "Évol. " + "-".join(parts[2:])
+    if parts[1] == "evolpct":
+        return "Évol. % " + "-".join(parts[2:])
+    if parts[1] == "montant":
+        return "Montant " + parts[2]
+    return "Taux " + parts[1]
+
+
+def find_city(df, insee):
+    """
+        Retourne la commune de code insee donné (ou None si elle n'existe pas)
+        Entrées :
+            - df : dataframe qui contient toutes les données
+            - insee : code insee de la commune (str)
+        Sortie :
+            - extract de la commune (Series) ou None
+    """
+    city = df[df["insee"] == insee]
+    if city.empty:
+        return None
+    return city.iloc[0]
+
+
+def compute_stats(displaySet, infoParam):
+    """
+        Calcule les statistiques descriptives du jeu de données affiché
+        Entrées :
+            - displaySet : DisplaySet des communes affichées
+            - infoParam : paramètres dont on souhaite les statistiques
+        Sorties :
+            - dataFrame des statistiques (une colonne par paramètre)
+    """
+    stats = displaySet[infoParam].dropna().describe(percentiles=[0.5]).round(decimals=2)
+    stats = stats[stats.index != 'count'] #On supprime la variable "count" deja affichée
+
+    # Modification de l'intitulé des colonnes
+    stats.columns = [param_label(elt) for elt in infoParam]
+
+    return stats
+
+
+### Jeu de données partagé ###
+
+class DataStore:
+    """
+        Jeu de données chargé en mémoire, partagé par toutes les sessions du processus,
+        avec ses index :
+            - inseeIndex : code insee -> position de la commune dans dataCities
+            - index spatial (dataCities.sindex), construit au premier usage
+            - searchIndex : recherche des communes par nom ou code insee
+            - topology : tracé des communes en arcs partagés (cf topology.py)
+            - adjacency : graphe des communes voisines (cf adjacency.py)
+            - centroids : centroïdes des communes et leur KD-tree (cf centroids.py)
+            - baselines : répartitions nationale et départementales des paramètres
+              affichables (cf baseline.py)
+            - moran : I de Moran national de chaque taux (les indices locaux sont
+              ajoutés aux colonnes, cf autocorr.py)
+        version identifie le fichier de données chargé (utilisée pour les caches HTTP).
+        Topologie et graphe d'adjacence sont relus depuis leurs caches, construits avec
+        le jeu de données (cf build_dataset) ; build les construit s'ils manquent.
+    """
+
+    def __init__(self, dataCities, version, build=False):
+        self.dataCities = dataCities
+        self.version = version
+        self.inseeIndex = {insee: pos for pos, insee in enumerate(dataCities["insee"])}
+        self.searchIndex = SearchIndex(dataCities)
+        self.topology = load_topology(dataCities, version, build=build)
+        self.adjacency = load_adjacency(dataCities, version, build=build)
+        if self.topology is None or self.adjacency is None:
+            raise DatasetError("topologie ou graphe d'adjacence absent pour la version " + version
+                               + " : reconstruction en arrière-plan (cf watch_sources) "
+                               "ou avec python dataset.py")
+        self.centroids = Centroids(dataCities)
+        self.baselines = Baselines(dataCities, baseline_params())
+        self.moran = add_hotspots(dataCities, self.adjacency,
+                                  [impot + str(year) for impot in dict_imp.values() for year in data_yr])
+
+    def city(self, insee):
+        """
+            Retourne la commune de code insee donné (ou None), sans parcourir la table
+        """
+        pos = self.inseeIndex.get(insee)
+        if pos is None:
+            return None
+        return self.dataCities.iloc[pos]
+
+    def select(self, ogCity, dist):
+        """
+            Communes affichées autour de ogCity (cf select_data)
+        """
+        return select_data(self.dataCities, ogCity, dist)
+
+    def select_shape(self, shape):
+        """
+            Communes dont le centroïde est dans la zone shape (cf select_shape)
+        """
+        return select_shape(self.dataCities, self.centroids, shape)
+
+    def select_hops(self, ogCity, hops):
+        """
+            Communes à au plus hops frontières de ogCity (cf select_hops)
+        """
+        return select_hops(self.dataCities, self.adjacency, self.inseeIndex[ogCity["insee"]], hops)
+
+    def cheaper(self, ogCity, param, k=5):
+        """
+            Communes les plus proches de ogCity dont le taux param est plus bas (cf cheaper_nearby)
+        """
+        return cheaper_nearby(self.dataCities, self.centroids, self.inseeIndex[ogCity["insee"]], param, k)
+
+
+def dataset_version(path=dataset_file):
+    """
+        Identifiant court du jeu de données en place, lu dans son manifeste (None sans manifeste)
+    """
+    return manifest_version(read_manifest(path))
+
+
+def build_store(rebuild=False):
+    """
+        Charge le jeu de données et construit tous ses index
+        Entrées :
+            - rebuild : force la génération du jeu de données (cf load_dataset)
+        Sortie :
+            - DataStore
+    """
+    dataCities, version = load_dataset(rebuild)
+    # Construction de l'index spatial une fois pour toutes
+    dataCities.sindex
+    # Hors des requêtes (rebuild), les caches dérivés manquants sont construits
+    return DataStore(dataCities, version, build=rebuild)
+
+
+_store = None
+_storeLock = Lock()
+# Un seul rechargement à la fois
+_reloadLock = Lock()
+# Fonctions appelées après le remplacement du jeu de données (vidage des caches)
+_reloadListeners = []
+_watcher = None
+
+def get_store():
+    """
+        Retourne le jeu de données partagé du processus (chargé au premier appel)
+        Les appelants conservent la référence obtenue pour toute la durée d'un traitement
+        (une session garde ainsi la version avec laquelle elle a été ouverte).
+    """
+    global _store
+    with _storeLock:
+        if _store is None:
+            _store = build_store()
+    return _store
+
+
+def on_reload(listener):
+    """
+        Enregistre une fonction (sans argument) appelée après chaque rechargement
+    """
+    _reloadListeners.append(listener)
+
+
+def reload_store(force=False):
+    """
+        Recharge le jeu de données si ses fichiers ont changé (ou si force), sans interrompre
+        le service : le nouveau jeu et ses index sont construits à part, puis substitués
+        d'un coup pour les sessions et requêtes suivantes. Les sessions en cours terminent
+        sur l'ancienne version.
+        Entrées :
+            - force : régénère le jeu de données même si les sources n'ont pas changé
+        Sortie :
+            - True si une nouvelle version a été chargée
+    """
+    global _store
+    # Rechargement déjà en cours : inutile d'en lancer un second
+    if not _reloadLock.acquire(blocking=False):
+        return False
+    try:
+        # Pas de jeu chargé si le fichier assemblé manquait au démarrage (cf load_dataset)
+        current = _store.version if _store is not None else None
+        rebuild = force or dataset_outdated()
+        if not rebuild and caches_missing():
+            # Jeu valide sans ses caches dérivés : reconstruits ici, hors des requêtes
+            repair_caches()
+        if not rebuild and dataset_version() == current:
+            return False
+
+        store = build_store(rebuild)
+        with _storeLock:
+            _store = store
+        print(f"jeu de données rechargé : version {current} -> {store.version}")
+        for listener in _reloadListeners:
+            listener()
+        return True
+    finally:
+        _reloadLock.release()
+
+
+def source_signature():
+    # Dates de modification et tailles des fichiers sources, du jeu assemblé et de ses caches
+    signature = []
+    for path in source_files + [dataset_file, topology_file, adjacency_file]:
+        try:
+            info = os.stat(path)
+            signature.append((path, info.st_mtime_ns, info.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return signature
+
+
+def watch_sources(signature, interval=watchInterval):
+    """
+        Surveille les fichiers de données et recharge le jeu de données à leur modification
+        (boucle infinie, exécutée dans un thread dédié). Un jeu absent, invalide ou périmé
+        au lancement est reconstruit sans attendre, de même que des caches dérivés absents
+        ou endommagés (supprimés ensuite, ils sont reconstruits au passage suivant).
+        Entrées :
+            - signature : état des fichiers au lancement de la surveillance (cf source_signature)
+            - interval : intervalle entre deux vérifications (s)
+    """
+    pending = dataset_outdated() or caches_missing()
+    while True:
+        current = signature
+        if not pending:
+            time.sleep(interval)
+            current = source_signature()
+            if current == signature:
+                continue
+        pending = False
+        try:
+            reload_store()
+            signature = current
+        except Exception as error:
+            # Fichier en cours de copie par exemple : nouvel essai au prochain passage
+            print("échec du rechargement du jeu de données :", error)
+
+
+def start_watcher(interval=watchInterval):
+    """
+        Lance (une seule fois par processus) la surveillance des fichiers de données
+    """
+    global _watcher
+    with _storeLock:
+        if _watcher is None:
+            _watcher = Thread(target=watch_sources, args=(source_signature(), interval), daemon=True)
+            _watcher.start()
+
+
+if __name__ == "__main__":
+    # Génération du jeu de données hors de l'application (avant le premier lancement,
+    # ou pour vérifier celui en place)
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Génération du jeu de données VizImpôts")
+    parser.add_argument("--force", action="store_true", help="régénère même si le jeu est à jour")
+    parser.add_argument("--check", action="store_true", help="vérifie le jeu en place sans le générer")
+    args = parser.parse_args()
+
+    if args.check:
+        manifest = read_manifest(dataset_file)
+        print(json.dumps(manifest, indent=1))
+        print("à jour" if not dataset_outdated() else "absent, invalide ou périmé")
+    elif args.force or dataset_outdated():
+        build_dataset()
+    else:
+        print("jeu de données à jour")
+        repair_caches()
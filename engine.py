@@ -0,0 +1,209 @@
+#%%
+"""
+    Moteur d'analyse des taux d'imposition, utilisable sans Bokeh (notebook, script) :
+
+        from engine import Engine
+        engine = Engine()
+        engine.stats("69123", radius=20, tax="TF")
+        engine.batch_stats(["75056", "69123", "13055"], radius=[5, 10, 20], tax="TH", year=2018)
+        engine.cheaper("69123", k=5, tax="TH")
+        engine.simulate(3000)      # montants estimés pour une valeur locative de 3000 €/an
+
+    L'application (vizapp.py) et l'API (api.py) reposent sur le même jeu de données
+    partagé et ses index (cf dataset.DataStore).
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from dataset import get_store, compute_stats, city_distances, data_yr, dict_tax
+from simulator import simulation_table
+
+# Statistiques calculées par batch_stats (mêmes intitulés que compute_stats)
+statNames = ["mean", "std", "min", "50%", "max"]
+
+
+class Engine:
+    """
+        Accès au jeu de données et aux calculs de voisinage, hors de toute interface
+        Entrées :
+            - store : jeu de données et index (par défaut, celui partagé par le processus)
+    """
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else get_store()
+
+    @property
+    def dataCities(self):
+        return self.store.dataCities
+
+    @property
+    def version(self):
+        return self.store.version
+
+    def city(self, insee):
+        """
+            Commune de code insee donné (KeyError si elle n'existe pas)
+        """
+        ogCity = self.store.city(insee)
+        if ogCity is None:
+            raise KeyError(f"commune {insee} inconnue")
+        return ogCity
+
+    def select(self, insee, radius=10, hops=None):
+        """
+            Communes affichées autour d'une commune, par distance (km) ou par rangs de voisinage
+            Sortie :
+                - DisplaySet des communes retenues
+        """
+        ogCity = self.city(insee)
+        if hops is not None:
+            return self.store.select_hops(ogCity, hops)
+        return self.store.select(ogCity, radius)
+
+    def stats(self, insee, radius=10, tax="TH", years=data_yr, hops=None):
+        """
+            Statistiques du panneau d'information pour une commune (cf compute_stats)
+        """
+        return self.describe(self.select(insee, radius, hops), tax, years)
+
+    def describe(self, displaySet, tax="TH", years=data_yr):
+        """
+            Statistiques des taux d'un impôt pour des communes déjà sélectionnées
+        """
+        return compute_stats(displaySet, [dict_tax[tax] + str(elt) for elt in years])
+
+    def distances(self, insee, maxRadius):
+        """
+            Communes situées à au plus maxRadius km d'une commune, par distance croissante
+            Sorties :
+                - positions des communes dans le jeu de données
+                - distances au contour de la commune (m), triées
+        """
+        positions, dist = city_distances(self.dataCities, self.city(insee).geometry, maxRadius)
+        order = np.argsort(dist, kind="stable")
+        return positions[order], dist[order]
+
+    def batch_stats(self, insee, radius, tax="TH", year=data_yr[-1]):
+        """
+            Taille de la sélection et statistiques du taux pour un lot de requêtes
+            (insee, rayon, impôt, année), en un seul appel.
+            Les arguments sont des valeurs ou des tableaux (étendus à la même longueur).
+            Pour chaque commune, les distances de ses voisines ne sont calculées qu'une fois :
+            la sélection d'un rayon est le début de la liste triée par distance, et moyenne,
+            écart-type, min et max de tous les rayons sont lus dans des sommes cumulées.
+            La sélection est celle de select_data (cf dataset.city_distances).
+            Entrées :
+                - insee : code(s) insee
+                - radius : rayon(s) (km)
+                - tax : impôt(s) (clé de dict_tax)
+                - year : année(s)
+            Sorties :
+                - dataFrame (une ligne par requête) : insee, radius, tax, year, communes,
+                  puis les statistiques (statNames) ; une commune inconnue donne 0 commune
+        """
+        insee, radius, tax, year = (elt.ravel() for elt in np.broadcast_arrays(
+            np.asarray(insee, dtype=object), np.asarray(radius, dtype=np.float64),
+            np.asarray(tax, dtype=object), np.asarray(year, dtype=np.int64)))
+        params = np.array([dict_tax[code] + str(elt) for code, elt in zip(tax, year)], dtype=object)
+
+        communes = np.zeros(len(insee), dtype=np.int64)
+        stats = np.full((len(insee), len(statNames)), np.nan)
+
+        for code in pd.unique(insee):
+            rows = np.flatnonzero(insee == code)
+            if self.store.city(code) is None:
+                continue
+            positions, dist = self.distances(code, radius[rows].max())
+            # Nombre de communes retenues pour chaque rayon
+            counts = np.searchsorted(dist, radius[rows] * 1000, side="right")
+            communes[rows] = counts
+
+            for param in pd.unique(params[rows]):
+                sub = params[rows] == param
+                paramRows, paramCounts = rows[sub], counts[sub]
+                values = self.dataCities[param].to_numpy(dtype=np.float64)[positions]
+                stats[paramRows] = prefix_stats(values, paramCounts)
+
+        result = pd.DataFrame({"insee": insee, "radius": radius, "tax": tax, "year": year,
+                               "communes": communes})
+        for i, name in enumerate(statNames):
+            result[name] = np.round(stats[:, i], 2)
+        return result
+
+    def cheaper(self, insee, k=5, tax="TH", year=data_yr[-1]):
+        """
+            Communes les plus proches d'une commune dont le taux est plus bas
+            (cf dataset.cheaper_nearby)
+        """
+        return self.store.cheaper(self.city(insee), dict_tax[tax] + str(year), k)
+
+    def simulate(self, vlc, insee=None, radius=10, hops=None):
+        """
+            Montants estimés de taxe d'habitation et de taxe foncière d'un logement de valeur
+            locative cadastrale vlc (€/an), dans toutes les communes (insee None) ou autour
+            d'une commune, en une opération sur les taux (cf simulator.py)
+            Sorties :
+                - dataFrame (une ligne par commune) : insee, nom, Code_DEP, montants
+        """
+        positions = None if insee is None else self.select(insee, radius, hops).positions
+        return simulation_table(self.dataCities, vlc, positions)
+
+
+def prefix_stats(values, counts):
+    """
+        Statistiques des premières valeurs d'un tableau, pour plusieurs longueurs à la fois
+        (valeurs manquantes ignorées, comme par describe)
+        Entrées :
+            - values : valeurs triées par distance
+            - counts : longueurs des débuts de tableau
+        Sorties :
+            - tableau (len(counts), len(statNames))
+    """
+    valid = ~np.isnan(values)
+    zeros = np.where(valid, values, 0)
+    # Sommes cumulées : nombre de valeurs, somme, somme des carrés, min et max courants
+    n = np.concatenate([[0], np.cumsum(valid)])[counts]
+    s1 = np.concatenate([[0], np.cumsum(zeros)])[counts]
+    s2 = np.concatenate([[0], np.cumsum(zeros ** 2)])[counts]
+    mins = np.concatenate([[np.nan], np.fmin.accumulate(values)])[counts]
+    maxs = np.concatenate([[np.nan], np.fmax.accumulate(values)])[counts]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = s1 / n
+        # écart-type de l'échantillon (ddof=1, comme describe)
+        std = np.sqrt(np.maximum(s2 - n * mean ** 2, 0) / (n - 1))
+    std[n < 2] = np.nan
+    # La médiane n'est pas cumulable : calculée sur chaque début de tableau
+    median = np.array([np.nanmedian(values[:count]) if nValid else np.nan
+                       for count, nValid in zip(counts, n)])
+
+    return np.column_stack([mean, std, mins, median, maxs])
+
+
+if __name__ == '__main__':
+    # Comparaison du calcul par lot et d'un calcul requête par requête
+    # ex : python engine.py 1000
+    nQueries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    engine = Engine()
+    rng = np.random.default_rng(0)
+    codes = rng.choice(engine.dataCities["insee"].to_numpy(), size=max(nQueries // 20, 1))
+    insee = rng.choice(codes, size=nQueries)
+    radius = rng.choice([5, 10, 20, 50], size=nQueries)
+    tax = rng.choice(list(dict_tax), size=nQueries)
+    year = rng.choice(data_yr, size=nQueries)
+
+    start = time.perf_counter()
+    result = engine.batch_stats(insee, radius, tax, year)
+    batchTime = time.perf_counter() - start
+
+    sample = min(nQueries, 100)
+    start = time.perf_counter()
+    for i in range(sample):
+        engine.stats(insee[i], radius[i], tax[i], [year[i]])
+    loopTime = (time.perf_counter() - start) * nQueries / sample
+
+    print(f"{nQueries} requêtes : par lot {batchTime:.2f} s, une à une ~{loopTime:.2f} s")
+    print(result.head())
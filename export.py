@@ -0,0 +1,162 @@
+#%%
+"""
+    Export des communes affichées en CSV, GeoJSON ou Parquet, par blocs de lignes :
+    chaque format est un générateur de morceaux de fichier, le fichier complet n'est
+    jamais construit en mémoire (exports à 100 km ou de toute la France).
+
+    Le tracé (optionnel) est exporté en WGS84 (EPSG:4326) : WKT en CSV, géométrie
+    GeoJSON, WKB en Parquet. Le format Parquet nécessite pyarrow (optionnel).
+"""
+import io
+import json
+
+import numpy as np
+from shapely.geometry import mapping
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from dataset import DisplaySet, data_yr, dict_tax
+
+# Nombre de communes traitées par bloc
+exportChunk = 500
+# Formats d'export (format -> type MIME, extension)
+exportFormats = {"csv": ("text/csv", "csv"),
+                 "geojson": ("application/geo+json", "geojson"),
+                 "parquet": ("application/vnd.apache.parquet", "parquet")}
+
+
+def export_columns():
+    """
+        Colonnes attributaires exportées : identification de la commune et taux
+    """
+    return ["insee", "nom", "Code_DEP"] + [prefix + str(year) for prefix in dict_tax.values()
+                                          for year in data_yr]
+
+
+def iter_chunks(displaySet, chunk=exportChunk):
+    """
+        Découpe les communes affichées en DisplaySet de chunk communes au plus
+    """
+    for start in range(0, len(displaySet), chunk):
+        yield DisplaySet(displaySet.dataCities, displaySet.positions[start:start + chunk])
+
+
+def wgs84(displaySet):
+    # Tracé des communes en coordonnées géographiques
+    return displaySet.geometry.to_crs(epsg=4326)
+
+
+def iter_csv(displaySet, geometry=False):
+    """
+        Morceaux du fichier CSV (tracé en WKT dans la colonne geometry)
+    """
+    columns = export_columns()
+    yield ",".join(columns + (["geometry"] if geometry else [])) + "\n"
+    for part in iter_chunks(displaySet):
+        frame = part[columns]
+        if geometry:
+            frame["geometry"] = [geom.wkt for geom in wgs84(part)]
+        yield frame.to_csv(header=False, index=False)
+
+
+def iter_geojson(displaySet, geometry=False):
+    """
+        Morceaux du fichier GeoJSON (géométrie null sans le tracé)
+    """
+    columns = export_columns()
+    yield '{"type": "FeatureCollection", "features": ['
+    first = True
+    for part in iter_chunks(displaySet):
+        frame = part[columns]
+        # NaN n'est pas du JSON valide
+        records = frame.astype(object).where(frame.notna(), None).to_dict(orient="records")
+        shapes = [mapping(geom) for geom in wgs84(part)] if geometry else [None] * len(records)
+        features = ",\n".join(json.dumps({"type": "Feature", "properties": record, "geometry": shape})
+                              for record, shape in zip(records, shapes))
+        if features:
+            yield ("\n" if first else ",\n") + features
+            first = False
+    yield "\n]}\n"
+
+
+class _ChunkSink:
+    """
+        Fichier en écriture pour pyarrow, vidé après chaque bloc de lignes (cf iter_parquet)
+    """
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        content = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return content
+
+
+def iter_parquet(displaySet, geometry=False):
+    """
+        Morceaux du fichier Parquet, un groupe de lignes par bloc (tracé en WKB)
+    """
+    if pa is None:
+        raise ImportError("l'export Parquet nécessite pyarrow")
+    columns = export_columns()
+    sink = _ChunkSink()
+    writer = None
+    # Au moins un bloc, éventuellement vide, pour écrire le schéma
+    parts = iter_chunks(displaySet) if len(displaySet) else [displaySet]
+    for part in parts:
+        frame = part[columns]
+        frame[columns[3:]] = frame[columns[3:]].astype(np.float64)
+        if geometry:
+            frame["geometry"] = [geom.wkb for geom in wgs84(part)]
+        if writer is None:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            writer = pq.ParquetWriter(sink, table.schema)
+        else:
+            table = pa.Table.from_pandas(frame, schema=writer.schema, preserve_index=False)
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def iter_export(displaySet, fmt, geometry=False):
+    """
+        Fichier d'export des communes affichées, par morceaux
+        Entrées :
+            - displaySet : DisplaySet des communes exportées
+            - fmt : format (clé de exportFormats)
+            - geometry : exporte aussi le tracé des communes
+        Sorties :
+            - générateur de morceaux du fichier (str, ou bytes pour Parquet)
+    """
+    if fmt == "parquet":
+        return iter_parquet(displaySet, geometry)
+    if fmt == "geojson":
+        return iter_geojson(displaySet, geometry)
+    return iter_csv(displaySet, geometry)
+
+
+def parquet_available():
+    return pa is not None
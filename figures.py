@@ -0,0 +1,511 @@
+#%%
+import numpy as np
+
+from bokeh.models import (ColorBar, ColumnDataSource, Div,
+                          HoverTool, PreText,
+                          LinearColorMapper, WheelZoomTool,
+                          Arrow, VeeHead, WMTSTileSource, FixedTicker, CustomJS,
+                          BoxSelectTool, LassoSelectTool)
+from bokeh.plotting import figure
+from bokeh.tile_providers import Vendors, get_provider
+from bokeh.events import Tap, SelectionGeometry
+
+from dataset import compute_stats, rank_params
+from geocodec import encode_display, encode_topology, create_geosource
+from tiles import proxyUrl
+from classify import defaultScheme, display_breaks, class_index, fixed_classes, frame_classes
+from autocorr import display_moran, base_param
+
+# Durée d'affichage de chaque année de l'animation (ms)
+frameInterval = 1000
+
+# Animation des années, jouée par le navigateur : la colonne "classe" de la source
+# prend successivement les valeurs des colonnes frame_0, frame_1... (classes précalculées)
+_animationCode = """
+    const players = window.vizimpotsPlayers || (window.vizimpotsPlayers = {});
+    const player = players[button.id];
+    if (player) {
+        clearInterval(player.timer);
+        if (player.source === source) {
+            source.data.classe = player.classe;
+            source.change.emit();
+        }
+        delete players[button.id];
+    }
+    if (!button.active) {
+        color_bar.major_label_overrides = labels;
+        plot.title.text = title;
+        return;
+    }
+
+    let frame = 0;
+    function show() {
+        source.data.classe = source.data["frame_" + frame];
+        source.change.emit();
+        plot.title.text = titles[frame];
+        frame = (frame + 1) % titles.length;
+    }
+    players[button.id] = {source: source, classe: source.data.classe, timer: setInterval(show, interval)};
+    color_bar.major_label_overrides = frameLabels;
+    show();
+"""
+
+### Fonctions de création des figures ###
+
+def choro_columns(displaySet, displayParam):
+    """
+        Colonnes attributaires transmises avec le tracé des communes
+        (infobulles et couleur de la carte)
+    """
+    columns = ["insee", "nom", "Code_DEP", displayParam]
+    # Indices d'autocorrélation : taux d'origine et ses rangs en plus
+    baseParam = base_param(displayParam)
+    if baseParam != displayParam:
+        columns.append(baseParam)
+    columns += [col for col in rank_params(baseParam).values() if col in displaySet.columns]
+    return columns
+
+
+def encode_choropleth(displaySet, displayParam, topology=None):
+    """
+        Encode le tracé et les attributs des communes affichées pour la carte :
+        par arcs partagés si la topologie est fournie, commune par commune sinon
+    """
+    columns = choro_columns(displaySet, displayParam)
+    if topology is not None:
+        return encode_topology(topology, displaySet.positions, displaySet, columns)
+    return encode_display(displaySet, columns)
+
+
+def colorbar_labels(breaks, displayParam):
+    """
+        Graduations de la légende : aux limites des classes, ou au milieu des classes
+        nommées (clusters LISA)
+        Sorties :
+            - positions des graduations, libellés (position -> texte)
+    """
+    fixed = fixed_classes(displayParam)
+    if fixed is not None and fixed[2] is not None:
+        ticks = [i + 0.5 for i in range(len(fixed[2]))]
+        return ticks, {str(tick): label for tick, label in zip(ticks, fixed[2])}
+    ticks = list(range(len(breaks)))
+    return ticks, {str(i): f"{elt:.2f}" for i, elt in enumerate(breaks)}
+
+
+def create_basemap():
+    """
+        Source des tuiles du fond de carte : proxy local avec cache si configuré
+        (cf tiles.py), CDN CartoDB sinon
+    """
+    provider = get_provider(Vendors.CARTODBPOSITRON)
+    if proxyUrl is None:
+        return provider
+    return WMTSTileSource(url=proxyUrl.rstrip("/") + "/{Z}/{X}/{Y}.png", attribution=provider.attribution)
+
+
+def create_choropleth(displaySet, displayParam, palette, ogCity, title, tapCallback=None, geodata=None,
+                      topology=None, basemap=None, scheme=defaultScheme, surface=None,
+                      frames=None, playButton=None, selectCallback=None):
+    """
+        Fonction qui met à jour la coloration des communes affichées
+        Entrées :
+            - displaySet : DisplaySet des communes affichées
+            - displayParam : paramètres que l'on souhaite aficher
+            - palette : liste de couleurs (identique à celle de la choroplèthe)
+            - ogCity : extract de la commune sélectionnée
+            - title : titre de la carte
+            - tapCallback : callback appelé au clic sur la carte (optionnel)
+            - geodata : tracé des communes déjà encodé par encode_choropleth (optionnel)
+            - topology : topologie du tracé de toutes les communes (optionnel)
+            - basemap : source des tuiles du fond de carte, réutilisée d'une carte à l'autre
+              (optionnel, cf create_basemap)
+            - scheme : mode de classification des couleurs (cf classify.py)
+            - surface : surface lissée affichée sous les communes, qui ne sont alors plus
+              colorées (optionnel, cf smoothing.py)
+            - frames : liste (paramètre, titre) des images de l'animation, ex : une par année
+              (optionnel)
+            - playButton : Toggle qui lance et arrête l'animation dans le navigateur
+              (optionnel, avec frames)
+            - selectCallback : callback appelé avec la zone tracée par les outils de sélection
+              rectangle et lasso, pendant et à la fin du tracé (optionnel)
+        Sorties :
+            - Figure contenant la carte.
+    """
+    # On récupère les limites géographiques pour initialiser la carte
+    displayBounds = displaySet.total_bounds
+
+    # encodage compact du tracé des communes, décodé par le navigateur (cf geocodec)
+    if geodata is None:
+        geodata = encode_choropleth(displaySet, displayParam, topology)
+
+    # Palette imposée pour les indices d'autocorrélation (classes fixes)
+    fixed = fixed_classes(displayParam)
+    if fixed is not None:
+        palette = fixed[1]
+
+    # Classe de couleur de chaque commune (limites partagées avec l'histogramme)
+    breaks = display_breaks(displaySet, displayParam, len(palette), scheme)
+    geodata = dict(geodata, classe=class_index(geodata[displayParam], breaks))
+
+    # Classes de toutes les images de l'animation, en une passe et sur des limites communes,
+    # transmises en tableaux uint8 : le changement d'image ne sollicite plus le serveur
+    animate = frames is not None and playButton is not None and surface is None
+    if animate:
+        frameBreaks, classes = frame_classes(displaySet, [param for param, _ in frames], len(palette), scheme)
+        geodata = dict(geodata, **{f"frame_{i}": elt for i, elt in enumerate(classes)})
+    geosource, xs, ys = create_geosource(geodata)
+
+    # Creation de la figure de la carte
+    choroPlot = figure(title = title,
+                x_range=(displayBounds[0], displayBounds[2]),
+                y_range=(displayBounds[1], displayBounds[3]),
+                x_axis_type="mercator",
+                y_axis_type="mercator",
+                plot_height = 500 ,
+                plot_width = 850,
+                sizing_mode = "scale_width",
+                toolbar_location = 'below',
+                tools = "pan, wheel_zoom, box_zoom, reset",
+                x_axis_location=None,
+                y_axis_location=None
+            )
+
+    choroPlot.xgrid.grid_line_color = None
+    choroPlot.ygrid.grid_line_color = None
+
+    # Ajout d'un évèmenent de type clic, pour sélectionnr la commune de référence
+    if tapCallback is not None:
+        choroPlot.on_event(Tap, tapCallback)
+
+    # Outils de sélection d'une zone quelconque (rectangle, lasso), zone transmise au serveur
+    if selectCallback is not None:
+        choroPlot.add_tools(BoxSelectTool(select_every_mousemove=True),
+                            LassoSelectTool(select_every_mousemove=True))
+        choroPlot.on_event(SelectionGeometry, selectCallback)
+
+    #outil de zoom molette activé par défaut
+    choroPlot.toolbar.active_scroll = choroPlot.select_one(WheelZoomTool)
+
+    # ajout du fond de carte
+    if basemap is None:
+        basemap = create_basemap()
+    choroPlot.add_tile(basemap)
+
+    # Une couleur par classe : la classe i (colonne "classe" = i + 0.5) reçoit palette[i]
+    color_mapper = LinearColorMapper(palette = palette,
+                                low = 0,
+                                high = len(palette),
+                                nan_color = '#808080',
+                                high_color = '#808080'     # classes compactes sans valeur
+                                )
+
+    # Surface lissée sous le tracé des communes, avec les mêmes classes de couleur
+    if surface is not None:
+        surface_mapper = LinearColorMapper(palette = palette,
+                                    low = 0,
+                                    high = len(palette),
+                                    nan_color = (0, 0, 0, 0)
+                                    )
+        choroPlot.image(image=[class_index(surface["image"], breaks)],
+                        x=surface["x"], y=surface["y"], dw=surface["dw"], dh=surface["dh"],
+                        color_mapper=surface_mapper,
+                        global_alpha=0.6
+                    )
+
+    # Ajout du tracé des communes sur la carte
+    # (contours seuls au-dessus de la surface lissée, toujours actifs pour le survol et le clic)
+    citiesPatch = choroPlot.patches(xs, ys,
+                    source = geosource,
+                    line_color = 'gray',
+                    line_width = 0.25,
+                    fill_alpha = 0.5 if surface is None else 0,
+                    fill_color = {'field' : 'classe' , 'transform': color_mapper}
+                    )
+
+    # création de la legende #
+    ticks, labels = colorbar_labels(breaks, displayParam)
+    color_bar = ColorBar(color_mapper=color_mapper,
+                    ticker=FixedTicker(ticks=ticks),
+                    major_label_overrides=labels,
+                    label_standoff=8,
+                    location=(0,0),
+                    orientation='vertical'
+                    )
+    choroPlot.add_layout(color_bar, 'right')
+
+    # ajout d'une flèche sur la commune de reférence
+    start = ogCity.geometry.centroid
+    pin_point = Arrow(end=VeeHead(size=15),
+                        line_color="red",
+                        x_start=start.x,
+                        y_start=start.y,
+                        x_end=start.x,
+                        y_end=start.y - 0.001
+                    )
+    choroPlot.add_layout(pin_point)
+
+    #  Ajout d'un tooltip au survol de la carte
+    tooltips = [('Commune','@nom'),
+                (displayParam, '@' + displayParam)]
+    baseParam = base_param(displayParam)
+    if baseParam != displayParam:
+        tooltips.append((baseParam, '@' + baseParam))
+    # Position de la commune (rangs précalculés pour les taux)
+    ranks = rank_params(baseParam)
+    if ranks["rangNat"] in displaySet.columns:
+        tooltips += [('Rang national', '@{%s}{0} (percentile @{%s}{0})' % (ranks["rangNat"], ranks["pctNat"])),
+                     ('Rang départemental', '@{%s}{0} (percentile @{%s}{0})' % (ranks["rangDep"], ranks["pctDep"]))]
+    choroHover = HoverTool(renderers = [citiesPatch],
+                        tooltips = tooltips
+                        )
+    choroPlot.add_tools(choroHover)
+
+    # Animation : le bouton pilote la source de cette carte (celle de la carte précédente
+    # est abandonnée)
+    if playButton is not None:
+        playButton.disabled = not animate
+        callbacks = []
+        if animate:
+            callbacks.append(CustomJS(args=dict(button=playButton, source=geosource, plot=choroPlot,
+                                                color_bar=color_bar, labels=labels,
+                                                frameLabels=colorbar_labels(frameBreaks, displayParam)[1],
+                                                title=title, titles=[elt for _, elt in frames],
+                                                interval=frameInterval),
+                                      code=_animationCode))
+        playButton.js_property_callbacks = {"change:active": callbacks}
+
+    return choroPlot
+
+
+def compute_histo(displaySet, displayParam, nBins, scheme=defaultScheme):
+    """
+        Calcule la répartition des valeurs affichées dans l'histogramme
+        Entrées :
+            - displaySet : DisplaySet des communes affichées
+            - displayParam : paramètres que l'on souhaite aficher
+            - nBins : nombre de regroupements
+            - scheme : mode de classification (regroupements identiques aux classes de la carte)
+        Sorties :
+            - dictionnaire (hist, edges, total, hist_pct, mean, med)
+    """
+    # Valeurs du paramètre, extraites une seule fois
+    values = displaySet[displayParam]
+    # Calcul de l'histogramme
+    hist, edges = np.histogram(values.dropna(), bins=display_breaks(displaySet, displayParam, nBins, scheme))
+    # Nombre de lignes dans displaySet (vectorisé pour passage à datasource)
+    total = values.size * np.ones(nBins, np.int8)
+    # Normalisation de l'histogramme (affichage en % du total d'éléments)
+    hist_pct = 100*hist/total[0]
+
+    # Calcul de la moyenne et médiane de l'échantillon
+    mean = values.mean()
+    med =  values.quantile(0.5)
+
+    return dict(hist=hist, edges=edges, total=total, hist_pct=hist_pct, mean=mean, med=med)
+
+
+# Fonction de création de l'histogramme
+def createHisto(displaySet, displayParam, palette, ogCity, title, histo=None, scheme=defaultScheme,
+                baseline=None):
+    """
+        L'histogramme permet de visualiser la répartition des taux des communes affichées
+        Entrées :
+            - displaySet : DisplaySet des communes affichées
+            - displayParam : paramètres que l'on souhaite aficher
+            - palette : liste de couleurs (identique à celle de la choroplèthe)
+            - ogCity : extract de la commune sélectionnée
+            - title : titre de l'histogramme
+            - histo : répartition déjà calculée par compute_histo (optionnel)
+            - scheme : mode de classification des couleurs (cf classify.py)
+            - baseline : répartitions de référence, superposées pour la France et le
+              département de la commune sélectionnée (optionnel, cf baseline.py)
+        Sorties :
+            - figure contenant l'histogramme.
+    """
+
+    fixed = fixed_classes(displayParam)
+    if fixed is not None:
+        palette = fixed[1]
+
+    # On crée autant de regroupement que de couleurs passées à la fct°
+    if histo is None:
+        histo = compute_histo(displaySet, displayParam, len(palette), scheme)
+    hist, edges, total = histo["hist"], histo["edges"], histo["total"]
+    hist_pct, mean, med = histo["hist_pct"], histo["mean"], histo["med"]
+
+    # Répartitions nationale et départementale sur les mêmes regroupements (précalculées)
+    overlay = None
+    if baseline is not None:
+        overlay = baseline.overlay(displayParam, ogCity["Code_DEP"], edges)
+    references = [] if overlay is None else [elt for elt in (overlay["national"], overlay["department"])
+                                             if elt is not None]
+
+    # Calcul de l'étendue l'échelle verticale
+    hmax = max(max(elt) for elt in [hist_pct] + references)*1.1
+    hmin= -0.1*hmax
+
+    # Création de la figure contenant l'histogramme
+    histoPlot = figure(title = title,
+                y_range=(hmin, hmax),
+                plot_height = 300 ,
+                plot_width = 400,
+                sizing_mode = "scale_width",
+                y_axis_location='right',
+                toolbar_location=None
+                )
+    histoPlot.xgrid.grid_line_color = None
+    histoPlot.xaxis.axis_label = displayParam
+    histoPlot.xaxis.axis_line_color = None
+    histoPlot.ygrid.grid_line_color = "white"
+    histoPlot.yaxis.axis_label = '% de l\'échantillon'
+    histoPlot.yaxis.axis_line_color = None
+
+    # Source de données
+    data = dict(right=edges[1:],
+                left=edges[:-1] ,
+                top=hist_pct,
+                nb=hist,
+                total=total,
+                color=palette
+            )
+    if overlay is not None:
+        nanPct = np.full(len(hist), np.nan)
+        data.update(national=overlay["national"],
+                    department=overlay["department"] if overlay["department"] is not None else nanPct)
+    histoSource = ColumnDataSource(data=data)
+
+    # Tracé de l'histogramme
+    histoDraw = histoPlot.quad(bottom=0,
+                                left="left",
+                                right="right",
+                                top="top",
+                                fill_color = "color",
+                                line_color=None,
+                                source=histoSource)
+
+    # Contours des répartitions de référence (% des communes de France / du département)
+    tooltips = [('Taille', '@nb'),
+                ('Fourchette', '@left - '+'@right'),
+                ]
+    if overlay is not None:
+        histoPlot.quad(bottom=0, left="left", right="right", top="national",
+                       fill_color=None, line_color="black", line_dash="dashed",
+                       source=histoSource,
+                       legend_label=f"France (méd. {overlay['natMedian']:.2f})")
+        tooltips.append(('France', '@national{0.0} %'))
+        if overlay["department"] is not None:
+            histoPlot.quad(bottom=0, left="left", right="right", top="department",
+                           fill_color=None, line_color="darkorange", line_width=1.5,
+                           source=histoSource,
+                           legend_label=f"Dép. {ogCity['Code_DEP']} (méd. {overlay['depMedian']:.2f})")
+            tooltips.append(('Département', '@department{0.0} %'))
+
+    #  Ajout d'un tooltip au survol de la carte
+    histoHover = HoverTool(renderers = [histoDraw],
+                        mode = "vline",
+                        tooltips = tooltips
+                    )
+    histoPlot.add_tools(histoHover)
+
+    # Ajout d'un repère vertical pour la commune sélectionnée
+    if ~np.isnan(ogCity[displayParam]) :
+        ogCityDraw = histoPlot.quad(bottom=hmin,
+                                    top=hmax,
+                                    left=ogCity[displayParam] - 0.05,
+                                    right=ogCity[displayParam] + 0.05,
+                                    fill_color = "pink",
+                                    line_color= None,
+                                    legend_label=ogCity["nom"] + ' (' + ogCity["Code_DEP"]+')'
+                                )
+
+        #  Ajout d'un tooltip au survol de la commune d'orginie
+        displayName = ogCity["nom"]+" ("+ogCity["Code_DEP"]+")"
+        ogCityHover = HoverTool(renderers = [ogCityDraw],
+                            mode = "vline",
+                            tooltips = [('Commune sélectionnée', displayName),
+                                        (displayParam, str(ogCity[displayParam])),
+                                        ]
+                        )
+        histoPlot.add_tools(ogCityHover)
+
+    # Ajout d'un repère vertical pour la moyenne de l'échantillon
+    histoPlot.quad(bottom=hmin,
+                    top=hmax,
+                    left=mean - 0.05,
+                    right=mean + 0.05,
+                    fill_color = "blue",
+                    line_color= None,
+                    legend_label="Moyenne ")
+
+    # Ajout d'un repère vertical pour la mediane de l'échantillon
+    histoPlot.quad(bottom=hmin,
+                    top=hmax,
+                    left=med - 0.05,
+                    right=med + 0.05,
+                    fill_color = "purple",
+                    line_color= None,
+                    legend_label="Mediane ")
+
+    # On rend la légende interactive
+    histoPlot.legend.click_policy="hide"
+    # On oriente horizontalement la légende
+    histoPlot.legend.orientation="vertical"
+    # Réduction de la police
+    histoPlot.legend.label_text_font_size = "8px"
+    # On place la légende hors de la zone de tracé
+    histoLegend = histoPlot.legend[0]
+    histoPlot.legend[0] = None
+    histoPlot.add_layout(histoLegend, 'right')
+
+    return histoPlot
+
+
+def create_info(displaySet, infoParam, ogCity, impotLabel, stats=None, displayParam=None, adjacency=None,
+                cheaper=None):
+    """
+        Affiche un panneau textuel contenant des infomations sur le jeu de données
+        affiché et la commune sélectionnée.
+        Entrées :
+            - displaySet : DisplaySet des communes affichées
+            - infoParam : paramètres que l'on souhaite aficher
+            - ogCity : extract de la commune sélectionnée
+            - impotLabel : libellé de l'impôt affiché
+            - stats : statistiques déjà calculées par compute_stats (optionnel)
+            - displayParam : paramètre affiché, pour la position de la commune (optionnel)
+            - adjacency : graphe d'adjacence des communes, pour le I de Moran de la zone (optionnel)
+            - cheaper : communes proches au taux plus bas (cf dataset.cheaper_nearby, optionnel)
+        Sorties :
+            - figure contenant le texte à afficher.
+    """
+    if stats is None:
+        stats = compute_stats(displaySet, infoParam)
+
+    # Creation du texte
+    infoText = [f"<b>Communes affichées</b> : {len(displaySet)}",
+                f"<b>Commune sélectionnée</b> : {ogCity['nom']} ({ogCity['Code_DEP']})",
+                "</br><b>Statistiques</b> : " + impotLabel
+            ]
+
+    # Position de la commune sélectionnée (rangs précalculés, simple lecture)
+    if displayParam is not None:
+        baseParam = base_param(displayParam)
+        ranks = rank_params(baseParam)
+        if ranks["rangNat"] in ogCity.index and not np.isnan(ogCity[ranks["rangNat"]]):
+            rankText = [f"<b>Rang national</b> : {ogCity[ranks['rangNat']]:.0f}e (percentile {ogCity[ranks['pctNat']]:.0f})",
+                        f"<b>Rang départemental</b> : {ogCity[ranks['rangDep']]:.0f}e (percentile {ogCity[ranks['pctDep']]:.0f})"]
+            infoText[2:2] = rankText
+
+        # Regroupement spatial des taux dans la zone affichée
+        if adjacency is not None and baseParam in displaySet.columns:
+            moranI, moranZ, _ = display_moran(displaySet, baseParam, adjacency)
+            if not np.isnan(moranI):
+                infoText.insert(-1, f"<b>I de Moran (zone affichée)</b> : {moranI:.2f} (z = {moranZ:.1f})")
+
+    # Communes les plus proches au taux plus bas
+    if cheaper is not None:
+        cheaperText = [f"&nbsp;&nbsp;{elt.nom} ({elt.Code_DEP}) : {elt.taux:.2f} % à {elt.distance:.1f} km ({elt.ecart:+.2f} pts)"
+                       for elt in cheaper.itertuples()]
+        infoText.insert(-1, "<b>Moins cher à proximité</b> : " + ("</br>".join([""] + cheaperText)
+                                                                   if cheaperText else "aucune commune"))
+
+    return [Div(text="</br>".join(infoText)), PreText(text=str(stats))]
@@ -0,0 +1,310 @@
+#%%
+"""
+    Encodage compact du tracé des communes envoyé au navigateur.
+
+    Au lieu du GeoJSON (coordonnées webmercator en double précision écrites en texte),
+    chaque commune est transmise sous forme :
+        - d'une origine (ox, oy) : premier point, arrondi à la grille
+        - d'une suite d'écarts entiers entre points successifs, exprimés en pas de grille
+          (quantum, en mètres), stockés dans un tableau typé int16 (int32 si nécessaire)
+    Les polygones d'une même commune sont séparés par la valeur minimale du type
+    (-32768 ou -2147483648), décodée en NaN comme le fait le GeoJSONDataSource.
+    Le décodage est fait côté navigateur par une CustomJSTransform appliquée aux
+    champs xs / ys du glyphe patches.
+
+    Lorsque la topologie des communes est disponible (cf topology.py), les frontières
+    partagées entre communes affichées ne sont transmises qu'une fois : chaque commune
+    ne porte que les références de ses arcs, les arcs (encodés de la même façon) sont
+    transmis dans une source de données à part.
+
+    Mesure des gains :
+        python geocodec.py <insee> <rayon km> [<rayon km> ...]
+"""
+import json
+import sys
+
+import numpy as np
+
+from bokeh.models import ColumnDataSource, CustomJSTransform
+from bokeh.util.serialization import transform_column_source_data
+
+# Pas de la grille de quantification par défaut (m)
+defaultQuantum = 1.0
+
+_sentinels = {np.dtype(np.int16): np.iinfo(np.int16).min,
+              np.dtype(np.int32): np.iinfo(np.int32).min}
+
+# Décodage côté navigateur : cumul des écarts, mise à l'échelle et ajout de l'origine
+_decoder = """
+const origin = source.data[axis]
+const out = new Array(xs.length)
+for (let i = 0; i < xs.length; i++) {
+    const deltas = xs[i]
+    const sentinel = (deltas instanceof Int16Array) ? -32768 : -2147483648
+    const coords = new Float64Array(deltas.length)
+    let acc = 0
+    for (let j = 0; j < deltas.length; j++) {
+        if (deltas[j] === sentinel) {
+            coords[j] = NaN
+        } else {
+            acc += deltas[j]
+            coords[j] = origin[i] + acc * quantum
+        }
+    }
+    out[i] = coords
+}
+return out
+"""
+
+
+# Décodage des arcs partagés : points des arcs, puis contours de chaque commune
+_topologyDecoder = """
+const table = arcs.data
+const deltas = table[axis][0]
+const starts = table['s' + axis][0]
+const offsets = table['offsets'][0]
+const origin = table['g' + axis][0]
+
+const points = new Float64Array(deltas.length)
+for (let a = 0; a < offsets.length - 1; a++) {
+    let acc = starts[a]
+    for (let j = offsets[a]; j < offsets[a + 1]; j++) {
+        acc += deltas[j]
+        points[j] = origin + acc * quantum
+    }
+}
+
+const sentinel = -2147483648
+const out = new Array(xs.length)
+for (let i = 0; i < xs.length; i++) {
+    const coords = []
+    let first = true
+    for (const ref of xs[i]) {
+        if (ref === sentinel) {
+            coords.push(NaN)
+            first = true
+            continue
+        }
+        // arcs consécutifs d'un contour : le premier point de l'un est le dernier du précédent
+        if (ref >= 0) {
+            for (let j = first ? offsets[ref] : offsets[ref] + 1; j < offsets[ref + 1]; j++)
+                coords.push(points[j])
+        } else {
+            const arc = ~ref
+            for (let j = first ? offsets[arc + 1] - 1 : offsets[arc + 1] - 2; j >= offsets[arc]; j--)
+                coords.push(points[j])
+        }
+        first = false
+    }
+    out[i] = Float64Array.from(coords)
+}
+return out
+"""
+
+
+def exterior_rings(geometry):
+    """
+        Contours extérieurs d'un Polygon ou d'un MultiPolygon
+        (comme le GeoJSONDataSource de Bokeh, les trous ne sont pas tracés)
+    """
+    if geometry is None or geometry.is_empty:
+        return []
+    if geometry.geom_type == "Polygon":
+        return [geometry.exterior]
+    return [polygon.exterior for polygon in geometry.geoms]
+
+
+def encode_geometry(geometry, quantum=defaultQuantum):
+    """
+        Encode le tracé d'une commune en écarts entiers sur une grille
+        Entrées :
+            - geometry : Polygon ou MultiPolygon (EPSG:3857)
+            - quantum : pas de la grille (m)
+        Sorties :
+            - tuple (ox, oy, dx, dy) : origine et écarts (tableaux int16 ou int32)
+    """
+    parts = []
+    for ring in exterior_rings(geometry):
+        # Le dernier point répète le premier : inutile pour patches
+        coords = np.asarray(ring.coords)[:-1, :2]
+        parts.append(np.rint(coords / quantum).astype(np.int64))
+    if not parts:
+        return np.nan, np.nan, np.zeros(0, np.int16), np.zeros(0, np.int16)
+
+    grid = np.concatenate(parts)
+    origin = grid[0]
+    deltas = np.diff(grid, axis=0, prepend=origin[np.newaxis, :])
+
+    # Le type le plus petit qui contient tous les écarts (hors valeur de séparation)
+    limit = np.iinfo(np.int16).max
+    dtype = np.int16 if np.abs(deltas).max(initial=0) <= limit else np.int32
+    sentinel = _sentinels[np.dtype(dtype)]
+
+    # Insertion des séparateurs entre polygones
+    breaks = np.cumsum([len(part) for part in parts])[:-1]
+    dx = np.insert(deltas[:, 0], breaks, 0).astype(dtype)
+    dy = np.insert(deltas[:, 1], breaks, 0).astype(dtype)
+    positions = breaks + np.arange(len(breaks))
+    dx[positions] = sentinel
+    dy[positions] = sentinel
+
+    return origin[0] * quantum, origin[1] * quantum, dx, dy
+
+
+def encode_display(displaySet, columns, quantum=defaultQuantum):
+    """
+        Prépare les colonnes de la source de données de la carte
+        Entrées :
+            - displaySet : DisplaySet des communes affichées (cf dataset.py)
+            - columns : colonnes attributaires à transmettre (infobulles, couleurs)
+            - quantum : pas de la grille (m)
+        Sorties :
+            - dictionnaire colonne -> valeurs, pour un ColumnDataSource
+    """
+    encoded = [encode_geometry(geometry, quantum) for geometry in displaySet.geometry]
+    data = {column: displaySet[column].to_numpy() for column in columns}
+    data["ox"] = np.array([elt[0] for elt in encoded], dtype=np.float64)
+    data["oy"] = np.array([elt[1] for elt in encoded], dtype=np.float64)
+    data["qx"] = [elt[2] for elt in encoded]
+    data["qy"] = [elt[3] for elt in encoded]
+    return data
+
+
+def encode_topology(topology, positions, displaySet, columns):
+    """
+        Prépare les colonnes de la source de données de la carte à partir de la topologie :
+        les arcs utilisés par les communes affichées ne sont transmis qu'une fois.
+        Entrées :
+            - topology : Topology de l'ensemble des communes
+            - positions : positions des communes affichées dans le jeu de données complet
+            - displaySet : DisplaySet des communes affichées (cf dataset.py)
+            - columns : colonnes attributaires à transmettre (infobulles, couleurs)
+        Sorties :
+            - dictionnaire colonne -> valeurs, pour un ColumnDataSource ;
+              la table des arcs est sous la clé "_arcs"
+    """
+    sentinel = _sentinels[np.dtype(np.int32)]
+
+    # Références d'arcs de chaque commune, contours séparés par la valeur sentinelle
+    featureRefs = []
+    for position in positions:
+        rings = topology.feature_rings(position)
+        refs = []
+        for ring in rings:
+            if refs:
+                refs.append(np.array([sentinel], dtype=np.int32))
+            refs.append(ring)
+        featureRefs.append(np.concatenate(refs) if refs else np.zeros(0, np.int32))
+
+    # Arcs utilisés, renumérotés localement
+    allRefs = np.concatenate(featureRefs) if featureRefs else np.zeros(0, np.int32)
+    allRefs = allRefs[allRefs != sentinel]
+    usedArcs = np.unique(np.where(allRefs >= 0, allRefs, ~allRefs))
+
+    def local(refs):
+        out = refs.copy()
+        valid = refs != sentinel
+        arcs = np.where(refs[valid] >= 0, refs[valid], ~refs[valid])
+        ids = np.searchsorted(usedArcs, arcs).astype(np.int32)
+        out[valid] = np.where(refs[valid] >= 0, ids, ~ids)
+        return out
+
+    # Points des arcs utilisés, mis bout à bout
+    starts = topology.arcOffsets[usedArcs]
+    lengths = topology.arcOffsets[usedArcs + 1] - starts
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    index = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    points = topology.coords[index].astype(np.int64)
+
+    # Ecarts entre points successifs d'un arc (le premier point de l'arc est transmis à part)
+    gridOrigin = points.min(axis=0) if len(points) else np.zeros(2, np.int64)
+    deltas = np.diff(points, axis=0, prepend=points[:1])
+    deltas[offsets[:-1]] = 0
+    limit = np.iinfo(np.int16).max
+    dtype = np.int16 if np.abs(deltas).max(initial=0) <= limit else np.int32
+    arcStarts = (points[offsets[:-1]] - gridOrigin).astype(np.int32)
+
+    data = {column: displaySet[column].to_numpy() for column in columns}
+    data["arcs"] = [local(refs) for refs in featureRefs]
+    data["_arcs"] = dict(x=[deltas[:, 0].astype(dtype)],
+                         y=[deltas[:, 1].astype(dtype)],
+                         sx=[arcStarts[:, 0]],
+                         sy=[arcStarts[:, 1]],
+                         offsets=[offsets.astype(np.int32)],
+                         gx=[float(gridOrigin[0] * topology.quantum)],
+                         gy=[float(gridOrigin[1] * topology.quantum)])
+    data["_quantum"] = topology.quantum
+    return data
+
+
+def create_geosource(data, quantum=defaultQuantum):
+    """
+        Crée la source de données de la carte et les transformations de décodage
+        Entrées :
+            - data : colonnes préparées par encode_display ou encode_topology
+            - quantum : pas de la grille utilisé à l'encodage (m)
+        Sorties :
+            - tuple (source, xs, ys) : source et spécifications des champs pour patches
+    """
+    if "_arcs" in data:
+        columns = {key: value for key, value in data.items() if not key.startswith("_")}
+        source = ColumnDataSource(data=columns)
+        arcs = ColumnDataSource(data=data["_arcs"])
+        xs = {'field': 'arcs', 'transform': CustomJSTransform(args=dict(arcs=arcs, axis='x', quantum=data["_quantum"]),
+                                                              v_func=_topologyDecoder)}
+        ys = {'field': 'arcs', 'transform': CustomJSTransform(args=dict(arcs=arcs, axis='y', quantum=data["_quantum"]),
+                                                              v_func=_topologyDecoder)}
+        return source, xs, ys
+
+    source = ColumnDataSource(data=data)
+    xs = {'field': 'qx', 'transform': CustomJSTransform(args=dict(source=source, axis='ox', quantum=quantum),
+                                                        v_func=_decoder)}
+    ys = {'field': 'qy', 'transform': CustomJSTransform(args=dict(source=source, axis='oy', quantum=quantum),
+                                                        v_func=_decoder)}
+    return source, xs, ys
+
+
+def payload_sizes(displaySet, quantum=defaultQuantum, topology=None):
+    """
+        Compare la taille (octets) du tracé transmis en GeoJSON, encodé et par arcs partagés
+        Sorties :
+            - dictionnaire (communes, points, geojson, encoded, topology)
+    """
+    geometry = displaySet.geometry
+    geojsonBytes = len(geometry.to_json().encode())
+
+    data = encode_display(displaySet, [], quantum)
+    encodedBytes = len(json.dumps(transform_column_source_data(data)).encode())
+    points = sum(len(ring.coords) for geom in geometry for ring in exterior_rings(geom))
+
+    sizes = dict(communes=len(displaySet), points=points, geojson=geojsonBytes, encoded=encodedBytes)
+    if topology is not None:
+        data = encode_topology(topology, displaySet.positions, displaySet, [])
+        sizes["topology"] = (len(json.dumps(transform_column_source_data({"arcs": data["arcs"]})).encode())
+                             + len(json.dumps(transform_column_source_data(data["_arcs"])).encode()))
+    return sizes
+
+
+if __name__ == '__main__':
+    from dataset import get_store
+
+    store = get_store()
+    ogCity = store.city(sys.argv[1])
+    for radius in sys.argv[2:]:
+        sizes = payload_sizes(store.select(ogCity, float(radius)), topology=store.topology)
+        print(f"{radius} km : {sizes['communes']} communes, {sizes['points']} points, "
+              f"GeoJSON {sizes['geojson'] / 1e3:.0f} ko, encodé {sizes['encoded'] / 1e3:.0f} ko "
+              f"(x{sizes['geojson'] / sizes['encoded']:.1f}), "
+              f"arcs partagés {sizes['topology'] / 1e3:.0f} ko (x{sizes['geojson'] / sizes['topology']:.1f})")
+
+    # Mémoire du tracé : les géométries shapely restent chargées (sélection, recherche du clic),
+    # la topologie s'y ajoute. Estimation des géométries : points de tous les contours (trous
+    # compris), stockés par GEOS en x, y, z (24 octets par point), hors en-têtes des objets.
+    geomPoints = sum(len(ring.coords) for geom in store.dataCities.geometry
+                     for polygon in getattr(geom, "geoms", [geom]) if not polygon.is_empty
+                     for ring in [polygon.exterior, *polygon.interiors])
+    geomBytes = 24 * geomPoints
+    print(f"Tracé en mémoire : géométries shapely ~{geomBytes / 1e6:.1f} Mo ({geomPoints} points) "
+          f"+ topologie {store.topology.nbytes / 1e6:.1f} Mo = ~{(geomBytes + store.topology.nbytes) / 1e6:.1f} Mo "
+          "(la topologie allège les données transmises, pas la mémoire du processus)")
+# %%
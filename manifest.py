@@ -0,0 +1,204 @@
+#%%
+"""
+    Manifeste du jeu de données assemblé (DATA/dataCities.json.manifest) et verrou de
+    construction, partagés par tous les processus servant l'application.
+
+    Le manifeste décrit le fichier assemblé : taille, date et empreinte de sa fin,
+    nombre de communes, schéma (colonne -> type), empreintes des fichiers sources et part
+    des communes sans taux après l'assemblage. Il est écrit après le fichier, une fois
+    celui-ci complet : un fichier sans manifeste correspondant est incomplet ou d'une
+    autre origine.
+
+    La vérification au chargement ne lit que quelques métadonnées et les derniers
+    tailBytes octets du fichier (temps constant) : un fichier tronqué ou remplacé est
+    détecté sans le relire entièrement.
+"""
+import os
+import json
+import time
+import hashlib
+from datetime import datetime
+
+# Version du format du manifeste
+manifestFormat = 1
+# Octets de fin du fichier assemblé couverts par l'empreinte du manifeste
+tailBytes = 1 << 16
+# Âge au-delà duquel un verrou de construction est considéré abandonné (s)
+lockTimeout = 1800
+
+
+def manifest_path(path):
+    return path + ".manifest"
+
+
+def file_hash(path, chunk=1 << 20):
+    """
+        Empreinte sha1 du contenu complet d'un fichier (fichiers sources, à la construction)
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(chunk), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_state(path):
+    """
+        Taille, date de modification et empreinte des tailBytes derniers octets d'un fichier
+    """
+    info = os.stat(path)
+    with open(path, "rb") as file:
+        file.seek(max(info.st_size - tailBytes, 0))
+        tail = hashlib.sha1(file.read()).hexdigest()
+    return {"size": info.st_size, "mtime_ns": info.st_mtime_ns, "tail_sha1": tail}
+
+
+def source_state(path):
+    # Taille et date (comparées au chargement), empreinte du contenu (traçabilité)
+    info = os.stat(path)
+    return {"size": info.st_size, "mtime_ns": info.st_mtime_ns, "sha1": file_hash(path)}
+
+
+def create_manifest(path, dataCities, sources, unmatched):
+    """
+        Manifeste du fichier assemblé path, une fois écrit
+        Entrées :
+            - path : fichier assemblé (complet)
+            - dataCities : geoDataFrame écrit dans path
+            - sources : fichiers sources de l'assemblage
+            - unmatched : part des communes sans taux, par impôt
+        Sorties :
+            - dictionnaire (sérialisable en JSON)
+    """
+    return {"format": manifestFormat,
+            "built": datetime.now().isoformat(timespec="seconds"),
+            "file": file_state(path),
+            "rows": len(dataCities),
+            "schema": {str(column): str(dtype) for column, dtype in dataCities.dtypes.items()},
+            "sources": {source: source_state(source) for source in sources if os.path.exists(source)},
+            "unmatched": unmatched}
+
+
+def read_manifest(path):
+    """
+        Manifeste du fichier assemblé path, ou None s'il est absent, illisible ou d'un autre format
+    """
+    try:
+        with open(manifest_path(path), encoding="utf-8") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get("format") != manifestFormat:
+        return None
+    return manifest
+
+
+def manifest_version(manifest):
+    """
+        Identifiant court du jeu de données décrit par le manifeste (empreinte et date de
+        construction) : inchangé par une copie du fichier, utilisé pour les caches dérivés
+        (topologie, graphe d'adjacence) et les caches HTTP
+    """
+    if manifest is None:
+        return None
+    key = f"{manifest['file']['tail_sha1']}-{manifest['built']}"
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def manifest_matches(path, manifest):
+    """
+        Vrai si le fichier assemblé path est bien celui décrit par le manifeste
+        (taille et empreinte de la fin : une copie qui change la date reste valide)
+    """
+    if manifest is None:
+        return False
+    try:
+        state, recorded = file_state(path), manifest["file"]
+        return (state["size"], state["tail_sha1"]) == (recorded["size"], recorded["tail_sha1"])
+    except (OSError, KeyError):
+        return False
+
+
+def sources_changed(manifest, sources):
+    """
+        Vrai si un fichier source a changé depuis la construction décrite. Taille et date
+        suffisent le plus souvent ; si seule la date diffère (copie, déploiement), le contenu
+        est comparé à son empreinte.
+    """
+    recorded = manifest.get("sources", {})
+    for source in sources:
+        if not os.path.exists(source):
+            continue
+        info = os.stat(source)
+        state = recorded.get(source)
+        if state is None or state["size"] != info.st_size:
+            return True
+        if state["mtime_ns"] != info.st_mtime_ns and file_hash(source) != state["sha1"]:
+            return True
+    return False
+
+
+def write_json_atomic(path, content):
+    """
+        Écrit un fichier JSON sous un nom temporaire, puis le substitue d'un coup
+    """
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "w", encoding="utf-8") as file:
+        json.dump(content, file, indent=1)
+    os.replace(temp, path)
+
+
+class BuildLock:
+    """
+        Verrou inter-processus de construction du jeu de données (fichier path.lock, créé
+        de façon exclusive) : un seul processus écrit le fichier assemblé à la fois.
+        Un verrou plus ancien que lockTimeout (processus interrompu) est supprimé.
+        S'utilise avec with ; acquire(False) renvoie False si le verrou est déjà pris.
+    """
+
+    def __init__(self, path):
+        self.path = path + ".lock"
+
+    def held(self):
+        # Verrou pris par un processus (abandonné ou non)
+        return os.path.exists(self.path)
+
+    def acquire(self, blocking=True, timeout=lockTimeout, interval=1):
+        start = time.monotonic()
+        while True:
+            try:
+                handle = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(handle, str(os.getpid()).encode())
+                os.close(handle)
+                return True
+            except FileExistsError:
+                # Verrou abandonné supprimé : nouvel essai immédiat
+                if self.clear_stale():
+                    continue
+            if not blocking or time.monotonic() - start > timeout:
+                return False
+            time.sleep(interval)
+
+    def clear_stale(self):
+        # Vrai si un verrou abandonné a été supprimé
+        try:
+            if time.time() - os.stat(self.path).st_mtime > lockTimeout:
+                os.remove(self.path)
+                return True
+        except OSError:
+            pass
+        return False
+
+    def release(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        if not self.acquire():
+            raise TimeoutError(f"verrou {self.path} toujours pris après {lockTimeout} s")
+        return self
+
+    def __exit__(self, *args):
+        self.release()
@@ -0,0 +1,81 @@
+#%%
+import unicodedata
+from bisect import bisect_left
+
+import numpy as np
+
+
+def normalize(text):
+    """
+        Forme normalisée d'un nom pour la recherche : sans accents, en minuscules,
+        tirets et apostrophes remplacés par des espaces.
+        ex : "Saint-Étienne" -> "saint etienne"
+    """
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    for sep in "-'’":
+        text = text.replace(sep, " ")
+    return " ".join(text.lower().split())
+
+
+class SearchIndex:
+    """
+        Index de recherche des communes par préfixe du nom ou du code insee.
+        Les clés normalisées sont triées une fois pour toutes : une recherche est
+        une dichotomie sur le préfixe suivie de la lecture des premiers résultats,
+        sans parcours de la table.
+        Classement des résultats :
+            1. nom (ou code insee) commençant par le texte, correspondance exacte en tête
+            2. un des mots suivants du nom commençant par le texte ("denis" -> Saint-Denis)
+    """
+
+    def __init__(self, dataCities):
+        noms = dataCities["nom"].tolist()
+        codes = dataCities["insee"].tolist()
+
+        nameKeys, nameRows = [], []
+        wordKeys, wordRows = [], []
+        for pos, (nom, insee) in enumerate(zip(noms, codes)):
+            key = normalize(nom)
+            nameKeys += [key, insee.lower()]
+            nameRows += [pos, pos]
+            # Mots suivants du nom ("saint denis" -> "denis")
+            words = key.split(" ")
+            for i in range(1, len(words)):
+                wordKeys.append(" ".join(words[i:]))
+                wordRows.append(pos)
+
+        self.nameKeys, self.nameRows = self._sort(nameKeys, nameRows)
+        self.wordKeys, self.wordRows = self._sort(wordKeys, wordRows)
+
+    @staticmethod
+    def _sort(keys, rows):
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        return [keys[i] for i in order], np.array(rows, dtype=np.int64)[order]
+
+    @staticmethod
+    def _prefix_range(keys, prefix):
+        return bisect_left(keys, prefix), bisect_left(keys, prefix + "\uffff")
+
+    def search(self, text, limit=10):
+        """
+            Recherche des communes dont le nom ou le code insee commence par text
+            Entrées :
+                - text : texte saisi (casse et accents indifférents)
+                - limit : nombre maximal de résultats
+            Sortie :
+                - liste des positions des communes dans le jeu de données, par pertinence
+        """
+        prefix = normalize(text)
+        if not prefix:
+            return []
+
+        results = []
+        for keys, rows in ((self.nameKeys, self.nameRows), (self.wordKeys, self.wordRows)):
+            start, end = self._prefix_range(keys, prefix)
+            for pos in rows[start:end]:
+                if pos not in results:
+                    results.append(int(pos))
+                    if len(results) == limit:
+                        return results
+        return results
@@ -0,0 +1,92 @@
+#%%
+"""
+    Simulation du montant des impôts locaux d'un logement, à partir de sa valeur
+    locative cadastrale (VLC, en €/an) et des taux de chaque commune :
+        - taxe d'habitation : VLC x taux
+        - taxe foncière : 50 % de la VLC (abattement légal) x taux
+    Estimation hors abattements de taxe d'habitation, exonérations et frais de gestion.
+
+    Les montants de toutes les communes, de tous les impôts et de toutes les années sont
+    calculés en une opération sur la matrice des taux.
+"""
+import numpy as np
+import pandas as pd
+
+from dataset import create_displayParam, data_yr, dict_imp
+
+# Part de la valeur locative cadastrale retenue dans la base de chaque impôt
+dict_base = {"TauxTH_": 1.0,
+             "TauxTF_": 0.5
+        }
+# Valeur locative cadastrale par défaut et maximale (€/an)
+defaultVLC = 3000
+maxVLC = 100000
+
+
+def amount_columns(impots=None, years=data_yr):
+    """
+        Montants simulés : (colonne du taux, colonne du montant, part de la VLC retenue)
+    """
+    impots = list(dict_imp.values()) if impots is None else impots
+    return [(create_displayParam(impot, year), create_displayParam(impot, year, 'montant'), dict_base[impot])
+            for impot in impots for year in years]
+
+
+def tax_amounts(rates, bases, vlc):
+    """
+        Montants estimés (€) pour une valeur locative cadastrale
+        Entrées :
+            - rates : taux (%), tableau (communes, colonnes)
+            - bases : part de la VLC retenue pour chaque colonne (cf dict_base)
+            - vlc : valeur locative cadastrale (€/an)
+        Sorties :
+            - tableau des montants, de même forme que rates
+    """
+    return np.round(rates * (np.asarray(bases) * vlc / 100), 2)
+
+
+def simulate(dataCities, positions, vlc, impots=None, years=data_yr):
+    """
+        Montants estimés de chaque impôt et de chaque année pour des communes
+        Entrées :
+            - dataCities : geoDataFrame de toutes les communes
+            - positions : positions des communes (None : toutes)
+            - vlc : valeur locative cadastrale (€/an)
+            - impots : préfixes des impôts simulés (None : tous)
+            - years : années simulées
+        Sorties :
+            - dictionnaire colonne du montant -> montants alignés sur positions
+    """
+    columns = amount_columns(impots, years)
+    # Matrice des taux (communes, colonnes), seules les communes demandées sont lues
+    rates = [dataCities[rate].to_numpy(dtype=np.float64) for rate, _, _ in columns]
+    rates = np.column_stack([elt if positions is None else elt[positions] for elt in rates])
+    amounts = tax_amounts(rates, [base for _, _, base in columns], vlc)
+    return {amount: amounts[:, i] for i, (_, amount, _) in enumerate(columns)}
+
+
+def with_amounts(displaySet, ogCity, vlc):
+    """
+        Ajoute les montants estimés aux communes décrites et à la commune sélectionnée
+        Sorties :
+            - DisplaySet avec les colonnes de montant (cf DisplaySet.with_columns)
+            - copie de ogCity avec ses montants
+    """
+    displaySet = displaySet.with_columns(simulate(displaySet.dataCities, displaySet.positions, vlc))
+    ogCity = ogCity.copy()
+    for rate, amount, base in amount_columns():
+        ogCity[amount] = tax_amounts(np.float64(ogCity[rate]), base, vlc)
+    return displaySet, ogCity
+
+
+def simulation_table(dataCities, vlc, positions=None):
+    """
+        Tableau des montants estimés (une ligne par commune) : insee, nom, Code_DEP, montants
+    """
+    if positions is None:
+        positions = np.arange(len(dataCities))
+    table = pd.DataFrame({column: dataCities[column].to_numpy()[positions]
+                          for column in ("insee", "nom", "Code_DEP")})
+    for column, values in simulate(dataCities, positions, vlc).items():
+        table[column] = values
+    return table
@@ -0,0 +1,134 @@
+#%%
+"""
+    Surface lissée des taux : moyenne pondérée par la distance des taux des communes
+    voisines, calculée aux centres d'une grille régulière couvrant la zone affichée.
+    Les communes aux taux extrêmes mais de petite taille ne dominent plus la carte.
+
+    Pondération (bandwidth : largeur de lissage, en km) :
+        - gauss : noyau gaussien exp(-d² / 2 bandwidth²), tronqué à 3 bandwidth
+        - idw : inverse du carré de la distance, jusqu'à bandwidth
+
+    Les paires (commune, point de grille) à moins de la distance de troncature sont
+    obtenues en une requête entre le KD-tree des centroïdes (cf centroids.py) et celui
+    des points de grille ; toutes les communes y participent, y compris hors de la zone
+    affichée (pas d'effet de bord).
+"""
+from functools import lru_cache
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from dataset import on_reload
+from classify import fixed_classes
+
+# modes de pondération (libellé affiché -> mode)
+dict_kernel = {"Gaussienne": "gauss", "Inverse de la distance": "idw"}
+defaultKernel = "gauss"
+# largeur de lissage maximale (km)
+maxBandwidth = 20
+# nombre de cellules de la grille sur le plus grand côté de la zone
+gridCells = 150
+# troncature du noyau gaussien (en largeurs de lissage)
+gaussCutoff = 3
+
+
+def surface_grid(bounds, bandwidth, cells=gridCells):
+    """
+        Grille régulière couvrant une emprise
+        Les cellules ne descendent pas sous le quart de la largeur de lissage : une
+        surface plus lisse n'a pas besoin d'une grille plus fine, et le nombre de paires
+        (commune, point de grille) reste proportionnel au nombre de communes.
+        Entrées :
+            - bounds : (xmin, ymin, xmax, ymax) en m
+            - bandwidth : largeur de lissage (m)
+            - cells : nombre de cellules sur le plus grand côté
+        Sorties :
+            - abscisses et ordonnées des centres des cellules, taille d'une cellule
+    """
+    xmin, ymin, xmax, ymax = bounds
+    cell = max(xmax - xmin, ymax - ymin, 1) / cells
+    cell = max(cell, bandwidth / 4)
+    nx = max(int(np.ceil((xmax - xmin) / cell)), 1)
+    ny = max(int(np.ceil((ymax - ymin) / cell)), 1)
+    return xmin + (np.arange(nx) + 0.5) * cell, ymin + (np.arange(ny) + 0.5) * cell, cell
+
+
+def kernel_weights(dist, bandwidth, kernel, cell):
+    """
+        Poids des communes selon leur distance au point de grille
+    """
+    if kernel == "idw":
+        # distance minimale d'une demi-cellule (commune au centre de la cellule)
+        return 1 / np.maximum(dist, cell / 2) ** 2
+    return np.exp(-0.5 * (dist / bandwidth) ** 2)
+
+
+def smooth_surface(centroids, values, bounds, bandwidth, kernel=defaultKernel, cells=gridCells):
+    """
+        Surface lissée d'un paramètre sur une emprise
+        Entrées :
+            - centroids : centroïdes de toutes les communes (cf centroids.py)
+            - values : valeurs du paramètre de toutes les communes (NaN : sans valeur)
+            - bounds : emprise de la surface (xmin, ymin, xmax, ymax), en m
+            - bandwidth : largeur de lissage (km)
+            - kernel : mode de pondération (valeur de dict_kernel)
+            - cells : nombre de cellules sur le plus grand côté de la grille
+        Sorties :
+            - dictionnaire (image, x, y, dw, dh) : valeurs lissées (ny, nx), la première
+              ligne étant au sud, NaN pour une cellule sans commune à portée ; position et
+              dimensions de l'image
+    """
+    bandwidth = bandwidth * 1000
+    xs, ys, cell = surface_grid(bounds, bandwidth, cells)
+    gridX, gridY = np.meshgrid(xs, ys)
+    grid = np.column_stack([gridX.ravel(), gridY.ravel()])
+
+    # Paires (commune, point de grille) à portée du noyau, avec leur distance
+    cutoff = bandwidth * gaussCutoff if kernel == "gauss" else bandwidth
+    pairs = centroids.tree.sparse_distance_matrix(cKDTree(grid), cutoff, output_type="ndarray")
+    city, point, dist = pairs["i"], pairs["j"], pairs["v"]
+    valid = ~np.isnan(values[city])
+    city, point, dist = city[valid], point[valid], dist[valid]
+
+    weights = kernel_weights(dist, bandwidth, kernel, cell)
+    total = np.bincount(point, weights=weights * values[city], minlength=len(grid))
+    weightSum = np.bincount(point, weights=weights, minlength=len(grid))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        image = np.where(weightSum > 0, total / weightSum, np.nan)
+
+    return dict(image=image.reshape(gridX.shape),
+                x=xs[0] - cell / 2, y=ys[0] - cell / 2,
+                dw=len(xs) * cell, dh=len(ys) * cell)
+
+
+@lru_cache(maxsize=128)
+def cached_surface(store, bounds, displayParam, bandwidth, kernel):
+    """
+        Surface lissée d'un paramètre, calculée une fois par (emprise, paramètre, largeur,
+        pondération) : revenir à une année ou à une zone déjà vue ne la recalcule pas
+    """
+    values = store.dataCities[displayParam].to_numpy(dtype=np.float64)
+    return smooth_surface(store.centroids, values, bounds, bandwidth, kernel)
+
+
+# Les surfaces calculées sur l'ancien jeu de données ne servent plus après un rechargement
+on_reload(cached_surface.cache_clear)
+
+
+def display_surface(store, displaySet, displayParam, bandwidth, kernel=defaultKernel):
+    """
+        Surface lissée de la zone affichée, ou None si le lissage est désactivé
+        (largeur nulle) ou sans objet (indices à classes fixes, cf classify.py ;
+        colonnes calculées pour la session, absentes du jeu de données)
+        Entrées :
+            - store : jeu de données et index (cf dataset.DataStore)
+            - displaySet : DisplaySet des communes affichées
+            - displayParam : paramètre affiché
+            - bandwidth : largeur de lissage (km)
+            - kernel : mode de pondération (valeur de dict_kernel)
+    """
+    if bandwidth <= 0 or fixed_classes(displayParam) is not None or displayParam not in store.dataCities.columns:
+        return None
+    # Emprise arrondie à 100 m, pour retrouver la surface d'une même zone dans le cache
+    bounds = tuple(float(elt) for elt in np.round(displaySet.total_bounds, -2))
+    return cached_surface(store, bounds, displayParam, bandwidth, kernel)
@@ -0,0 +1,33 @@
+#%%
+"""
+    Voisinage à k rangs comparé à un parcours en largeur élémentaire
+"""
+import numpy as np
+
+from adjacency import Adjacency
+
+
+def random_graph(n, edges, rng):
+    first = rng.integers(0, n, edges)
+    second = rng.integers(0, n, edges)
+    pairs = {(a, b) for a, b in zip(first, second) if a != b}
+    pairs |= {(b, a) for a, b in pairs}
+    neighbours = [sorted(b for a, b in pairs if a == i) for i in range(n)]
+    indptr = np.concatenate([[0], np.cumsum([len(elt) for elt in neighbours])]).astype(np.int64)
+    indices = np.array([b for elt in neighbours for b in elt], dtype=np.int32)
+    return Adjacency(indptr, indices), neighbours
+
+
+def brute_force_k_hop(neighbours, position, hops):
+    reached = {position}
+    for _ in range(hops):
+        reached |= {other for current in reached for other in neighbours[current]}
+    return sorted(reached)
+
+
+def test_k_hop_matches_brute_force():
+    rng = np.random.default_rng(1)
+    adjacency, neighbours = random_graph(60, 90, rng)
+    for position in range(len(adjacency)):
+        for hops in range(5):
+            assert adjacency.k_hop(position, hops).tolist() == brute_force_k_hop(neighbours, position, hops)
@@ -0,0 +1,94 @@
+#%%
+"""
+    Réponses JSON de l'API : ETag, 304 et réponses conservées en mémoire (cf api.cached_json)
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from flask import Flask
+
+import api
+
+
+class FakeStore:
+    def __init__(self, version):
+        self.version = version
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Application minimale : une route dont on compte les calculs
+    store = FakeStore("v1")
+    calls = []
+    monkeypatch.setattr(api, "get_store", lambda: store)
+    api.clear_responses()
+
+    app = Flask(__name__)
+
+    @app.route("/values")
+    def values():
+        def compute(current):
+            calls.append(current.version)
+            return {"version": current.version, "n": int(api.request.args.get("n", 1))}
+        return api.cached_json(compute)
+
+    yield app.test_client(), store, calls
+    api.clear_responses()
+
+
+def test_etag_and_not_modified(client):
+    test, _, calls = client
+    first = test.get("/values?n=3")
+    assert first.status_code == 200
+    assert first.get_json()["n"] == 3
+    assert first.headers["X-Dataset-Version"] == "v1"
+    assert "max-age" in first.headers["Cache-Control"]
+
+    again = test.get("/values?n=3", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304 and again.data == b""
+    assert again.headers["ETag"] == first.headers["ETag"]
+    assert calls == ["v1"]
+
+
+def test_memo_serves_same_bytes(client):
+    test, _, calls = client
+    first = test.get("/values?n=3")
+    second = test.get("/values?n=3")
+    assert second.data == first.data and calls == ["v1"]
+    # Autre requête : autre ETag, nouveau calcul
+    other = test.get("/values?n=4")
+    assert other.headers["ETag"] != first.headers["ETag"] and len(calls) == 2
+
+
+def test_new_version_changes_etag(client):
+    test, store, calls = client
+    first = test.get("/values")
+    store.version = "v2"
+    second = test.get("/values", headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 200
+    assert second.get_json()["version"] == "v2"
+    assert calls == ["v1", "v2"]
+
+
+def test_memo_is_bounded_in_bytes(client, monkeypatch):
+    test, _, calls = client
+    size = len(test.get("/values?n=1").data)
+    monkeypatch.setattr(api, "cacheBytes", 2 * size)
+    for n in range(2, 6):
+        test.get(f"/values?n={n}")
+    assert api._responsesBytes <= 2 * size and len(api._responses) == 2
+    # La plus ancienne a été évincée : recalculée
+    calls.clear()
+    test.get("/values?n=1")
+    assert calls == ["v1"]
+
+    # Réponse trop grosse : jamais conservée
+    monkeypatch.setattr(api, "cacheEntryBytes", size - 1)
+    api.clear_responses()
+    test.get("/values?n=1")
+    assert len(api._responses) == 0
+
+
+def test_describe_city_without_department():
+    city = pd.Series({"insee": "01001", "nom": "A", "Code_DEP": np.nan})
+    assert api.describe_city(city) == {"insee": "01001", "nom": "A", "Code_DEP": None}
@@ -0,0 +1,45 @@
+#%%
+"""
+    I de Moran comparé à un calcul à la main
+"""
+import numpy as np
+
+from adjacency import Adjacency
+from autocorr import Weights, autocorrelation, moran
+
+
+def path_graph(n):
+    # Communes alignées : i voisine de i - 1 et de i + 1
+    neighbours = [[j for j in (i - 1, i + 1) if 0 <= j < n] for i in range(n)]
+    indptr = np.concatenate([[0], np.cumsum([len(elt) for elt in neighbours])])
+    return Adjacency(indptr, np.concatenate(neighbours).astype(np.int32))
+
+
+def test_moran_path_by_hand():
+    # Valeurs 1, 2, 3, 4 sur un chemin : z = -1.5, -0.5, 0.5, 1.5
+    # Décalages spatiaux (poids normalisés par ligne) : -0.5, -0.5, 0.5, 0.5
+    # I = n / S0 * sum(z * lag) / sum(z²) = 4 / 4 * (0.75 + 0.25 + 0.25 + 0.75) / 5 = 0.4
+    adjacency = path_graph(4)
+    weights = Weights.from_adjacency(adjacency, np.arange(4))
+    moranI, _ = moran(np.array([1.0, 2.0, 3.0, 4.0]), weights)
+    assert np.isclose(moranI, 0.4)
+
+
+def test_moran_alternating_values():
+    # Valeurs alternées -1, 1, -1, 1, -1, 1 : lag = 1, -1, 1, -1, 1, -1, soit z * lag = -1
+    # pour chaque commune et I = -1
+    adjacency = path_graph(6)
+    result = autocorrelation(np.array([-1.0, 1, -1, 1, -1, 1]), adjacency)
+    assert np.isclose(result["moranI"], -1)
+    assert result["n"] == 6
+
+
+def test_missing_values_are_dropped():
+    # La commune sans valeur est retirée du graphe : il reste le chemin 0 - 1 et la commune 3 isolée
+    adjacency = path_graph(4)
+    result = autocorrelation(np.array([1.0, 2.0, np.nan, 4.0]), adjacency)
+    # z = -4/3, -1/3, 5/3 ; lag = -1/3, -4/3, 0 ; S0 = 2 communes reliées
+    # I = 3 / 2 * (4/9 + 4/9) / (16/9 + 1/9 + 25/9) = 3 / 2 * 8 / 42
+    assert np.isclose(result["moranI"], 3 / 2 * 8 / 42)
+    assert result["n"] == 3
+    assert np.isnan(result["lisaZ"][2])
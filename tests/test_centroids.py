@@ -0,0 +1,56 @@
+#%%
+"""
+    Communes les plus proches dans un masque comparées à un tri de toutes les distances
+"""
+import geopandas as gpd
+import numpy as np
+
+import centroids
+from centroids import Centroids
+
+
+def random_points(n, rng):
+    xy = rng.uniform(0, 100000, (n, 2))
+    return gpd.GeoDataFrame(geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs="EPSG:3857"), xy
+
+
+def brute_force(xy, position, mask, k):
+    found = np.flatnonzero(mask)
+    dist = np.hypot(*(xy[found] - xy[position]).T)
+    order = np.argsort(dist)[:k]
+    return found[order], dist[order]
+
+
+def test_nearest_where_matches_brute_force():
+    rng = np.random.default_rng(2)
+    dataCities, xy = random_points(2000, rng)
+    points = Centroids(dataCities)
+    # Masques denses (KD-tree) et rares (calcul direct), k plus grand que le masque compris
+    for share in (0.5, 0.1, 0.01, 0.002):
+        mask = rng.random(len(xy)) < share
+        for position in rng.integers(0, len(xy), 10):
+            for k in (1, 5, 20):
+                found, dist = points.nearest_where(position, mask, k)
+                expected, expectedDist = brute_force(xy, position, mask, k)
+                assert found.tolist() == expected.tolist()
+                assert np.allclose(dist, expectedDist)
+
+
+def test_nearest_where_brute_force_path(monkeypatch):
+    # Sans KD-tree (bruteFraction nulle), même résultat
+    rng = np.random.default_rng(3)
+    dataCities, xy = random_points(300, rng)
+    points = Centroids(dataCities)
+    mask = rng.random(len(xy)) < 0.5
+    monkeypatch.setattr(centroids, "bruteFraction", 0)
+    found, dist = points.nearest_where(7, mask, 10)
+    expected, expectedDist = brute_force(xy, 7, mask, 10)
+    assert found.tolist() == expected.tolist()
+    assert np.allclose(dist, expectedDist)
+
+
+def test_nearest_where_empty_mask():
+    rng = np.random.default_rng(4)
+    dataCities, _ = random_points(50, rng)
+    found, dist = Centroids(dataCities).nearest_where(0, np.zeros(50, dtype=bool), 5)
+    assert len(found) == 0 and len(dist) == 0
@@ -0,0 +1,38 @@
+#%%
+"""
+    Seuils de Jenks comparés à une recherche exhaustive sur de petits échantillons
+"""
+from itertools import combinations
+
+import numpy as np
+
+from classify import jenks_breaks
+
+
+def total_ssd(values, starts):
+    # Somme des carrés des écarts à la moyenne de chaque classe (values triées)
+    bounds = [0] + list(starts) + [len(values)]
+    return sum(((values[a:b] - values[a:b].mean()) ** 2).sum() for a, b in zip(bounds[:-1], bounds[1:]))
+
+
+def brute_force_ssd(values, nClasses):
+    return min(total_ssd(values, starts) for starts in combinations(range(1, len(values)), nClasses - 1))
+
+
+def test_jenks_matches_brute_force():
+    rng = np.random.default_rng(0)
+    for size in (5, 8, 11):
+        for nClasses in (2, 3, 4):
+            values = np.sort(rng.lognormal(size=size))
+            breaks = jenks_breaks(values, nClasses)
+            # Chaque seuil intérieur est la première valeur de sa classe
+            starts = np.searchsorted(values, breaks[1:-1])
+            assert breaks[0] == values[0] and breaks[-1] == values[-1]
+            assert np.isclose(total_ssd(values, starts), brute_force_ssd(values, nClasses))
+
+
+def test_jenks_more_classes_than_values():
+    breaks = jenks_breaks(np.array([3.0, 1.0, 2.0]), 5)
+    assert len(breaks) == 6
+    assert np.all(np.diff(breaks) >= 0)
+    assert breaks[0] == 1 and breaks[-1] == 3
@@ -0,0 +1,38 @@
+#%%
+"""
+    Statistiques par lot (prefix_stats) comparées aux statistiques du panneau d'information
+    (compute_stats) sur chaque début de sélection
+"""
+import numpy as np
+import pandas as pd
+
+from dataset import DisplaySet, compute_stats
+from engine import prefix_stats, statNames
+
+param = "TauxTH_2018"
+
+
+def test_prefix_stats_matches_compute_stats():
+    rng = np.random.default_rng(5)
+    values = np.round(rng.uniform(5, 40, 200), 2)
+    values[rng.random(200) < 0.15] = np.nan
+    values[:3] = np.nan
+    dataCities = pd.DataFrame({param: values})
+    # Communes triées par distance : un ordre quelconque du jeu de données, qui commence
+    # par trois communes sans valeur (débuts de sélection vides compris)
+    order = np.concatenate([[0, 1, 2], 3 + rng.permutation(len(values) - 3)])
+    counts = np.array([0, 1, 2, 3, 4, 5, 10, 57, 133, 200])
+
+    batch = prefix_stats(values[order], counts)
+    for count, row in zip(counts, batch):
+        stats = compute_stats(DisplaySet(dataCities, order[:count]), [param])
+        assert list(stats.index) == statNames
+        expected = stats.iloc[:, 0].to_numpy(dtype=np.float64)
+        assert np.allclose(np.round(row, 2), expected, equal_nan=True), count
+
+
+def test_prefix_stats_single_value():
+    # Une seule valeur : écart-type indéfini (ddof=1), comme describe
+    mean, std, vmin, median, vmax = prefix_stats(np.array([np.nan, 7.0, np.nan]), np.array([3]))[0]
+    assert (mean, vmin, median, vmax) == (7, 7, 7, 7)
+    assert np.isnan(std)
@@ -0,0 +1,87 @@
+#%%
+"""
+    Export par morceaux : un morceau par bloc de communes, fichier complet valide
+    dans chaque format
+"""
+import io
+import json
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+import export
+from dataset import DisplaySet
+from export import export_columns, iter_export
+
+
+def communes(n):
+    # n communes carrées alignées près de Paris (EPSG:3857), un taux sur dix manquant
+    rng = np.random.default_rng(6)
+    columns = export_columns()
+    frame = {"insee": [f"{75000 + i:05d}" for i in range(n)],
+             "nom": [f"Commune {i}, \"test\"" for i in range(n)],
+             "Code_DEP": ["75"] * n}
+    for column in columns[3:]:
+        values = np.round(rng.uniform(5, 40, n), 2)
+        values[rng.random(n) < 0.1] = np.nan
+        frame[column] = values
+    squares = [box(260000 + 100 * i, 6250000, 260000 + 100 * (i + 1), 6250100) for i in range(n)]
+    return gpd.GeoDataFrame(frame, geometry=squares, crs="EPSG:3857")
+
+
+def selection(dataCities, n=None):
+    positions = np.arange(len(dataCities) if n is None else n)[::-1].copy()
+    return DisplaySet(dataCities, positions)
+
+
+def test_csv_streamed_by_blocks():
+    dataCities = communes(2 * export.exportChunk + 17)
+    displaySet = selection(dataCities)
+    chunks = list(iter_export(displaySet, "csv"))
+    # En-tête, puis un morceau par bloc
+    assert len(chunks) == 1 + 3
+    frame = pd.read_csv(io.StringIO("".join(chunks)), dtype={"insee": str, "Code_DEP": str})
+    expected = displaySet[export_columns()]
+    pd.testing.assert_frame_equal(frame, expected, check_dtype=False)
+
+
+def test_geojson_valid_with_geometry():
+    dataCities = communes(export.exportChunk + 3)
+    displaySet = selection(dataCities)
+    chunks = list(iter_export(displaySet, "geojson", geometry=True))
+    assert len(chunks) == 2 + 2
+    content = json.loads("".join(chunks))
+    features = content["features"]
+    assert [feature["properties"]["insee"] for feature in features] == list(displaySet["insee"])
+    # NaN transmis en null
+    column = export_columns()[3]
+    missing = displaySet[column].isna().to_numpy()
+    assert [feature["properties"][column] is None for feature in features] == list(missing)
+    # Tracé en WGS84
+    lon, lat = np.array(features[0]["geometry"]["coordinates"][0]).T
+    assert (2 < lon).all() and (lon < 3).all() and (48 < lat).all() and (lat < 49).all()
+
+
+def test_empty_selection():
+    dataCities = communes(5)
+    empty = DisplaySet(dataCities, np.array([], dtype=np.int64))
+    assert json.loads("".join(iter_export(empty, "geojson"))) == {"type": "FeatureCollection", "features": []}
+    assert "".join(iter_export(empty, "csv")).strip() == ",".join(export_columns())
+
+
+def test_parquet_row_groups():
+    pq = pytest.importorskip("pyarrow.parquet")
+    dataCities = communes(export.exportChunk + 3)
+    displaySet = selection(dataCities)
+    content = b"".join(iter_export(displaySet, "parquet", geometry=True))
+    parquet = pq.ParquetFile(io.BytesIO(content))
+    assert parquet.metadata.num_row_groups == 2
+    table = parquet.read().to_pandas()
+    assert list(table["insee"]) == list(displaySet["insee"])
+    assert table["geometry"].map(len).gt(0).all()
+
+    empty = DisplaySet(dataCities, np.array([], dtype=np.int64))
+    assert pq.read_table(io.BytesIO(b"".join(iter_export(empty, "parquet")))).num_rows == 0
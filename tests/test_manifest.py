@@ -0,0 +1,122 @@
+#%%
+"""
+    Manifeste du jeu de données assemblé et verrou de construction
+"""
+import os
+import shutil
+import time
+
+import pandas as pd
+
+import manifest
+from manifest import (BuildLock, create_manifest, manifest_matches, manifest_path, manifest_version,
+                      read_manifest, sources_changed, write_json_atomic)
+
+
+def write(path, content):
+    with open(path, "wb") as file:
+        file.write(content)
+
+
+def built(tmp_path):
+    # Fichier assemblé, une source et le manifeste correspondant
+    path, source = str(tmp_path / "data.json"), str(tmp_path / "source.csv")
+    write(path, b"x" * (manifest.tailBytes + 1000))
+    write(source, b"a,b\n1,2\n")
+    frame = pd.DataFrame({"insee": ["01001", "01002"], "TauxTH_2018": [10.0, 12.5]})
+    write_json_atomic(manifest_path(path), create_manifest(path, frame, [source], {"TH": 0.0}))
+    return path, source
+
+
+def test_manifest_matches_file(tmp_path):
+    path, _ = built(tmp_path)
+    recorded = read_manifest(path)
+    assert recorded["rows"] == 2
+    assert recorded["schema"] == {"insee": "object", "TauxTH_2018": "float64"}
+    assert manifest_matches(path, recorded)
+
+
+def test_truncated_or_replaced_file_detected(tmp_path):
+    path, _ = built(tmp_path)
+    recorded = read_manifest(path)
+    with open(path, "r+b") as file:
+        file.truncate(manifest.tailBytes)
+    assert not manifest_matches(path, recorded)
+    # Même taille, fin différente
+    write(path, b"x" * (manifest.tailBytes + 999) + b"y")
+    assert not manifest_matches(path, recorded)
+
+
+def test_copy_keeps_manifest_and_version(tmp_path):
+    path, _ = built(tmp_path)
+    copy = str(tmp_path / "copy.json")
+    shutil.copyfile(path, copy)
+    shutil.copyfile(manifest_path(path), manifest_path(copy))
+    os.utime(copy, (time.time() + 100, time.time() + 100))
+    assert manifest_matches(copy, read_manifest(copy))
+    assert manifest_version(read_manifest(copy)) == manifest_version(read_manifest(path))
+
+
+def test_missing_or_foreign_manifest(tmp_path):
+    path = str(tmp_path / "data.json")
+    write(path, b"{}")
+    assert read_manifest(path) is None and manifest_version(None) is None
+    assert not manifest_matches(path, None)
+    write(manifest_path(path), b'{"format": 0}')
+    assert read_manifest(path) is None
+    write(manifest_path(path), b"{tronqu")
+    assert read_manifest(path) is None
+
+
+def test_sources_changed(tmp_path):
+    path, source = built(tmp_path)
+    recorded = read_manifest(path)
+    assert not sources_changed(recorded, [source])
+    # Date seule modifiée (copie) : contenu identique
+    os.utime(source, (time.time() + 100, time.time() + 100))
+    assert not sources_changed(recorded, [source])
+    # Même taille, contenu différent
+    write(source, b"a,b\n1,3\n")
+    assert sources_changed(recorded, [source])
+    write(source, b"a,b\n1,2\n3,4\n")
+    assert sources_changed(recorded, [source])
+    # Source absente du manifeste
+    other = str(tmp_path / "other.csv")
+    write(other, b"")
+    assert sources_changed(recorded, [other])
+
+
+def test_build_lock_is_exclusive(tmp_path):
+    path = str(tmp_path / "data.json")
+    first, second = BuildLock(path), BuildLock(path)
+    assert first.acquire(blocking=False)
+    assert second.held()
+    assert not second.acquire(blocking=False)
+    first.release()
+    assert not second.held()
+    with second:
+        assert not first.acquire(blocking=False)
+    assert not first.held()
+
+
+def test_stale_lock_is_cleared(tmp_path):
+    path = str(tmp_path / "data.json")
+    lock = BuildLock(path)
+    write(lock.path, b"12345")
+    old = time.time() - manifest.lockTimeout - 10
+    os.utime(lock.path, (old, old))
+    assert lock.acquire(blocking=False)
+    with open(lock.path) as file:
+        assert file.read() == str(os.getpid())
+    lock.release()
+
+
+def test_lock_timeout(tmp_path):
+    path = str(tmp_path / "data.json")
+    holder = BuildLock(path)
+    assert holder.acquire(blocking=False)
+    start = time.monotonic()
+    assert not BuildLock(path).acquire(timeout=0.2, interval=0.05)
+    assert time.monotonic() - start < 5
+    assert holder.held()
+    holder.release()
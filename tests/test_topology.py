@@ -0,0 +1,63 @@
+#%%
+"""
+    Topologie d'une grille de 2 x 2 communes carrées : arcs partagés stockés une fois,
+    contours retrouvés à l'identique après encodage (encode_topology) et décodage
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+
+from geocodec import encode_topology
+from topology import build_topology
+
+side = 1000.0
+
+
+def grid():
+    squares = [box(x * side, y * side, (x + 1) * side, (y + 1) * side) for y in range(2) for x in range(2)]
+    return gpd.GeoDataFrame({"insee": ["A", "B", "C", "D"]}, geometry=squares, crs="EPSG:3857")
+
+
+def same_ring(decoded, original):
+    # Même suite de points, au point de départ près (points de fermeture retirés)
+    decoded, original = decoded[:-1], np.asarray(original.coords)[:-1]
+    if len(decoded) != len(original):
+        return False
+    return any(np.allclose(np.roll(decoded, shift, axis=0), original) for shift in range(len(decoded)))
+
+
+def test_shared_borders_stored_once():
+    topology = build_topology(grid())
+    arcLengths = np.diff(topology.arcOffsets)
+    # 12 segments distincts : 8 en limite de la grille, 4 partagés par deux communes
+    assert (arcLengths - 1).sum() == 12
+    # Chaque frontière intérieure est parcourue une fois dans chaque sens
+    used = np.concatenate([ring for position in range(4) for ring in topology.feature_rings(position)])
+    arcs, counts = np.unique(np.where(used >= 0, used, ~used), return_counts=True)
+    assert len(arcs) == len(arcLengths)
+    assert (counts == 2).sum() == 4
+
+
+def test_encode_decode_round_trip():
+    dataCities = grid()
+    topology = build_topology(dataCities)
+    positions = np.array([0, 1, 2, 3])
+    data = encode_topology(topology, positions, pd.DataFrame(index=positions), [])
+
+    table = {key: value[0] for key, value in data["_arcs"].items()}
+    offsets = table["offsets"]
+    origin = np.array([table["gx"], table["gy"]])
+
+    def arc_points(arc):
+        deltas = np.column_stack([table["x"], table["y"]])[offsets[arc]:offsets[arc + 1]].astype(np.int64)
+        start = np.array([table["sx"][arc], table["sy"][arc]])
+        return (start + np.cumsum(deltas, axis=0)) * data["_quantum"] + origin
+
+    for refs, geometry in zip(data["arcs"], dataCities.geometry):
+        points = []
+        for ref in refs:
+            arc = arc_points(ref if ref >= 0 else ~ref)
+            arc = arc if ref >= 0 else arc[::-1]
+            points.append(arc if not points else arc[1:])
+        assert same_ring(np.concatenate(points), geometry.exterior)
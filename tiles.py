@@ -0,0 +1,272 @@
+#%%
+"""
+    Proxy des tuiles du fond de carte, avec cache disque borné.
+
+        GET /tiles/<z>/<x>/<y>.png
+
+    Les tuiles sont lues dans le cache (DATA/tiles/z/x/y.png), ou demandées à la
+    source amont puis conservées. Quand le cache dépasse sa taille maximale, les
+    tuiles les moins récemment servies sont supprimées.
+
+    Configuration (variables d'environnement) :
+        - VIZIMPOTS_TILE_PROXY : adresse du proxy vue par le navigateur
+          (ex : http://localhost:8000/tiles) ; sans elle la carte utilise directement le CDN
+        - VIZIMPOTS_TILE_UPSTREAM : source amont, url avec {z}, {x}, {y}
+          (file:///chemin/{z}/{x}/{y}.png pour une source locale)
+        - VIZIMPOTS_TILE_OFFLINE : si défini, seules les tuiles du cache sont servies
+        - VIZIMPOTS_TILE_CACHE_MB : taille maximale du cache (Mo)
+
+    Pré-remplissage du cache (ex : 30 km autour de Lyon, zooms 8 à 13) :
+
+        python tiles.py 69123 30 8 13
+"""
+import os
+import sys
+import math
+import tempfile
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from flask import Blueprint, Response, abort
+
+tiles = Blueprint("tiles", __name__, url_prefix="/tiles")
+
+# Répertoire du cache des tuiles
+tile_cache_dir = "DATA/tiles"
+# Taille maximale du cache (octets)
+tileCacheBytes = int(float(os.environ.get("VIZIMPOTS_TILE_CACHE_MB", 500)) * 1e6)
+# Source amont (fond de carte CartoDB Positron, comme Vendors.CARTODBPOSITRON)
+upstreamUrl = os.environ.get("VIZIMPOTS_TILE_UPSTREAM",
+                             "https://tiles.basemaps.cartocdn.com/light_all/{z}/{x}/{y}.png")
+# Fonctionnement sans accès à la source amont
+offline = bool(os.environ.get("VIZIMPOTS_TILE_OFFLINE"))
+# Adresse du proxy pour le navigateur (None : tuiles demandées directement au CDN)
+proxyUrl = os.environ.get("VIZIMPOTS_TILE_PROXY")
+# Zoom maximal servi
+maxZoom = 19
+# Nombre maximal de tuiles préchargées par niveau de zoom
+prefetchTiles = 64
+# Durée de mise en cache par le navigateur (s)
+tileMaxAge = 86400
+
+# Rayon de la sphère de la projection web mercator (m)
+_earthRadius = 6378137.0
+
+
+class TileCache:
+    """
+        Cache disque des tuiles, de taille bornée (suppression des moins récemment servies)
+        L'ordre d'utilisation est conservé en mémoire ; au démarrage il est reconstitué
+        à partir des dates de modification des fichiers.
+    """
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = Lock()
+        self.entries = OrderedDict()    # chemin -> taille, du moins au plus récemment servi
+        self.size = 0
+
+        found = []
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith(".png"):
+                    info = os.stat(os.path.join(root, name))
+                    found.append((info.st_mtime, os.path.join(root, name), info.st_size))
+        for _, path, size in sorted(found):
+            self.entries[path] = size
+            self.size += size
+
+    def path(self, z, x, y):
+        return os.path.join(self.directory, str(z), str(x), f"{y}.png")
+
+    def get(self, z, x, y):
+        """
+            Contenu de la tuile, ou None si elle n'est pas en cache
+        """
+        path = self.path(z, x, y)
+        with self.lock:
+            if path not in self.entries:
+                return None
+            self.entries.move_to_end(path)
+        try:
+            with open(path, "rb") as file:
+                content = file.read()
+        except OSError:
+            with self.lock:
+                self.size -= self.entries.pop(path, 0)
+            return None
+        # Date conservée pour l'ordre d'éviction au prochain démarrage
+        # (la tuile a pu être évincée entre-temps par un autre thread)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return content
+
+    def put(self, z, x, y, content):
+        """
+            Enregistre la tuile (écriture atomique), puis réduit le cache à sa taille maximale
+        """
+        path = self.path(z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Nom temporaire unique : une requête et un préchargement peuvent écrire la même tuile
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(handle, "wb") as file:
+            file.write(content)
+        os.replace(temp, path)
+
+        with self.lock:
+            self.size += len(content) - self.entries.pop(path, 0)
+            self.entries[path] = len(content)
+            evicted = []
+            while self.size > self.maxBytes and len(self.entries) > 1:
+                oldPath, oldSize = self.entries.popitem(last=False)
+                self.size -= oldSize
+                evicted.append(oldPath)
+        for oldPath in evicted:
+            try:
+                os.remove(oldPath)
+            except OSError:
+                pass
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.path(*key) in self.entries
+
+
+_cache = None
+_cacheLock = Lock()
+# Préchargements : quelques téléchargements simultanés, sans doublon
+_prefetcher = ThreadPoolExecutor(max_workers=4)
+_pending = set()
+_pendingLock = Lock()
+
+
+def get_cache():
+    """
+        Cache des tuiles du processus (ouvert au premier appel)
+    """
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            _cache = TileCache(tile_cache_dir, tileCacheBytes)
+    return _cache
+
+
+def fetch_upstream(z, x, y):
+    """
+        Télécharge la tuile auprès de la source amont (None si indisponible)
+    """
+    if offline:
+        return None
+    url = upstreamUrl.format(z=z, x=x, y=y)
+    request = urllib.request.Request(url, headers={"User-Agent": "VizImpots tile proxy"})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.read()
+    except OSError:
+        return None
+
+
+def get_tile(z, x, y):
+    """
+        Tuile depuis le cache, ou depuis la source amont (puis mise en cache)
+    """
+    cache = get_cache()
+    content = cache.get(z, x, y)
+    if content is None:
+        content = fetch_upstream(z, x, y)
+        if content is not None:
+            cache.put(z, x, y, content)
+    return content
+
+
+@tiles.route("/<int:z>/<int:x>/<int:y>.png", methods=["GET"])
+def tile(z, x, y):
+    if not 0 <= z <= maxZoom or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        abort(404)
+    content = get_tile(z, x, y)
+    if content is None:
+        abort(404)
+    response = Response(content, mimetype="image/png")
+    response.cache_control.public = True
+    response.cache_control.max_age = tileMaxAge
+    return response
+
+
+def tile_range(bounds, z):
+    """
+        Tuiles couvrant une emprise web mercator au zoom z
+        Entrées :
+            - bounds : (xmin, ymin, xmax, ymax) en EPSG:3857
+            - z : niveau de zoom
+        Sorties :
+            - intervalles (xmin, xmax), (ymin, ymax) des indices de tuiles (bornes incluses)
+    """
+    n = 2 ** z
+    extent = 2 * math.pi * _earthRadius
+
+    def index(value):
+        return min(max(int(value * n // extent), 0), n - 1)
+
+    xmin, ymin, xmax, ymax = bounds
+    # Les lignes de tuiles sont comptées depuis le nord
+    return ((index(xmin + extent / 2), index(xmax + extent / 2)),
+            (index(extent / 2 - ymax), index(extent / 2 - ymin)))
+
+
+def area_tiles(bounds, zooms=None):
+    """
+        Tuiles d'une emprise, pour chaque zoom où elle tient en au plus prefetchTiles tuiles
+    """
+    result = []
+    for z in (zooms if zooms is not None else range(maxZoom + 1)):
+        (x0, x1), (y0, y1) = tile_range(bounds, z)
+        if zooms is None and (x1 - x0 + 1) * (y1 - y0 + 1) > prefetchTiles:
+            break
+        result += [(z, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+    return result
+
+
+def _prefetch_tile(key):
+    try:
+        get_tile(*key)
+    finally:
+        with _pendingLock:
+            _pending.discard(key)
+
+
+def prefetch_area(bounds):
+    """
+        Précharge en arrière-plan les tuiles de l'emprise affichée, aux zooms
+        où elle est visible (cf area_tiles), sans attendre leur téléchargement
+        Entrées :
+            - bounds : (xmin, ymin, xmax, ymax) en EPSG:3857
+    """
+    if proxyUrl is None or offline:
+        return
+    cache = get_cache()
+    for key in area_tiles(bounds):
+        with _pendingLock:
+            if key in _pending or key in cache:
+                continue
+            _pending.add(key)
+        _prefetcher.submit(_prefetch_tile, key)
+
+
+if __name__ == '__main__':
+    from dataset import get_store
+
+    insee, radius, zmin, zmax = sys.argv[1], float(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4])
+    store = get_store()
+    displaySet = store.select(store.city(insee), radius)
+    keys = area_tiles(displaySet.total_bounds, range(zmin, zmax + 1))
+    missing = 0
+    for count, key in enumerate(keys, 1):
+        if get_tile(*key) is None:
+            missing += 1
+        print(f"\r{count}/{len(keys)} tuiles", end="")
+    print(f"\n{len(keys) - missing} tuiles en cache, {missing} indisponibles")
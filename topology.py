@@ -0,0 +1,218 @@
+#%%
+"""
+    Topologie du tracé des communes : les frontières communes à deux communes voisines
+    ne sont stockées (et transmises) qu'une seule fois.
+
+    Le contour de chaque commune est découpé en arcs : suites de segments partagés avec
+    une même commune voisine (ou avec aucune, en limite du territoire). Chaque arc est
+    enregistré une fois, dans le sens de la première commune qui le parcourt ; la commune
+    voisine y fait référence en sens inverse (~id, comme dans le format TopoJSON).
+
+    Stockage (tableaux numpy, sauvegardés dans DATA/topology.npz) :
+        - coords : points des arcs, en entiers sur la grille de pas quantum (m)
+        - arcOffsets : début de chaque arc dans coords
+        - refs : références d'arcs de chaque contour (id ou ~id si parcouru à l'envers)
+        - ringOffsets : début de chaque contour dans refs
+        - featureOffsets : premier contour de chaque commune
+"""
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+from geocodec import exterior_rings, defaultQuantum
+
+# Topologie sauvegardée (reconstruite si le jeu de données change)
+topology_file = "DATA/topology.npz"
+
+
+class Topology:
+    """
+        Tracé des communes décomposé en arcs partagés (cf description du module)
+    """
+
+    def __init__(self, quantum, coords, arcOffsets, refs, ringOffsets, featureOffsets):
+        self.quantum = quantum
+        self.coords = coords
+        self.arcOffsets = arcOffsets
+        self.refs = refs
+        self.ringOffsets = ringOffsets
+        self.featureOffsets = featureOffsets
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.coords, self.arcOffsets, self.refs,
+                                              self.ringOffsets, self.featureOffsets))
+
+    def feature_rings(self, position):
+        """
+            Références d'arcs des contours d'une commune (une liste par contour)
+        """
+        first, last = self.featureOffsets[position], self.featureOffsets[position + 1]
+        return [self.refs[self.ringOffsets[ring]:self.ringOffsets[ring + 1]] for ring in range(first, last)]
+
+    def save(self, path, version):
+        """
+            Sauvegarde sous un nom temporaire unique, puis substitution d'un coup : un autre
+            processus qui lit le fichier au même moment ne voit jamais de fichier partiel
+        """
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        with os.fdopen(handle, "wb") as file:
+            np.savez(file, version=version, quantum=self.quantum, coords=self.coords,
+                     arcOffsets=self.arcOffsets, refs=self.refs,
+                     ringOffsets=self.ringOffsets, featureOffsets=self.featureOffsets)
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path, version):
+        """
+            Charge la topologie sauvegardée, ou None si elle correspond à un autre jeu de données
+        """
+        with np.load(path) as saved:
+            if str(saved["version"]) != version:
+                return None
+            return cls(float(saved["quantum"]), saved["coords"], saved["arcOffsets"], saved["refs"],
+                       saved["ringOffsets"], saved["featureOffsets"])
+
+
+def quantize_rings(geometries, quantum):
+    """
+        Contours extérieurs de chaque commune, en points entiers sur la grille
+        (points répétés et point de fermeture supprimés)
+        Sorties :
+            - liste des contours (tableaux (n, 2)), liste de la commune de chaque contour
+    """
+    rings, ringFeature = [], []
+    for feature, geometry in enumerate(geometries):
+        for ring in exterior_rings(geometry):
+            points = np.rint(np.asarray(ring.coords)[:, :2] / quantum).astype(np.int64)
+            keep = np.ones(len(points), dtype=bool)
+            keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+            points = points[keep]
+            if len(points) > 1 and (points[0] == points[-1]).all():
+                points = points[:-1]
+            if len(points) >= 3:
+                rings.append(points)
+                ringFeature.append(feature)
+    return rings, np.array(ringFeature, dtype=np.int64)
+
+
+def segment_neighbours(rings):
+    """
+        Identifie, pour chaque segment de chaque contour, le segment identique (parcouru
+        dans un sens ou dans l'autre) d'un autre contour.
+        Calcul vectorisé sur l'ensemble des segments.
+        Sorties :
+            - segId : identifiant du segment (identique pour les deux contours qui le partagent)
+            - neighbour : contour voisin partageant le segment (-1 si aucun)
+            - ringStarts : position du premier segment de chaque contour
+    """
+    lengths = np.array([len(ring) for ring in rings], dtype=np.int64)
+    ringStarts = np.concatenate([[0], np.cumsum(lengths)])
+    starts = np.concatenate(rings)
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    segRing = np.repeat(np.arange(len(rings)), lengths)
+
+    # Clé du segment indépendante du sens de parcours
+    swap = (starts[:, 0] > ends[:, 0]) | ((starts[:, 0] == ends[:, 0]) & (starts[:, 1] > ends[:, 1]))
+    low = np.where(swap[:, np.newaxis], ends, starts)
+    high = np.where(swap[:, np.newaxis], starts, ends)
+    keys = np.column_stack([low, high])
+    _, segId, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    segId = segId.reshape(-1)
+
+    # Les segments partagés par exactement deux contours relient ces contours
+    order = np.argsort(segId, kind="stable")
+    same = segId[order][1:] == segId[order][:-1]
+    first, second = order[:-1][same], order[1:][same]
+    valid = (counts[segId[first]] == 2) & (segRing[first] != segRing[second])
+    neighbour = np.full(len(segId), -1, dtype=np.int64)
+    neighbour[first[valid]] = segRing[second[valid]]
+    neighbour[second[valid]] = segRing[first[valid]]
+
+    return segId, neighbour, ringStarts
+
+
+def build_topology(dataCities, quantum=defaultQuantum):
+    """
+        Construit la topologie du tracé de toutes les communes
+        Entrées :
+            - dataCities : geoDataFrame de toutes les communes (EPSG:3857)
+            - quantum : pas de la grille (m)
+        Sorties :
+            - Topology
+    """
+    rings, ringFeature = quantize_rings(dataCities.geometry, quantum)
+    segId, neighbour, ringStarts = segment_neighbours(rings)
+
+    arcs = []       # points de chaque arc
+    arcIndex = {}   # (plus petit segment, nombre de segments) -> id de l'arc
+    ringRefs = []
+
+    def register(points, segments, closed):
+        # Retourne la référence de l'arc formé par points, en le créant s'il est nouveau
+        key = (int(segments.min()), len(segments))
+        arc = arcIndex.get(key)
+        if arc is not None and len(arcs[arc]) == len(points):
+            stored = arcs[arc]
+            if closed:
+                # Contour fermé : même point de départ, sens donné par le second point
+                if (stored[0] == points[0]).all():
+                    return arc if (stored[1] == points[1]).all() else ~arc
+            elif (stored[0] == points[0]).all() and (stored[-1] == points[-1]).all():
+                return arc
+            elif (stored[0] == points[-1]).all() and (stored[-1] == points[0]).all():
+                return ~arc
+        arcIndex.setdefault(key, len(arcs))
+        arcs.append(points)
+        return len(arcs) - 1
+
+    for ring, points in enumerate(rings):
+        n = len(points)
+        segments = segId[ringStarts[ring]:ringStarts[ring + 1]]
+        neighbours = neighbour[ringStarts[ring]:ringStarts[ring + 1]]
+        # Le contour est coupé à chaque changement de commune voisine
+        breaks = np.flatnonzero(neighbours != np.roll(neighbours, 1))
+
+        if len(breaks) == 0:
+            # Contour d'un seul tenant : départ au plus petit point pour être reconnu par le voisin
+            start = np.lexsort((points[:, 1], points[:, 0]))[0]
+            closedPoints = points[(start + np.arange(n + 1)) % n]
+            ringRefs.append([register(closedPoints, segments, True)])
+            continue
+
+        refs = []
+        for start, end in zip(breaks, np.append(breaks[1:], breaks[0] + n)):
+            span = np.arange(start, end + 1) % n
+            refs.append(register(points[span], segments[span[:-1]], False))
+        ringRefs.append(refs)
+
+    arcLengths = np.array([len(arc) for arc in arcs], dtype=np.int64)
+    ringLengths = np.array([len(refs) for refs in ringRefs], dtype=np.int64)
+    featureRings = np.bincount(ringFeature, minlength=len(dataCities))
+
+    return Topology(quantum,
+                    np.concatenate(arcs).astype(np.int32),
+                    np.concatenate([[0], np.cumsum(arcLengths)]),
+                    np.concatenate(ringRefs).astype(np.int32),
+                    np.concatenate([[0], np.cumsum(ringLengths)]),
+                    np.concatenate([[0], np.cumsum(featureRings)]))
+
+
+def load_topology(dataCities, version, path=topology_file, build=True):
+    """
+        Charge la topologie sauvegardée pour cette version du jeu de données,
+        ou la construit (puis la sauvegarde) ; None si elle manque et que build est faux
+    """
+    try:
+        topology = Topology.load(path, version)
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        topology = None
+
+    if topology is None and build:
+        print("topologie des communes non trouvée, génération en cours")
+        topology = build_topology(dataCities)
+        topology.save(path, version)
+
+    return topology
@@ -0,0 +1,623 @@
+#%%
+import time
+from functools import lru_cache
+
+import geopandas as gpd
+from shapely.geometry import Polygon, box
+
+from bokeh.models import Slider, Select, CheckboxGroup, TextInput, Toggle, Div, Spinner
+from bokeh.layouts import column, row
+from bokeh.palettes import brewer, Colorblind
+from bokeh.themes import Theme
+
+from dataset import (get_store, on_reload, create_displayParam, create_infoParam,
+                     compute_stats, param_label, data_yr, dict_imp, dict_mesure)
+from engine import Engine
+from figures import (create_choropleth, createHisto, create_info, compute_histo, encode_choropleth,
+                     create_basemap)
+from tiles import prefetch_area
+from classify import dict_classif, defaultScheme
+from smoothing import display_surface, dict_kernel, defaultKernel, maxBandwidth
+from simulator import with_amounts, defaultVLC, maxVLC
+
+#impot par défaut
+defaultImpot = 'TauxTH_'
+#mesure par défaut
+defaultMesure = 'taux'
+#palette
+defaultPalette = brewer['RdYlGn'][7] #7 couleurs Vert-Jaune-Rouge
+# gestion de la commune par défaut
+defaultDist = 10
+defaultInsee = '75056' # Paris
+# nombre de suggestions de la recherche de commune
+searchLimit = 10
+# distance d'affichage maximale (km)
+maxDist = 100
+# sélection par voisinage : nombre de rangs de communes par défaut et maximal
+defaultHops = 2
+maxHops = 10
+# modes de sélection des communes affichées
+dict_selection = {"Distance (km)": "dist", "Voisinage (rangs)": "hops"}
+# délai minimal entre deux calculs pendant le tracé d'une sélection libre (s)
+selectionDelay = 0.15
+
+
+@lru_cache(maxsize=64)
+def prepare_view(store, insee, dist, hops, displayParam, infoParam, nBins):
+    """
+        Prépare, une fois par processus, les données de la vue initiale d'une session :
+        sélection, encodage du tracé, histogramme et statistiques.
+        Les sessions suivantes ouvertes sur la même vue ne font plus que créer les figures.
+        Entrées :
+            - store : jeu de données de la session (un rechargement change la clé du cache)
+            - insee : code insee de la commune de référence
+            - dist : distance d'affichage (km)
+            - hops : nombre de rangs de voisinage (None : sélection par distance)
+            - displayParam : paramètre affiché
+            - infoParam : paramètres du panneau d'information (tuple)
+            - nBins : nombre de regroupements de l'histogramme
+        Sortie :
+            - dictionnaire (ogCity, displaySet, geodata, histo, stats)
+    """
+    ogCity = store.city(insee)
+    displaySet = Engine(store).select(insee, dist, hops)
+    # Préchargement des tuiles de la vue par le proxy (s'il est utilisé)
+    prefetch_area(displaySet.total_bounds)
+
+    return dict(ogCity=ogCity,
+                displaySet=displaySet,
+                geodata=encode_choropleth(displaySet, displayParam, store.topology),
+                histo=compute_histo(displaySet, displayParam, nBins),
+                stats=compute_stats(displaySet, list(infoParam)))
+
+
+# Les vues préparées sur l'ancien jeu de données ne servent plus après un rechargement
+on_reload(prepare_view.cache_clear)
+
+
+def selection_shape(geometry):
+    """
+        Zone tracée par un outil de sélection de la carte (événement SelectionGeometry)
+        Sortie :
+            - polygone shapely (EPSG:3857), ou None si la zone est vide ou non gérée
+    """
+    if geometry.get("type") == "rect":
+        shape = box(min(geometry["x0"], geometry["x1"]), min(geometry["y0"], geometry["y1"]),
+                    max(geometry["x0"], geometry["x1"]), max(geometry["y0"], geometry["y1"]))
+    elif geometry.get("type") == "poly" and len(geometry["x"]) >= 3:
+        # un lasso qui se recoupe n'est pas un polygone valide : buffer(0) le corrige
+        shape = Polygon(zip(geometry["x"], geometry["y"])).buffer(0)
+    else:
+        return None
+    return shape if shape.area > 0 else None
+
+
+def session_args(doc, store):
+    """
+        Lit la vue demandée dans l'url de la session (ex : ?insee=69123&dist=20 ou ?insee=69123&hops=3)
+        Les valeurs absentes ou invalides sont remplacées par la vue par défaut.
+        Sortie :
+            - tuple (insee, dist, hops), hops vaut None pour une sélection par distance
+    """
+    insee, dist, hops = defaultInsee, defaultDist, None
+    try:
+        arguments = doc.session_context.request.arguments
+    except AttributeError:
+        # document construit hors session (export, tests)
+        return insee, dist, hops
+
+    if "insee" in arguments:
+        value = arguments["insee"][0].decode()
+        if store.city(value) is not None:
+            insee = value
+    if "dist" in arguments:
+        try:
+            dist = min(max(int(arguments["dist"][0]), 0), maxDist)
+        except ValueError:
+            pass
+    if "hops" in arguments:
+        try:
+            hops = min(max(int(arguments["hops"][0]), 0), maxHops)
+        except ValueError:
+            pass
+    return insee, dist, hops
+
+
+def bkapp(doc, apiRoot=None):
+    """
+        Construit le document Bokeh d'une session (carte, histogramme, infos et widgets)
+        L'état (commune, jeu affiché, impôt, palette) est propre à chaque session.
+        Entrées :
+            - doc : document Bokeh de la session
+            - apiRoot : adresse de l'API JSON vue par le navigateur (ex : "/api", cf main.py) ;
+              None si elle n'est pas servie (bokeh serve seul) : pas de liens d'export
+    """
+
+    ### Fonctions de mise à jour ###
+
+    def update_layout(displaySet, displayParam, ogCity, palette):
+        """
+            Fonction permettant de mettre à jour toutes les figures du layout
+            Entrées :
+                - displaySet : DisplaySet des communes affichées
+                - displayParam : paramètres que l'on souhaite aficher
+                - ogCity : extract de la commune sélectionnée
+                - palette : liste de couleurs
+            Sorties :
+                - rien
+        """
+        # Arrêt de l'animation en cours (elle porte sur la carte remplacée)
+        toggle_play.active = False
+        # Montants estimés, pour la mesure "montant"
+        shownSet, shownCity = simulated(displaySet, ogCity)
+
+        # Mise à jour de la chroplèthe
+        appLayout.children[0].children[0] = create_choropleth(shownSet, displayParam, palette, shownCity,
+                                                              choro_title(), update_loc,
+                                                              topology=store.topology, basemap=basemap,
+                                                              scheme=scheme,
+                                                              surface=display_surface(store, displaySet, displayParam,
+                                                                                      slider_smooth.value, kernel),
+                                                              frames=frame_params(), playButton=toggle_play,
+                                                              selectCallback=update_shape)
+
+        # Liens d'export de la sélection affichée
+        div_export.text = export_links()
+
+        # Mise à jour de l'histogramme et des infos
+        update_panels(displaySet, displayParam, histo_title())
+
+    def update_panels(panelSet, displayParam, histoTitle):
+        """
+            Met à jour l'histogramme et le panneau d'information, sans toucher à la carte
+            Entrées :
+                - panelSet : DisplaySet des communes décrites (affichées, ou sélection libre)
+                - displayParam : paramètre affiché
+                - histoTitle : titre de l'histogramme
+        """
+        infoParam = create_infoParam(impot, mesure)
+        panelSet, panelCity = simulated(panelSet, ogCity)
+
+        # Mise à jour de l'histogramme
+        appLayout.children[1].children[0] = createHisto(panelSet, displayParam, palette, panelCity,
+                                                        histoTitle, scheme=scheme, baseline=store.baselines)
+
+        # Mise à jour des infos
+        appLayout.children[1].children[1:] = create_info(panelSet, infoParam, panelCity, select_imp.value,
+                                                         displayParam=displayParam, adjacency=store.adjacency,
+                                                         cheaper=cheaper_cities())
+
+    def cheaper_cities():
+        # Communes les plus proches au taux plus bas, pour l'impôt et l'année affichés
+        return store.cheaper(ogCity, create_displayParam(impot, slider_yr.value))
+
+    def simulated(view, city):
+        # Ajoute les montants estimés aux communes décrites, pour la mesure "montant"
+        if mesure != 'montant':
+            return view, city
+        return with_amounts(view, city, spinner_vlc.value)
+
+    def current_param():
+        # Paramètre à afficher en fonction de l'impôt, de l'année et de la mesure sélectionnés
+        return create_displayParam(impot, slider_yr.value, mesure)
+
+    def choro_title(year=None):
+        year = slider_yr.value if year is None else year
+        if mesure == 'taux':
+            return 'Taux ' + select_imp.value + " " + str(year)
+        return param_label(create_displayParam(impot, year, mesure)) + " " + select_imp.value
+
+    def export_links():
+        # Téléchargement des communes affichées (API servie par main.py, cf export.py)
+        if apiRoot is None:
+            return ""
+        if selection == 'hops':
+            query = f"hops={slider_hop.value}"
+        else:
+            query = f"radius={slider_dst.value}"
+        url = f"{apiRoot}/commune/{ogCity['insee']}/export?{query}"
+        links = [f'<a href="{url}&format={fmt}&geometry={geometry:d}" download>{label}</a>'
+                 for fmt, geometry, label in (("csv", False, "CSV"), ("geojson", True, "GeoJSON"),
+                                              ("parquet", True, "Parquet"))]
+        return "<b>Exporter la sélection</b> : " + " · ".join(links)
+
+    def frame_params():
+        # Paramètre et titre de la carte de chaque année, pour l'animation
+        # (une seule image pour les évolutions sur la période)
+        frames = {}
+        for year in data_yr:
+            frames.setdefault(create_displayParam(impot, year, mesure), choro_title(year))
+        return list(frames.items())
+
+    def select_view(city):
+        # Communes affichées autour de city selon le mode de sélection choisi
+        hops = slider_hop.value if selection == 'hops' else None
+        view = engine.select(city["insee"], slider_dst.value, hops)
+        # Préchargement des tuiles de la zone par le proxy (s'il est utilisé)
+        prefetch_area(view.total_bounds)
+        return view
+
+    def histo_title():
+        if mesure == 'taux':
+            return 'Répartition du taux de ' + select_imp.value + " " + str(slider_yr.value)
+        return 'Répartition : ' + param_label(current_param()) + " " + select_imp.value
+
+
+    ### Fonction callback ###
+
+    # Callback fonction (met à jour le graphique)
+    def update_yr(attr, old, new):
+        """
+            Fonction callback appelée au changement du slider des années.
+            Permet de modifier l'année du taux affiché.
+        """
+
+        # Création du paramètre à afficher en fonction de l'année sélectionnée :
+        displayParam = current_param()
+
+        #   Mise à jour du layout
+        update_layout(displaySet, displayParam, ogCity, palette)
+
+    def update_dst(attr, old, new):
+
+        """
+            Fonction callback appelée au changement de la distance d'affichage
+            (ou du nombre de rangs de voisinage)
+            Modifie le jeu de données afiché et recalcule les couleurs de nouveau jeu
+        """
+        nonlocal displaySet
+
+        # Création du paramètre à afficher en fonction de l'année sélectionnée :
+        displayParam = current_param()
+
+        # Mise à jour du jeu d'affichage
+        displaySet = select_view(ogCity)
+
+        #  Mise à jour du layout
+        update_layout(displaySet, displayParam, ogCity, palette)
+
+
+    def set_city(city):
+        """
+            Change la commune de référence et met à jour la carte en conséquence
+            Entrées :
+                - city : extract de la nouvelle commune sélectionnée
+        """
+        nonlocal ogCity
+        nonlocal displaySet
+
+        ogCity = city
+
+        # Calcul du nouveau jeu de données à afficher
+        displaySet = select_view(ogCity)
+        # Création du paramètre à afficher en fonction de l'année sélectionnée :
+        displayParam = current_param()
+        #  Mise à jour du layout
+        update_layout(displaySet, displayParam, ogCity, palette)
+
+    def update_loc(event):
+        """
+            Fonction callback activé au clic sur la map
+            Permet de changer la commune sélectionnée
+            Maj la carte avec la nouvelle commune de référence
+        """
+
+        ### Identification de la commune sous le point cliqué ###
+
+        # Création d'un objet shapely de type Point aux coords du clic :
+        clicPoint = gpd.points_from_xy([event.x], [event.y])
+        # Creation d'une geoserie contenant le point :
+        # Rem : utilisation de iloc[0] pour ne pas avoir d'index
+        # cf issue https://github.com/geopandas/geopandas/issues/317
+        pointSerie = gpd.GeoSeries(crs='epsg:3857', data=clicPoint).iloc[0]
+        # On recherche la commune qui contient le point :
+        clicCity = dataCities[dataCities.contains(other=pointSerie)]
+
+        ### Mise à jour de la carte avec la commune cliquée pour référence ###
+
+        # On vérifie avant maj que le clic a bien retourné une géométrie
+        set_city(clicCity.iloc[0] if not clicCity.empty else ogCity)
+
+    def update_shape(event):
+        """
+            Fonction callback appelée au tracé d'une zone avec les outils rectangle ou lasso
+            L'histogramme et les infos décrivent les communes de la zone (la carte ne change
+            pas). Pendant le tracé, au plus un calcul par selectionDelay ; la zone finale
+            est toujours prise en compte.
+        """
+        nonlocal lastShape
+
+        now = time.monotonic()
+        if not event.final and now - lastShape < selectionDelay:
+            return
+        lastShape = now
+
+        shape = selection_shape(event.geometry)
+        if shape is None:
+            return
+        shapeSet = store.select_shape(shape)
+        if shapeSet.empty:
+            return
+        displayParam = current_param()
+        update_panels(shapeSet, displayParam,
+                      f"Sélection libre ({len(shapeSet)} communes) : " + param_label(displayParam))
+
+    def update_search(attr, old, new):
+        """
+            Fonction callback appelée à la saisie dans le champ de recherche
+            Propose les communes dont le nom ou le code insee commence par le texte saisi
+        """
+        found = store.searchIndex.search(new, limit=searchLimit)
+        options = [(str(pos), f"{dataCities['nom'].iat[pos]} ({dataCities['Code_DEP'].iat[pos]}) - {dataCities['insee'].iat[pos]}")
+                   for pos in found]
+        header = f"{len(found)} résultat(s)" if new else ""
+        select_city.options = [("", header)] + options
+        select_city.value = ""
+
+    def update_pick(attr, old, new):
+        """
+            Fonction callback appelée au choix d'une commune parmi les suggestions
+            La commune devient directement la commune de référence
+        """
+        if new:
+            set_city(dataCities.iloc[int(new)])
+
+    def update_colormap(attr,old,new):
+        """
+            Change la palette de couleurs utilisée à l'action sur le toggle idoine
+        """
+        nonlocal palette
+
+        # Création du paramètre à afficher en fonction de l'année sélectionnée :
+        displayParam = current_param()
+
+        if len(new) > 0:
+            print('Mode Daltonien')
+            palette = Colorblind[7]
+        else:
+            print('Mode Normal')
+            palette = brewer['RdYlGn'][7]
+
+        #  Mise à jour du layout
+        update_layout(displaySet, displayParam, ogCity, palette)
+
+    def update_mesure(attr, old, new):
+        """
+            Fonction callback appelée au changement de la mesure affichée
+            (taux, évolution annuelle ou évolution sur la période)
+        """
+        nonlocal mesure
+
+        mesure = dict_mesure[new]
+
+        #   Mise à jour du layout
+        update_layout(displaySet, current_param(), ogCity, palette)
+
+    def update_selection(attr, old, new):
+        """
+            Fonction callback appelée au changement du mode de sélection des communes
+            (distance autour de la commune ou rangs de communes voisines)
+        """
+        nonlocal selection
+        nonlocal displaySet
+
+        selection = dict_selection[new]
+        slider_dst.visible = selection == 'dist'
+        slider_hop.visible = selection == 'hops'
+
+        displaySet = select_view(ogCity)
+        update_layout(displaySet, current_param(), ogCity, palette)
+
+    def update_classif(attr, old, new):
+        """
+            Fonction callback appelée au changement du mode de classification des couleurs
+            (intervalles égaux, quantiles ou seuils naturels)
+        """
+        nonlocal scheme
+
+        scheme = dict_classif[new]
+
+        #   Mise à jour du layout
+        update_layout(displaySet, current_param(), ogCity, palette)
+
+    def update_smoothing(attr, old, new):
+        """
+            Fonction callback appelée au changement de la largeur de lissage
+            (0 : taux de chaque commune) ou du mode de pondération de la surface lissée
+        """
+        nonlocal kernel
+
+        kernel = dict_kernel[select_kernel.value]
+
+        #   Mise à jour du layout
+        update_layout(displaySet, current_param(), ogCity, palette)
+
+    def update_vlc(attr, old, new):
+        """
+            Fonction callback appelée au changement de la valeur locative cadastrale simulée
+        """
+        if mesure == 'montant':
+            update_layout(displaySet, current_param(), ogCity, palette)
+
+    def update_impot(attr, old, new):
+        nonlocal impot
+
+        impot = dict_imp[new]
+
+        # Création du paramètre à afficher en fonction de l'année sélectionnée :
+        displayParam = current_param()
+
+        #   Mise à jour du layout
+        update_layout(displaySet, displayParam, ogCity, palette)
+
+
+    #%%
+    # Jeu de données partagé par les sessions (chargé une seule fois par processus)
+    store = get_store()
+    engine = Engine(store)
+    dataCities = store.dataCities
+
+    # %%
+
+    ### Main Code ####
+
+    ### Constrution de la carte et légende ####
+
+    # Paramètres par défaut (Paris, sauf commune demandée dans l'url)
+    impot = defaultImpot
+    mesure = defaultMesure
+    palette = defaultPalette
+    scheme = defaultScheme
+    kernel = defaultKernel
+    # heure du dernier calcul de sélection libre (cf update_shape)
+    lastShape = 0.0
+    insee, dist, hops = session_args(doc, store)
+    selection = 'dist' if hops is None else 'hops'
+    # paramètre affiché par défaut = taxe d'habitation la plus récente
+    defaultParam = create_displayParam(impot, data_yr[-1], mesure)
+    infoParam = create_infoParam(impot, mesure)
+
+    # Création du set de donnée à afficher (préparé une seule fois par processus)
+    initialView = prepare_view(store, insee, dist, hops, defaultParam, tuple(infoParam), len(palette))
+    ogCity = initialView["ogCity"]
+    displaySet = initialView["displaySet"]
+
+
+    ### Construction du front-end ###
+
+    # Ajout d'un slider pour choisir l'année
+    slider_yr = Slider(title = 'Année',
+                        start = data_yr[0],
+                        end = data_yr[-1],
+                        step = 1,
+                        value = data_yr[-1],
+                        default_size = 250
+                        )
+    slider_yr.on_change('value', update_yr)
+
+    # Ajout d'un slider pour choisir la distance d'affichage
+    slider_dst = Slider(title = 'Distance d\'affichage (km)',
+                        start = 0,
+                        end = 100,
+                        step = 5,
+                        value = dist,
+                        default_size = 250,
+                        visible = selection == 'dist'
+                        )
+    slider_dst.on_change('value', update_dst)
+
+    # Ajout d'un slider pour choisir le nombre de rangs de voisinage
+    slider_hop = Slider(title = 'Voisinage (rangs de communes)',
+                        start = 0,
+                        end = maxHops,
+                        step = 1,
+                        value = defaultHops if hops is None else hops,
+                        default_size = 250,
+                        visible = selection == 'hops'
+                        )
+    slider_hop.on_change('value', update_dst)
+
+    # Ajout d'un sélecteur pour choisir le mode de sélection des communes
+    select_sel = Select(title="Sélection :",
+                        value=[label for label, value in dict_selection.items() if value == selection][0],
+                        options=list(dict_selection)
+                    )
+    select_sel.on_change('value', update_selection)
+
+    # Ajout d'un sélecteur pour choisir l'impot à afficher
+    select_imp = Select(title="Impôt:",
+                        value="Taxe d'habitation",
+                        options=list(dict_imp)
+                    )
+    select_imp.on_change('value', update_impot)
+
+    # Ajout d'un sélecteur pour choisir la mesure affichée (taux ou évolution)
+    select_mesure = Select(title="Mesure:",
+                           value=list(dict_mesure)[0],
+                           options=list(dict_mesure)
+                        )
+    select_mesure.on_change('value', update_mesure)
+
+    # Ajout d'un sélecteur pour choisir la classification des couleurs
+    select_classif = Select(title="Classes de couleur:",
+                            value=list(dict_classif)[0],
+                            options=list(dict_classif)
+                        )
+    select_classif.on_change('value', update_classif)
+
+    # Ajout d'un slider pour choisir la largeur de la surface lissée (0 : désactivée)
+    slider_smooth = Slider(title = 'Lissage (km)',
+                        start = 0,
+                        end = maxBandwidth,
+                        step = 1,
+                        value = 0,
+                        default_size = 250
+                        )
+    slider_smooth.on_change('value', update_smoothing)
+
+    # Ajout d'un sélecteur pour choisir la pondération du lissage
+    select_kernel = Select(title="Pondération du lissage :",
+                           value=[label for label, value in dict_kernel.items() if value == kernel][0],
+                           options=list(dict_kernel)
+                        )
+    select_kernel.on_change('value', update_smoothing)
+
+    # Ajout d'un bouton d'animation des années (jouée par le navigateur)
+    toggle_play = Toggle(label="▶ Animation des années", active=False)
+
+    # Ajout d'une saisie de la valeur locative cadastrale (mesure "Montant estimé")
+    spinner_vlc = Spinner(title="Valeur locative cadastrale (€/an) :",
+                          value=defaultVLC,
+                          low=0,
+                          high=maxVLC,
+                          step=100
+                        )
+    spinner_vlc.on_change('value', update_vlc)
+
+    # Ajout d'un mode daltonien
+    checkbox_dalto = CheckboxGroup(labels=["Mode Daltonien"])
+    checkbox_dalto.on_change('active', update_colormap)
+
+    # Ajout d'une recherche de commune par nom ou code insee
+    search_city = TextInput(title="Rechercher une commune :",
+                            placeholder="Nom ou code insee"
+                        )
+    search_city.on_change('value', update_search)
+    select_city = Select(title="Résultats :",
+                         value="",
+                         options=[("", "")]
+                    )
+    select_city.on_change('value', update_pick)
+
+    # Ajout des liens d'export des communes affichées
+    div_export = Div(text=export_links(), visible=apiRoot is not None)
+
+    # Fond de carte de la session (conservé lors des mises à jour de la carte)
+    basemap = create_basemap()
+    # Creation de la choropleth
+    choroPlot = create_choropleth(displaySet, defaultParam, palette, ogCity, choro_title(), update_loc,
+                                  geodata=initialView["geodata"], basemap=basemap,
+                                  frames=frame_params(), playButton=toggle_play,
+                                  selectCallback=update_shape)
+    # Creation de l'historamme
+    histoPlot = createHisto(displaySet, defaultParam, palette, ogCity, histo_title(),
+                            histo=initialView["histo"], baseline=store.baselines)
+    # Creation des figures infos
+    infoTitle, infoDisplaySet = create_info(displaySet, infoParam, ogCity, select_imp.value,
+                                            stats=initialView["stats"], displayParam=defaultParam,
+                                            adjacency=store.adjacency, cheaper=cheaper_cities())
+
+    # Organisation colones/lignes
+    Col1 = column(slider_yr, toggle_play, select_sel, slider_dst, slider_hop)
+    Col2 = column(select_imp, select_mesure, spinner_vlc, select_classif, checkbox_dalto)
+    Col5 = column(search_city, select_city, div_export)
+    Col6 = column(slider_smooth, select_kernel)
+    row_wgt = row(Col1, Col2, Col6, Col5)
+    Col3 = column(choroPlot, row_wgt)
+    Col4 = column(histoPlot,infoTitle, infoDisplaySet)
+    appLayout = row(Col3, Col4)
+
+    doc.add_root(appLayout)
+    doc.title = "VizImpôts"
+
+    doc.theme = Theme(filename="theme.yaml")